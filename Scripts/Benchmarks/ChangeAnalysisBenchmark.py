@@ -0,0 +1,459 @@
+"""Benchmark of the change analysis hot path with synthetic OSM data
+
+Generates a synthetic base map spread over the generation polygon of
+IsraelHikingTileGenCommand: towns of short streets, intercity roads,
+hiking route relations, multipolygons, and a single country-long route
+relation. For each scenario, an Osm Change file and the updated map are
+generated from the base map:
+- minutely: a few dozen edits in a single town
+- daily: thousands of edits all over the country
+- week: a week of catch-up, as a single change file
+- relation: a single edit of the country-long route relation
+
+Each scenario runs in its own process, and reports the time and the peak
+resident memory after each stage of the analysis:
+- load: reading the base and new maps by the stand-in Map.add_osm_source
+- index: building an OsmGeometryIndex of the base map (with --index only)
+- classifier: building the tile classification of the generation polygon
+- analysis: osmChangeRead, excluding the load
+- mark_bbox: the part of the analysis spent in mark_bbox (without --workers only,
+  as the analysis threads bind the command class's methods)
+- new_tile_upwards: propagating each changed tile at max zoom one by one
+- update_guard: the guard band around the changed tiles
+- tiles_overlapps_polygon: every 2x2 super-tile of the polygon at each zoom level
+- updated: the generation filter of every 2x2 super-tile at each zoom level
+
+Usage:
+    python ChangeAnalysisBenchmark.py [--scale <factor>] [--index] [--workers <threads>] [<scenario> ...]
+
+The base map has about 400,000 nodes at scale 1.
+Runs headless under CPython 2.7 on Linux. Without Maperitive, the maperipy
+module is replaced by the stand-ins in the StandIn directory.
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import subprocess
+import resource
+
+if sys.platform != "cli":
+    # The standard module, rather than the IronPython replacement in the Maperipy directory
+    import sqlite3
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(benchmarks_dir, '..', 'Maperipy'))
+try:
+    import maperipy
+except ImportError:
+    sys.path.insert(0, os.path.join(benchmarks_dir, 'StandIn'))
+    import maperipy
+from maperipy import Map
+from GenIsraelHikingTiles import IsraelHikingTileGenCommand
+from OsmGeometryIndex import OsmGeometryIndex
+from PolygonTileClassifier import point_in_polygon, polygon_tile_extent
+from TileSet import TileSet
+
+# Like the map creation scripts, run in the project directory, where the Filters are
+os.chdir(os.path.join(benchmarks_dir, '..', '..'))
+
+SCENARIOS = ("minutely", "daily", "week", "relation")
+# Number of edits of each scenario at scale 1
+EDITS = {"minutely": 40, "daily": 5000, "week": 35000, "relation": 0}
+TOWNS = 300  # at scale 1
+STREETS_PER_TOWN = 80
+ROADS = 400  # at scale 1
+ROUTES = 200  # at scale 1
+NATIONAL_TRAIL_WAYS = 3000
+NATIONAL_TRAIL_ID = 1
+
+class OsmModel(object):
+    """In-memory synthetic OSM data: nodes, ways, and relations by id"""
+    def __init__(self):
+        self.nodes = {}  # id: (lon, lat)
+        self.ways = {}  # id: ([node ids], tags)
+        self.relations = {}  # id: ([(type, ref, role)], tags)
+        self.next_id = {"node": 1, "way": 1, "relation": 1}
+
+    def new_id(self, element_type):
+        element_id = self.next_id[element_type]
+        self.next_id[element_type] += 1
+        return element_id
+
+    def add_way(self, points, tags):
+        node_ids = []
+        for point in points:
+            node_id = self.new_id("node")
+            self.nodes[node_id] = point
+            node_ids.append(node_id)
+        if tags.get("area") == "yes":
+            node_ids.append(node_ids[0])
+        way_id = self.new_id("way")
+        self.ways[way_id] = (node_ids, tags)
+        return way_id
+
+    def has(self, element_type, element_id):
+        return element_id in {"node": self.nodes, "way": self.ways, "relation": self.relations}[element_type]
+
+    def copy(self):
+        result = OsmModel()
+        result.nodes = dict(self.nodes)
+        result.ways = dict(self.ways)
+        result.relations = dict(self.relations)
+        result.next_id = dict(self.next_id)
+        return result
+
+    def write_element(self, f, element_type, element_id, indent="  "):
+        if element_type == "node":
+            (lon, lat) = self.nodes[element_id]
+            f.write('{}<node id="{}" version="1" lat="{:.7f}" lon="{:.7f}"/>\n'.format(
+                indent, element_id, lat, lon))
+            return
+        if element_type == "way":
+            (node_ids, tags) = self.ways[element_id]
+            f.write('{}<way id="{}" version="1">\n'.format(indent, element_id))
+            for node_id in node_ids:
+                f.write('{}  <nd ref="{}"/>\n'.format(indent, node_id))
+        else:
+            (members, tags) = self.relations[element_id]
+            f.write('{}<relation id="{}" version="1">\n'.format(indent, element_id))
+            for (member_type, ref, role) in members:
+                f.write('{}  <member type="{}" ref="{}" role="{}"/>\n'.format(
+                    indent, member_type, ref, role))
+        for key in sorted(tags):
+            f.write('{}  <tag k="{}" v="{}"/>\n'.format(indent, key, tags[key]))
+        f.write('{}</{}>\n'.format(indent, element_type))
+
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            f.write('<osm version="0.6" generator="ChangeAnalysisBenchmark">\n')
+            for (element_type, elements) in (
+                    ("node", self.nodes), ("way", self.ways), ("relation", self.relations)):
+                for element_id in sorted(elements):
+                    self.write_element(f, element_type, element_id)
+            f.write('</osm>\n')
+
+def polygon_coords():
+    return IsraelHikingTileGenCommand().polygon_coords()
+
+def random_point(rnd, coords):
+    """A random (lon, lat) inside the polygon"""
+    (west, east) = (min(lon for (lon, lat) in coords), max(lon for (lon, lat) in coords))
+    (south, north) = (min(lat for (lon, lat) in coords), max(lat for (lon, lat) in coords))
+    while True:
+        (lon, lat) = (rnd.uniform(west, east), rnd.uniform(south, north))
+        if point_in_polygon(lon, lat, coords):
+            return (lon, lat)
+
+def random_walk(rnd, start, count, step):
+    points = [start]
+    for i in xrange(count-1):
+        (lon, lat) = points[-1]
+        points.append((lon + rnd.uniform(-step, step), lat + rnd.uniform(-step, step)))
+    return points
+
+def generate_base(scale, seed=1):
+    """The synthetic base map, the way ids of each town, and the way ids of the roads"""
+    rnd = random.Random(seed)
+    coords = polygon_coords()
+    model = OsmModel()
+    # The country-long route relation, with the lowest relation id
+    model.new_id("relation")
+    towns = []
+    centers = []
+    for town in xrange(int(TOWNS*scale)):
+        center = random_point(rnd, coords)
+        centers.append(center)
+        ways = []
+        for street in xrange(STREETS_PER_TOWN):
+            start = (center[0] + rnd.uniform(-0.02, 0.02), center[1] + rnd.uniform(-0.02, 0.02))
+            if rnd.random() < 0.2:
+                ways.append(model.add_way(random_walk(rnd, start, rnd.randint(4, 8), 0.0005),
+                    {"building": "yes", "area": "yes"}))
+            else:
+                ways.append(model.add_way(random_walk(rnd, start, rnd.randint(2, 15), 0.001),
+                    {"highway": rnd.choice(("residential", "service", "footway"))}))
+        towns.append(ways)
+    roads = []
+    for road in xrange(int(ROADS*scale)):
+        (lon1, lat1) = rnd.choice(centers)
+        (lon2, lat2) = rnd.choice(centers)
+        count = rnd.randint(20, 60)
+        points = [(lon1 + (lon2-lon1)*i/(count-1.0) + rnd.uniform(-0.002, 0.002),
+                   lat1 + (lat2-lat1)*i/(count-1.0) + rnd.uniform(-0.002, 0.002))
+                  for i in xrange(count)]
+        roads.append(model.add_way(points, {"highway": "primary"}))
+    for route in xrange(int(ROUTES*scale)):
+        start = random_point(rnd, coords)
+        members = []
+        for i in xrange(rnd.randint(5, 40)):
+            points = random_walk(rnd, start, 10, 0.002)
+            members.append(("way", model.add_way(points, {"highway": "path"}), ""))
+            start = points[-1]
+        if rnd.random() < 0.3:
+            # A multipolygon of a few closed ways
+            outer = random_walk(rnd, random_point(rnd, coords), 12, 0.005)
+            members = [("way", model.add_way(outer, {"area": "yes"}), "outer")]
+            tags = {"type": "multipolygon", "landuse": "forest"}
+        else:
+            tags = {"type": "route", "route": "hiking", "osmc:symbol": "red:white:red_stripe"}
+        model.relations[model.new_id("relation")] = (members, tags)
+    # The country-long route, from north to south through the towns
+    members = []
+    for center in sorted(centers, key=lambda center: -center[1]):
+        start = center
+        for i in xrange(max(1, NATIONAL_TRAIL_WAYS//len(centers))):
+            points = random_walk(rnd, start, 10, 0.002)
+            members.append(("way", model.add_way(points, {"highway": "path"}), ""))
+            start = points[-1]
+    model.relations[NATIONAL_TRAIL_ID] = (members,
+            {"type": "route", "route": "hiking", "name": "National Trail"})
+    return (model, towns, roads)
+
+def generate_change(base, towns, roads, scenario, scale, seed=2):
+    """The updated map and the list of (action, type, id) edits of a scenario"""
+    rnd = random.Random(seed)
+    model = base.copy()
+    edits = []
+    if scenario == "relation":
+        (members, tags) = model.relations[NATIONAL_TRAIL_ID]
+        new_way = model.add_way(random_walk(rnd, model.nodes[model.ways[members[-1][1]][0][-1]], 10, 0.002),
+                {"highway": "path"})
+        tags = dict(tags)
+        tags["colour"] = "orange"
+        model.relations[NATIONAL_TRAIL_ID] = (members + [("way", new_way, "")], tags)
+        for node_id in model.ways[new_way][0]:
+            edits.append(("create", "node", node_id))
+        edits.append(("create", "way", new_way))
+        edits.append(("modify", "relation", NATIONAL_TRAIL_ID))
+        return (model, edits)
+    if scenario == "minutely":
+        # All edits of a single mapper in a single town
+        candidate_ways = rnd.choice(towns)
+    else:
+        candidate_ways = [way for town in towns for way in town] + roads
+    edited_nodes = set()
+    for edit in xrange(int(EDITS[scenario]*scale)):
+        way_id = rnd.choice(candidate_ways)
+        if way_id not in model.ways:
+            continue
+        (node_ids, tags) = model.ways[way_id]
+        kind = rnd.random()
+        if kind < 0.5:
+            # Move a node
+            node_id = rnd.choice(node_ids)
+            (lon, lat) = model.nodes[node_id]
+            model.nodes[node_id] = (lon + rnd.uniform(-0.0002, 0.0002), lat + rnd.uniform(-0.0002, 0.0002))
+            if node_id not in edited_nodes:
+                edited_nodes.add(node_id)
+                edits.append(("modify", "node", node_id))
+        elif kind < 0.65:
+            # Extend a way
+            node_id = model.new_id("node")
+            model.nodes[node_id] = random_walk(rnd, model.nodes[node_ids[-1]], 2, 0.001)[-1]
+            model.ways[way_id] = (node_ids + [node_id], tags)
+            edits.append(("create", "node", node_id))
+            edits.append(("modify", "way", way_id))
+        elif kind < 0.8:
+            # A new way near an existing way
+            new_way = model.add_way(random_walk(rnd, model.nodes[node_ids[0]], rnd.randint(2, 10), 0.001),
+                    {"highway": "footway"})
+            for node_id in model.ways[new_way][0]:
+                edits.append(("create", "node", node_id))
+            edits.append(("create", "way", new_way))
+            candidate_ways.append(new_way)
+        elif kind < 0.9:
+            # Delete a way and its nodes
+            del model.ways[way_id]
+            edits.append(("delete", "way", way_id))
+            for node_id in set(node_ids):
+                if node_id not in edited_nodes:
+                    edited_nodes.add(node_id)
+                    del model.nodes[node_id]
+                    edits.append(("delete", "node", node_id))
+        else:
+            # Retag a way
+            tags = dict(tags)
+            tags["surface"] = rnd.choice(("paved", "gravel", "dirt"))
+            model.ways[way_id] = (node_ids, tags)
+            edits.append(("modify", "way", way_id))
+    # Elements created or modified, and then deleted, are only deleted
+    edits = [(action, element_type, element_id) for (action, element_type, element_id) in edits
+            if action == "delete" or model.has(element_type, element_id)]
+    return (model, edits)
+
+def write_change(filename, model, edits):
+    """Write an Osm Change file, each edit in its own action block"""
+    with open(filename, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<osmChange version="0.6" generator="ChangeAnalysisBenchmark">\n')
+        for (action, element_type, element_id) in edits:
+            f.write('  <{}>\n'.format(action))
+            if action == "delete":
+                f.write('    <{} id="{}" version="2"/>\n'.format(element_type, element_id))
+            else:
+                model.write_element(f, element_type, element_id, "    ")
+            f.write('  </{}>\n'.format(action))
+        f.write('</osmChange>\n')
+
+def peak_memory():
+    # Peak resident set size in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+class StageTimer(object):
+    """Time of the stages of a benchmark, and the peak memory after each stage"""
+    def __init__(self):
+        self.stages = []
+
+    def add(self, stage, seconds):
+        self.stages.append((stage, seconds, peak_memory()))
+
+    def timed(self, function, totals, name):
+        """Wrap a function, accumulating its time in totals[name]"""
+        totals[name] = 0.0
+        def wrapper(*args):
+            timer = time.time()
+            try:
+                return function(*args)
+            finally:
+                totals[name] += time.time() - timer
+        return wrapper
+
+def super_tiles(extent, size=2):
+    (left, top, right, bottom) = extent
+    for x in xrange(left, right+1, size):
+        for y in xrange(top, bottom+1, size):
+            yield (x, y)
+
+def run_scenario(scenario_dir, use_index, workers):
+    """Analyze a scenario's change file, print a line per stage"""
+    stages = StageTimer()
+    totals = {}
+    work_dir = tempfile.mkdtemp(prefix="ChangeAnalysisBenchmark-")
+    devnull = open(os.devnull, 'w')
+    try:
+        cmd = IsraelHikingTileGenCommand()
+        cmd.polygon_cache_dir = work_dir
+        cmd.write_manifests = False
+        cmd.workers = workers
+        add_osm_source = Map.add_osm_source
+        Map.add_osm_source = staticmethod(stages.timed(add_osm_source, totals, "load"))
+        if workers == 1:
+            cmd.mark_bbox = stages.timed(cmd.mark_bbox, totals, "mark_bbox")
+        base_map = os.path.join(scenario_dir, "..", "base.osm")
+        if use_index:
+            timer = time.time()
+            base_map = OsmGeometryIndex(os.path.join(work_dir, "base.sqlite"))
+            base_map.build(os.path.join(scenario_dir, "..", "base.osm"))
+            stages.add("index", time.time() - timer)
+        timer = time.time()
+        cmd.tile_classifier()
+        stages.add("classifier", time.time() - timer)
+        timer = time.time()
+        stdout = sys.stdout
+        sys.stdout = devnull  # Progress messages of the analysis
+        try:
+            cmd.osmChangeRead(os.path.join(scenario_dir, "change.osc"),
+                    base_map, os.path.join(scenario_dir, "new.osm"))
+        finally:
+            sys.stdout = stdout
+        analysis = time.time() - timer
+        Map.add_osm_source = add_osm_source
+        stages.add("load", totals["load"])
+        stages.add("analysis", analysis - totals["load"])
+        if workers == 1:
+            stages.add("mark_bbox", totals["mark_bbox"])
+        # Replay the changed tiles at max zoom through new_tile_upwards
+        changed = cmd.changed
+        max_zoom = max(changed)
+        cmd.changed = {zoom: TileSet(zoom, cmd.tile_extent(zoom)) for zoom in changed}
+        timer = time.time()
+        for (x, y) in changed[max_zoom]:
+            cmd.new_tile_upwards(x, y, max_zoom)
+        stages.add("new_tile_upwards", time.time() - timer)
+        cmd.changed = changed
+        timer = time.time()
+        cmd.guard = None
+        cmd.update_guard()
+        stages.add("update_guard", time.time() - timer)
+        coords = cmd.polygon_coords()
+        timer = time.time()
+        for zoom in changed:
+            for (x, y) in super_tiles(polygon_tile_extent(coords, zoom)):
+                cmd.tiles_overlapps_polygon(zoom, x, y, 2, 2)
+        stages.add("tiles_overlapps_polygon", time.time() - timer)
+        timer = time.time()
+        for zoom in changed:
+            for (x, y) in super_tiles(polygon_tile_extent(coords, zoom)):
+                cmd.updated(zoom, x, y, 2, 2)
+        stages.add("updated", time.time() - timer)
+        (sum_changed, sum_guard) = cmd.statistics(verbose=False)
+        for (stage, seconds, peak) in stages.stages:
+            print stage, seconds, peak, sum_changed, sum_guard
+    finally:
+        devnull.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def generate(data_dir, scenarios, scale):
+    timer = time.time()
+    (base, towns, roads) = generate_base(scale)
+    base.write(os.path.join(data_dir, "base.osm"))
+    print "Base map: {} nodes, {} ways, {} relations ({:.0f} MB, {:.1f} s)".format(
+            len(base.nodes), len(base.ways), len(base.relations),
+            os.path.getsize(os.path.join(data_dir, "base.osm"))/(1024.0*1024), time.time() - timer)
+    for scenario in scenarios:
+        (model, edits) = generate_change(base, towns, roads, scenario, scale)
+        scenario_dir = os.path.join(data_dir, scenario)
+        os.mkdir(scenario_dir)
+        write_change(os.path.join(scenario_dir, "change.osc"), model, edits)
+        model.write(os.path.join(scenario_dir, "new.osm"))
+        print "Scenario {}: {} edits".format(scenario, len(edits))
+
+def main(args):
+    scale = 1.0
+    use_index = False
+    workers = 1
+    scenario_dir = None
+    scenarios = []
+    while args:
+        arg = args.pop(0)
+        if arg == "--run":
+            scenario_dir = args.pop(0)
+        elif arg == "--scale":
+            scale = float(args.pop(0))
+        elif arg == "--index":
+            use_index = True
+        elif arg == "--workers":
+            workers = int(args.pop(0))
+        elif arg in SCENARIOS:
+            scenarios.append(arg)
+        else:
+            print __doc__
+            return
+    if scenario_dir:
+        run_scenario(scenario_dir, use_index, workers)
+        return
+    scenarios = scenarios or list(SCENARIOS)
+    data_dir = tempfile.mkdtemp(prefix="ChangeAnalysisBenchmark-")
+    try:
+        generate(data_dir, scenarios, scale)
+        print "{:9} {:24} {:>9} {:>9} {:>9} {:>9}".format(
+                "scenario", "stage", "time [s]", "peak [MB]", "changed", "update")
+        for scenario in scenarios:
+            output = subprocess.check_output([sys.executable, os.path.join(benchmarks_dir, os.path.basename(__file__)),
+                "--run", os.path.join(data_dir, scenario), "--workers", str(workers)]
+                + (["--index"] if use_index else []))
+            for line in output.splitlines():
+                (stage, seconds, peak, changed, guard) = line.split()
+                print "{:9} {:24} {:9.2f} {:9.1f} {:9} {:9}".format(
+                        scenario, stage, float(seconds), int(peak)/(1024.0*1024), changed, guard)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
+
+# vim: set shiftwidth=4 expandtab textwidth=0:
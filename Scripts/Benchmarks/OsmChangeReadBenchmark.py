@@ -0,0 +1,157 @@
+"""Benchmark of Osm Change file parsing: DOM vs. streaming
+
+Compares the XmlDocument (DOM) loading previously used by
+OsmChangeTileGenCommand.osmChangeRead with the streaming parser of
+OsmChangeReader.osmChangeElements.
+
+Usage:
+    python OsmChangeReadBenchmark.py [<change file> | --generate <MB>]
+
+Without a change file, a synthetic Osm Change file of about 300 MB is generated
+in the temporary directory.
+Both plain and gzip compressed (*.gz) change files are supported.
+
+Under Maperitive (IronPython), the DOM is a System.Xml.XmlDocument and memory
+is sampled from the .NET garbage collector.
+Under CPython, the DOM is an xml.etree tree, and each method runs in its own
+process to report its peak resident memory.
+"""
+
+import os
+import sys
+import time
+import random
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Maperipy'))
+from OsmChangeReader import osmChangeElements, osmChangeOpen
+
+try:
+    import clr
+    clr.AddReference('System.Xml')
+    from System import GC
+    from System.Xml import XmlDocument
+    from OsmChangeReader import osmChangeReader
+except ImportError:
+    clr = None
+    import resource
+    from xml.etree import cElementTree
+
+def generate_change_file(filename, size_mb, seed=1):
+    """Write a synthetic Osm Change file of about size_mb megabytes"""
+    rnd = random.Random(seed)
+    target = size_mb*1024*1024
+    with open(filename, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<osmChange version="0.6" generator="OsmChangeReadBenchmark">\n')
+        element_id = 1
+        while f.tell() < target:
+            action = rnd.choice(("create", "modify", "modify", "delete"))
+            f.write('  <{}>\n'.format(action))
+            for i in xrange(rnd.randint(1, 50)):
+                element_id += rnd.randint(1, 1000)
+                element_type = rnd.choice(("node", "node", "node", "way", "relation"))
+                f.write('    <{} id="{}" version="2" timestamp="2017-01-01T00:00:00Z" '
+                        'uid="1" user="bench" changeset="1"'.format(element_type, element_id))
+                if element_type == "node":
+                    f.write(' lat="{:.7f}" lon="{:.7f}"'.format(
+                        rnd.uniform(29.5, 33.3), rnd.uniform(34.3, 35.9)))
+                if action == "delete":
+                    f.write('/>\n')
+                    continue
+                f.write('>\n')
+                if element_type == "way":
+                    for j in xrange(rnd.randint(2, 40)):
+                        f.write('      <nd ref="{}"/>\n'.format(rnd.randint(1, element_id)))
+                elif element_type == "relation":
+                    for j in xrange(rnd.randint(1, 20)):
+                        f.write('      <member type="way" ref="{}" role=""/>\n'.format(
+                            rnd.randint(1, element_id)))
+                f.write('      <tag k="highway" v="path"/>\n')
+                f.write('    </{}>\n'.format(element_type))
+            f.write('  </{}>\n'.format(action))
+        f.write('</osmChange>\n')
+
+def memory_usage():
+    if clr:
+        return GC.GetTotalMemory(False)
+    # Peak resident set size in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+def dom_count(filename):
+    """The previous DOM-based path: load the whole document, then select the elements"""
+    count = 0
+    if clr:
+        osmChange = XmlDocument()
+        osmChange.Load(osmChangeReader(filename))
+        for element in osmChange.SelectNodes("./osmChange/*/*"):
+            (element.ParentNode.Name, element.Name,
+                    long(element.Attributes.GetNamedItem("id").Value))
+            count += 1
+        peak = memory_usage()
+    else:
+        f = osmChangeOpen(filename)
+        osmChange = cElementTree.parse(f).getroot()
+        f.close()
+        for action in osmChange:
+            for element in action:
+                (action.tag, element.tag, long(element.get("id")))
+                count += 1
+        peak = memory_usage()
+    return (count, peak)
+
+def stream_count(filename):
+    """The streaming path"""
+    count = 0
+    peak = memory_usage()
+    for record in osmChangeElements(filename):
+        count += 1
+        if clr and count % 100000 == 0:
+            peak = max(peak, memory_usage())
+    peak = max(peak, memory_usage())
+    return (count, peak)
+
+methods = {"dom": dom_count, "stream": stream_count}
+
+def measure(method, filename):
+    baseline = memory_usage()
+    timer = time.time()
+    (count, peak) = methods[method](filename)
+    timer = time.time() - timer
+    return (count, timer, peak - baseline if clr else peak)
+
+def report(method, count, timer, peak):
+    print "{:8} {:10} elements {:8.1f} seconds {:8.1f} MB".format(
+            method, count, timer, peak/(1024.0*1024))
+
+def main(args):
+    if len(args) == 3 and args[0] == "--method":
+        # Child process of a CPython run
+        (count, timer, peak) = measure(args[1], args[2])
+        print count, timer, peak
+        return
+    if not args or args[0] == "--generate":
+        size_mb = int(args[1]) if len(args) > 1 else 300
+        filename = os.path.join(tempfile.gettempdir(), "benchmark-{}MB.osc".format(size_mb))
+        if not os.path.exists(filename):
+            print "Generating", filename, "..."
+            generate_change_file(filename, size_mb)
+    else:
+        filename = args[0]
+    print "Change file: {} ({:.1f} MB)".format(filename, os.path.getsize(filename)/(1024.0*1024))
+    for method in ("dom", "stream"):
+        if clr:
+            GC.Collect()
+            (count, timer, peak) = measure(method, filename)
+        else:
+            output = subprocess.check_output(
+                    [sys.executable, os.path.abspath(__file__), "--method", method, filename])
+            (count, timer, peak) = output.split()
+            (count, timer, peak) = (int(count), float(timer), int(peak))
+        report(method, count, timer, peak)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
+
+# vim: set shiftwidth=4 expandtab textwidth=0:
@@ -0,0 +1,249 @@
+"""Stand-ins for the parts of Maperitive's maperipy module used by the change analysis
+
+Allows benchmarking OsmChangeTileGenCommand headless, under CPython, without Maperitive.
+Only the members used by the change analysis and the polygon tests are provided.
+OSM sources are loaded into memory from OSM XML files by Map.add_osm_source.
+"""
+
+import gc
+from OsmChangeReader import osmChangeDetails
+from maperipy.osm import OsmReferenceType
+
+class Srid(object):
+    Wgs84LonLat = "Wgs84LonLat"
+
+class Point(object):
+    __slots__ = ("x", "y")
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+    @property
+    def bounding_box(self):
+        return BoundingBox(Srid.Wgs84LonLat, self.x, self.y, self.x, self.y)
+
+    def __repr__(self):
+        return "Point({}, {})".format(self.x, self.y)
+
+def _point(point):
+    if isinstance(point, Point):
+        return point
+    return Point(*point)
+
+class BoundingBox(object):
+    def __init__(self, srid=Srid.Wgs84LonLat, min_x=None, min_y=None, max_x=None, max_y=None):
+        self.srid = srid
+        (self.min_x, self.min_y, self.max_x, self.max_y) = (min_x, min_y, max_x, max_y)
+
+    def extend_with(self, other):
+        if self.min_x is None:
+            (self.min_x, self.min_y, self.max_x, self.max_y) = (
+                    other.min_x, other.min_y, other.max_x, other.max_y)
+        else:
+            self.min_x = min(self.min_x, other.min_x)
+            self.min_y = min(self.min_y, other.min_y)
+            self.max_x = max(self.max_x, other.max_x)
+            self.max_y = max(self.max_y, other.max_y)
+
+    @property
+    def polygon(self):
+        return Polygon(LinearRing([
+            Point(self.min_x, self.max_y),
+            Point(self.max_x, self.max_y),
+            Point(self.max_x, self.min_y),
+            Point(self.min_x, self.min_y),
+            Point(self.min_x, self.max_y)]))
+
+def _bounding_box(points):
+    return BoundingBox(Srid.Wgs84LonLat,
+            min(point.x for point in points), min(point.y for point in points),
+            max(point.x for point in points), max(point.y for point in points))
+
+class LinearRing(object):
+    def __init__(self, points):
+        self.coords = [_point(point) for point in points]
+
+    @property
+    def bounding_box(self):
+        return _bounding_box(self.coords)
+
+class LineString(LinearRing):
+    pass
+
+class Polygon(object):
+    def __init__(self, exterior):
+        if not isinstance(exterior, LinearRing):
+            exterior = LinearRing(exterior)
+        self.exterior = exterior
+
+    @property
+    def bounding_box(self):
+        return self.exterior.bounding_box
+
+class GeometryUtils(object):
+    @staticmethod
+    def is_inside_linear_ring(point, ring, include_boundary=True):
+        """Ray casting test of a point against a ring"""
+        inside = False
+        coords = ring.coords
+        previous = coords[-1]
+        for current in coords:
+            if (previous.y > point.y) != (current.y > point.y):
+                if point.x < previous.x + (point.y - previous.y)*(current.x - previous.x)/(current.y - previous.y):
+                    inside = not inside
+            previous = current
+        return inside
+
+class Color(object):
+    def __init__(self, name):
+        self.name = name
+
+class Style(object):
+    pass
+
+class Symbol(object):
+    def __init__(self, name, srid, geometries=()):
+        self.name = name
+        self.srid = srid
+        self.style = Style()
+        self.geometries = list(geometries)
+
+    def add(self, geometry):
+        self.geometries.append(geometry)
+        return self
+
+    @property
+    def bounding_box(self):
+        bbox = BoundingBox(self.srid)
+        for geometry in self.geometries:
+            bbox.extend_with(geometry.bounding_box)
+        return bbox
+
+class LineSymbol(Symbol):
+    pass
+
+class PolygonSymbol(Symbol):
+    pass
+
+class CustomLayer(object):
+    def __init__(self):
+        self.visible = True
+        self.symbols = []
+
+    def add_symbol(self, symbol):
+        self.symbols.append(symbol)
+
+class OsmNode(object):
+    __slots__ = ("location",)
+
+    def __init__(self, location):
+        self.location = location
+
+class OsmMember(object):
+    __slots__ = ("ref_type", "ref_id", "role")
+
+    def __init__(self, ref_type, ref_id, role):
+        self.ref_type = ref_type
+        self.ref_id = ref_id
+        self.role = role
+
+class OsmRelation(object):
+    reference_types = {
+            "node": OsmReferenceType.NODE,
+            "way": OsmReferenceType.WAY,
+            "relation": OsmReferenceType.RELATION}
+
+    def __init__(self, tags, members):
+        self.tags = tags
+        self.members = [OsmMember(self.reference_types[member_type], ref, role)
+                for (member_type, ref, role) in members]
+
+    def has_tag(self, key):
+        return key in self.tags
+
+    def get_tag(self, key):
+        return self.tags[key]
+
+class OsmData(object):
+    """In-memory OSM data of an OSM XML file. Missing elements raise a KeyError."""
+    def __init__(self, filename):
+        self.nodes = {}
+        self.ways = {}
+        self.relations = {}
+        for element in osmChangeDetails(filename):
+            if element.type == "node":
+                self.nodes[element.id] = (element.lon, element.lat)
+            elif element.type == "way":
+                self.ways[element.id] = element.nodes
+            elif element.type == "relation":
+                self.relations[element.id] = (element.tags, element.members)
+
+    def has_node(self, node_id):
+        return node_id in self.nodes
+
+    def has_way(self, way_id):
+        return way_id in self.ways
+
+    def has_relation(self, relation_id):
+        return relation_id in self.relations
+
+    def node(self, node_id):
+        return OsmNode(Point(*self.nodes[node_id]))
+
+    def get_way_geometry(self, way_id):
+        return LineString([self.nodes[node_id] for node_id in self.ways[way_id] if node_id in self.nodes])
+
+    def relation(self, relation_id):
+        (tags, members) = self.relations[relation_id]
+        return OsmRelation(tags, members)
+
+class OsmLayer(object):
+    def __init__(self, filename):
+        self.visible = True
+        self.osm = OsmData(filename)
+
+class App(object):
+    commands = []
+
+    @staticmethod
+    def log(message):
+        print message
+
+    @staticmethod
+    def collect_garbage():
+        gc.collect()
+
+    @staticmethod
+    def run_command(command):
+        """Commands are recorded. Only remove-source is performed."""
+        App.commands.append(command)
+        if command.startswith("clear-map"):
+            del Map.layers[:]
+        elif command.startswith("remove-source"):
+            index = int(command.split('"')[1])
+            del Map.layers[index-1]
+
+    @staticmethod
+    def start_program(program, args):
+        App.commands.append(" ".join([program] + list(args)))
+
+class Map(object):
+    layers = []
+    geo_bounds = None
+
+    @staticmethod
+    def add_osm_source(filename):
+        Map.layers.append(OsmLayer(filename))
+
+    @staticmethod
+    def add_custom_layer():
+        layer = CustomLayer()
+        Map.layers.append(layer)
+        return layer
+
+    @staticmethod
+    def zoom_area(bounds):
+        pass
+
+# vim: set shiftwidth=4 expandtab textwidth=0:
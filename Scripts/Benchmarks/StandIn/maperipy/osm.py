@@ -0,0 +1,8 @@
+"""Stand-in for maperipy.osm, see maperipy"""
+
+class OsmReferenceType(object):
+    NODE = "node"
+    WAY = "way"
+    RELATION = "relation"
+
+# vim: set shiftwidth=4 expandtab textwidth=0:
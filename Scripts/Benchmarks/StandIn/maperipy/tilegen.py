@@ -0,0 +1,17 @@
+"""Stand-in for maperipy.tilegen, see maperipy
+
+TileGenCommand keeps its constructor's parameters and does not render.
+"""
+
+class TileGenCommand(object):
+    def __new__(cls, bounds=None, min_zoom=None, max_zoom=None, *args):
+        cmd = object.__new__(cls)
+        cmd.bounds = bounds
+        cmd.min_zoom = min_zoom
+        cmd.max_zoom = max_zoom
+        return cmd
+
+    def execute(self):
+        pass
+
+# vim: set shiftwidth=4 expandtab textwidth=0:
@@ -0,0 +1,114 @@
+"""Benchmark of changed and guard tile storage: dictionaries vs. TileSets
+
+Simulates a change covering the whole generation polygon's bounding box,
+such as a coastline or a boundary edit, at zoom levels 7 to 16.
+The changed tiles are marked at zoom 16 and propagated to lower zoom levels,
+then a guard band of one tile is added around each changed tile.
+The polygon test of the guard tiles is not included.
+
+Usage:
+    python TileSetBenchmark.py
+
+Each storage method runs in its own process to report its peak resident memory.
+"""
+
+import os
+import sys
+import math
+import time
+import subprocess
+import resource
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Maperipy'))
+from TileSet import TileSet
+
+MIN_ZOOM = 7
+MAX_ZOOM = 16
+# Bounding box of IsraelHikingTileGenCommand's polygon
+(MIN_LON, MIN_LAT, MAX_LON, MAX_LAT) = (34.15870, 29.37711, 35.91531, 33.35091)
+
+def deg2num(lat_deg, lon_deg, zoom):
+    lat_rad = math.radians(lat_deg)
+    n = 2.0 ** zoom
+    tile_x = int((lon_deg + 180.0) / 360.0 * n)
+    tile_y = int((1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2.0 * n)
+    return (tile_x, tile_y)
+
+def tile_extent(zoom):
+    (left, top) = deg2num(MAX_LAT, MIN_LON, zoom)
+    (right, bottom) = deg2num(MIN_LAT, MAX_LON, zoom)
+    return (left-1, top-1, right+1, bottom+1)
+
+def dict_run():
+    """The previous storage: dictionaries of (tile_x, tile_y) tuples"""
+    changed = {zoom: {} for zoom in range(MIN_ZOOM, MAX_ZOOM+1)}
+    def new_tile_upwards(x, y, zoom):
+        if zoom in changed and (x, y) not in changed[zoom]:
+            changed[zoom][(x, y)] = True
+            new_tile_upwards(x//2, y//2, zoom-1)
+    (left, top, right, bottom) = tile_extent(MAX_ZOOM)
+    for x in range(left+1, right):
+        for y in range(top+1, bottom):
+            new_tile_upwards(x, y, MAX_ZOOM)
+    timers.append(time.time())
+    guard = {}
+    for zoom in sorted(changed):
+        guard[zoom] = {}
+        tile_checked = {}
+        for (x, y) in changed[zoom]:
+            for x_guard in range(x-1, x+2):
+                for y_guard in range(y-1, y+2):
+                    if (x_guard, y_guard) not in tile_checked:
+                        tile_checked[(x_guard, y_guard)] = True
+                        if zoom == MIN_ZOOM or (x_guard//2, y_guard//2) in guard[zoom-1]:
+                            guard[zoom][(x_guard, y_guard)] = True
+    return (changed, guard)
+
+def tileset_run():
+    """The TileSet storage"""
+    changed = {zoom: TileSet(zoom, tile_extent(zoom)) for zoom in range(MIN_ZOOM, MAX_ZOOM+1)}
+    (left, top, right, bottom) = tile_extent(MAX_ZOOM)
+    (left, top, right, bottom) = (left+1, top+1, right-1, bottom-1)
+    zoom = MAX_ZOOM
+    while zoom in changed and changed[zoom].add_rect(left, top, right, bottom):
+        (left, top, right, bottom) = (left//2, top//2, right//2, bottom//2)
+        zoom -= 1
+    timers.append(time.time())
+    guard = {}
+    for zoom in sorted(changed):
+        guard[zoom] = changed[zoom].dilated()
+        if zoom != MIN_ZOOM:
+            guard[zoom].intersection_update(guard[zoom-1].children(guard[zoom].extent))
+    return (changed, guard)
+
+methods = {"dict": dict_run, "tileset": tileset_run}
+timers = []
+
+def peak_memory():
+    # Peak resident set size in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+def main(args):
+    if len(args) == 2 and args[0] == "--method":
+        baseline = peak_memory()
+        timers.append(time.time())
+        (changed, guard) = methods[args[1]]()
+        timers.append(time.time())
+        print sum(len(tiles) for tiles in changed.values()), \
+                sum(len(tiles) for tiles in guard.values()), \
+                timers[1] - timers[0], timers[2] - timers[1], peak_memory() - baseline
+        return
+    print "{:8} {:>9} {:>9} {:>8} {:>9} {:>9}".format(
+            "method", "changed", "guard", "mark [s]", "guard [s]", "peak [MB]")
+    for method in ("dict", "tileset"):
+        output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__), "--method", method])
+        (changed, guard, mark_timer, guard_timer, peak) = output.split()
+        print "{:8} {:9} {:9} {:8.2f} {:9.2f} {:9.1f}".format(
+                method, int(changed), int(guard),
+                float(mark_timer), float(guard_timer), int(peak)/(1024.0*1024))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
+
+# vim: set shiftwidth=4 expandtab textwidth=0:
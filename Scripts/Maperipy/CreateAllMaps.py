@@ -18,8 +18,17 @@ import errno
 from maperipy import *
 from maperipy.osm import *
 from GenIsraelHikingTiles import IsraelHikingTileGenCommand
+from OsmChangeTileGenCommand import analysis_key
 from OsmChangeSource import *
+from OsmGeometryIndex import OsmGeometryIndex
+from RulesetTags import RulesetTags
+from RulesetZooms import RulesetZooms
+from OsmFilter import OsmFilter
 from PolygonTileGenCommand import pretty_timer
+from TileStoreCleaner import TileStoreCleaner
+from RenderMetrics import RenderMetrics
+from TileOptimizer import TileOptimizer
+from SentinelIndex import TRANSPARENT
 
 start_time = datetime.now()
 App.run_command('clear-map')
@@ -67,17 +76,19 @@ def safe_rename(filename, new_filename):
             raise
 
 def add_to_PATH(app_name):
+    """Make sure an application is in the PATH, returns False if not found"""
     for path_dir in string.split(os.environ["PATH"], os.pathsep):
         for ext in string.split(os.pathsep+os.environ["PATHEXT"], os.pathsep):
             if os.path.exists(os.path.join(path_dir, app_name+ext)):
                 # Application already found in PATH
-                return
+                return True
     full_app_name=os.path.join(ProgramFiles, app_name)
     if not os.path.isdir(full_app_name):
         # Application not a sibling of Maperitive
         App.log("Warning: "+app_name+" location not found. Could not add it to PATH.")
-        return
+        return False
     os.environ["PATH"] = string.join([os.environ["PATH"],full_app_name], os.pathsep)
+    return True
 
 def cache_file(filename):
     if filename:
@@ -94,10 +105,31 @@ site_dir = os.path.join(ProjectDir, language)
 mkdir_p(os.path.join(site_dir, "Oruxmaps"))
 mkdir_p(cache_file(''))
 
+def ruleset_tags(*rulesets):
+    tags = RulesetTags(*[os.path.join("Rules", ruleset) for ruleset in rulesets])
+    tags.read_script(os.path.join("Scripts", "Maperipy", "AddOsmTags.py"))
+    return tags
+
+def ruleset_zooms(*rulesets):
+    zooms = RulesetZooms(*[os.path.join("Rules", ruleset) for ruleset in rulesets])
+    zooms.read_script(os.path.join("Scripts", "Maperipy", "AddOsmTags.py"))
+    return zooms
+
 #
 # Map sources
 #
 base_map =  IsraelHikingTileGenCommand()
+# Skip modifications of tags that the Hiking and MTB maps do not render
+base_map.ruleset_tags = ruleset_tags("IsraelHiking.mrules", "mtbmap.mrules")
+# Skip zoom levels where the Hiking and MTB maps do not draw a changed element
+base_map.ruleset_zooms = ruleset_zooms("IsraelHiking.mrules", "mtbmap.mrules")
+# Separate changed tiles for each map, from a single analysis
+base_map.add_target("hiking", ruleset_tags("IsraelHiking.mrules"))
+base_map.add_target("mtb", ruleset_tags("mtbmap.mrules"))
+if language == "Hebrew":
+    # The trails overlays are rendered with both rulesets
+    base_map.add_target("trails", base_map.ruleset_tags,
+            OsmFilter(os.path.join('Filters', 'trails_filter.txt')))
 if language == "Hebrew":
     # Minute updates from openstreetmap.fr
     osm_source = openstreetmap_fr(
@@ -118,7 +150,12 @@ else:
             os.path.join(ProjectDir, 'Cache', 'geofabrik'),
             "asia/israel-and-palestine")
 
+# Geometry of the base map for change analysis, updated when the source advances
+osm_source.geometry_index = OsmGeometryIndex(cache_file('israel-and-palestine-latest.sqlite'))
+
 trails_overlay =  IsraelHikingTileGenCommand()
+# No transparent overlay tile files, the tiles of the base maps are never transparent
+trails_overlay.sentinel_colors = (TRANSPARENT,)
 osm_trails = osmChangeOverlyFilterSource(
         cache_file('israel-and-palestine-trails-latest.osm.pbf'),
         cache_file('israel-and-palestine-trails-update.osc'),
@@ -127,6 +164,14 @@ osm_trails = osmChangeOverlyFilterSource(
         os.path.join('Filters', 'trails_filter.txt'),
         osm_source)
 
+# Throughput of the change analysis and of each tile generation, appended by all runs
+base_map.metrics = RenderMetrics(cache_file('render-metrics.jsonl'))
+trails_overlay.metrics = base_map.metrics
+if add_to_PATH("optipng"):
+    # Lossless optimization of the saved tiles
+    base_map.optimizer = TileOptimizer(cache_file('optimized-tiles.digests'), cache_file('optimized-tiles'))
+    trails_overlay.optimizer = base_map.optimizer
+
 #
 # Map creation phases
 #
@@ -143,6 +188,9 @@ if language == "Hebrew":
 def done_file(phase):
     return cache_file(phase+'.done')
 
+# The results of the change analysis, to resume incomplete phases without analyzing again
+analysis_file = cache_file('change-analysis.checkpoint')
+
 def mark_done(phase):
     open(done_file(phase), 'a').close()
     App.log(phase+' phase is done.')
@@ -160,6 +208,8 @@ if remainingPhases == []:
         osm_trails.advance()
     for phase in phases:
         os.remove(done_file(phase))
+    if os.path.exists(analysis_file):
+        os.remove(analysis_file)
     remainingPhases = phases
 
 #
@@ -195,14 +245,25 @@ if os.path.exists(osm_source.changes):
             base_time.isoformat(),
             updated_time.isoformat()),
             (updated_time-base_time).total_seconds())
-        App.log("=== Analyzing map changes {} ===".format(change_span))
-        App.collect_garbage()
-        base_map.osmChangeRead(osm_source.changes, osm_source.base, osm_source.updated)
-        (changed, guard) = base_map.statistics()
-        if changed:
-            with open(cache_file("Change Analysis.log"), 'a') as journal:
-                journal.write("Changes {}\n".format(change_span))
+        key = analysis_key(osm_source.changes, base_time.isoformat(), updated_time.isoformat())
+        if base_map.load_analysis(analysis_file, key):
+            App.log("=== Resuming with the analysis of map changes {} ===".format(change_span))
+            Map.add_osm_source(osm_source.updated)
+            (changed, guard) = base_map.statistics()
         else:
+            App.log("=== Analyzing map changes {} ===".format(change_span))
+            App.collect_garbage()
+            if osm_source.geometry_index.represents(osm_source.base):
+                base_osm = osm_source.geometry_index
+            else:
+                base_osm = osm_source.base
+            base_map.osmChangeRead(osm_source.changes, base_osm, osm_source.updated)
+            (changed, guard) = base_map.statistics()
+            base_map.save_analysis(analysis_file, key)
+            if changed:
+                with open(cache_file("Change Analysis.log"), 'a') as journal:
+                    journal.write("Changes {}\n".format(change_span))
+        if not changed:
             remainingPhases = []
         App.collect_garbage()
         print pretty_timer("Current duration:", (datetime.now()-start_time).total_seconds())
@@ -242,6 +303,7 @@ if remainingPhases:
         App.run_command("apply-ruleset")
         App.collect_garbage()
         App.log('=== Creating Israel Hiking tiles up to zoom 15 ===')  
+        base_map.use_target("hiking")
         base_map.GenToDirectory(7, 15, os.path.join(site_dir, 'Tiles'))
         mark_done(phase)
     else:
@@ -254,6 +316,7 @@ if remainingPhases:
         App.run_command("apply-ruleset")
         App.collect_garbage()
         App.log('=== Creating Israel MTB tiles up to zoom 15 ===')  
+        base_map.use_target("mtb")
         base_map.GenToDirectory(7, 15, os.path.join(site_dir, 'mtbTiles'))
         mark_done(phase)
     else:
@@ -266,6 +329,7 @@ if remainingPhases:
         App.run_command("apply-ruleset")
         App.collect_garbage()
         App.log("=== Creating Israel Hiking zoom 16 tiles ===")
+        base_map.use_target("hiking")
         base_map.GenToDirectory(16, 16, os.path.join(site_dir, 'Tiles'))
         mark_done(phase)
     else:
@@ -278,6 +342,7 @@ if remainingPhases:
         App.run_command("apply-ruleset")
         App.collect_garbage()
         App.log('=== Creating Israel MTB zoom 16 tiles ===')  
+        base_map.use_target("mtb")
         base_map.GenToDirectory(16, 16, os.path.join(site_dir, 'mtbTiles'))
         mark_done(phase)
     else:
@@ -296,6 +361,11 @@ if remainingPhases:
         if osm_trails.status() == "non-incremental":
             Map.add_osm_source(osm_trails.updated)
             changed = True
+        elif base_map.target_changed is not None and "trails" in base_map.target_changed:
+            # The trails changes were marked by the analysis of the full map
+            Map.add_osm_source(osm_trails.updated)
+            trails_overlay.use_changes(base_map.target_changed["trails"], base_map.zoom_limited)
+            (changed, guard) = trails_overlay.statistics()
         else:
             trails_overlay.osmChangeRead(osm_trails.changes, osm_trails.base, osm_trails.updated)
             (changed, guard) = trails_overlay.statistics()
@@ -331,6 +401,25 @@ if remainingPhases:
             "Execution time:",
             (datetime.now()-start_time).total_seconds())))
 
+#
+# Remove the stored tiles outside the generation polygon, or excluded by its zoom regions,
+# once for each polygon and zoom regions
+#
+classifier = base_map.tile_classifier()
+cleaned_file = cache_file('tile-store.cleaned')
+cleaned_key = "-".join([classifier.key()]
+        + ["{}-{}-{}".format(region.key(), min_zoom, max_zoom)
+            for (region, min_zoom, max_zoom) in base_map.zoom_region_classifiers()])
+if not os.path.exists(cleaned_file) or open(cleaned_file).read().strip() != cleaned_key:
+    App.log("=== Removing tiles outside the generation polygon ===")
+    cleaner = TileStoreCleaner(classifier)
+    cleaner.zoom_regions = base_map.zoom_region_classifiers()
+    cleaner.clean([os.path.join(site_dir, tiles)
+        for tiles in ('Tiles', 'mtbTiles', 'OverlayTiles', 'OverlayMTB')])
+    with open(cleaned_file, 'w') as f:
+        f.write(cleaned_key+"\n")
+    print pretty_timer("Current duration:", (datetime.now()-start_time).total_seconds())
+
 #
 # Cleanup and prepare for next execution
 #
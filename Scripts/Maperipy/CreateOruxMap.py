@@ -1,6 +1,7 @@
 import os, os.path, datetime, string, errno
 from maperipy import *
 import GenIsraelHikingTiles
+import SentinelIndex
 
 # http://stackoverflow.com/questions/749711/how-to-get-the-python-exe-location-programmatically
 MaperitiveDir = os.path.dirname(os.path.dirname(os.path.normpath(os.__file__)))
@@ -125,7 +126,10 @@ if not os.path.exists(zip_file) :
     App.run_command("run-script file=" + os.path.join("Scripts", "Maperitive", "IsraelHikingOverlay.mscript"))
     App.collect_garbage()
     #Original# generate-tiles minzoom=7 maxzoom=16 subpixel=3 min-tile-file-size=385 tilesdir=Site\OverlayTiles use-fprint=true
+    # No transparent overlay tile files
+    gen_cmd.sentinel_colors = (SentinelIndex.TRANSPARENT,)
     gen_cmd.GenToDirectory(7, 16, os.path.join(IsraelHikingDir, 'Site', 'OverlayTiles'))
+    gen_cmd.sentinel_colors = ()
     App.collect_garbage()
     # zip base-dir=Site zip-file=output\OverlayTiles.zip
     zip_and_upload(zip_file)
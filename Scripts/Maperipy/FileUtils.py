@@ -0,0 +1,28 @@
+"""File utilities shared by the tile generation scripts"""
+
+import os
+import sys
+
+MOVEFILE_REPLACE_EXISTING = 0x1
+MOVEFILE_WRITE_THROUGH = 0x8
+
+def replace_file(temp_filename, filename):
+    """Replace a file by a temporary file written next to it, atomically
+
+    After a crash, the file has either its old or its new content.
+    On Windows, where renaming over an existing file fails, an existing file is
+    replaced by System.IO.File.Replace under IronPython, or by MoveFileEx otherwise.
+    """
+    if (os.name != "nt" and sys.platform != "cli") or not os.path.exists(filename):
+        os.rename(temp_filename, filename)
+    elif sys.platform == "cli":
+        import clr
+        from System.IO import File
+        File.Replace(temp_filename, filename, None)
+    else:
+        import ctypes
+        if not ctypes.windll.kernel32.MoveFileExW(unicode(temp_filename), unicode(filename),
+                MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH):
+            raise ctypes.WinError()
+
+# vim: set shiftwidth=4 expandtab textwidth=0:
@@ -4,16 +4,23 @@
 - Tile generation restriction within a polygon using
   http://download.geofabrik.de/asia/israel-and-palestine.poly
   with a reduced sea area.
+- Zoom levels 14 to 16 are skipped in the Mediterranean sea, offshore of the coast
 - Allow generation reduction based on an OSM change file
+- A Copyright text chunk in each saved tile, see PngText
+- Optional lossless optimization of saved tiles, see TileOptimizer
+- Optionally, transparent overlay tiles are not kept as tile files, see SentinelIndex
 
 Author: Zeev Stadler
 License: public domain
 """
 
+import os
 import time
 from maperipy import *
 from OsmChangeTileGenCommand import OsmChangeTileGenCommand
 from PolygonTileGenCommand import pretty_timer
+from TileStoreCleaner import read_poly
+from PngText import set_png_text
 
 class IsraelHikingTileGenCommand(OsmChangeTileGenCommand):
     def __new__(cls, *args):
@@ -65,11 +72,12 @@ class IsraelHikingTileGenCommand(OsmChangeTileGenCommand):
     def __init__(self):
         OsmChangeTileGenCommand.__init__(self)
         self.after_tile_save = self.collect_tiles
-        self.tiles_to_post_process = []
-        self.len_tiles_to_post_process = 0
+        self.copyright = "Israel Hiking, CC-BY-NC-SA 3.0"  # Copyright text of saved tiles
+        self.optimizer = None  # Optional TileOptimizer of saved tiles
         self.subpixel_precision = 2
         self.use_fingerprint = True
-        self.min_tile_file_size = 385  # No transparent tiles
+        # The Mediterranean sea within the polygon, 3 km or more offshore
+        self.add_zoom_region(read_poly(os.path.join('Filters', 'mediterranean_sea.poly')), 7, 13)
 
     def rel_members_bbox(self, relation):
         return not (
@@ -81,30 +89,34 @@ class IsraelHikingTileGenCommand(OsmChangeTileGenCommand):
     def execute(self):
         timer = time.time()
         OsmChangeTileGenCommand.execute(self)
-        self.post_process_tiles()
+        if self.optimizer is not None:
+            self.optimizer.finish()
         timer = time.time() - timer
         print pretty_timer("   Tile generation time:", timer)
+        totals = self.metrics.totals
+        print "   Rendered {} of {} super-tiles, saved {} tiles ({} bytes), {:.1f} tiles per second".format(
+                totals["rendered"], totals["super_tiles"], totals["tiles_saved"], totals["bytes"],
+                totals["tiles_saved"]/max(timer, 0.001))
 
     def osmChangeRead(self, *args):
         timer = time.time()
         OsmChangeTileGenCommand.osmChangeRead(self, *args)
         timer = time.time() - timer
         print pretty_timer("   Osm Change analysis time:", timer)
+        elements = sum(self.analyzed.values())
+        self.metrics.analysis(seconds=round(timer, 3),
+                elements_per_second=round(elements/max(timer, 0.001), 2),
+                nodes=self.analyzed["node"], ways=self.analyzed["way"], relations=self.analyzed["relation"],
+                skipped=sum(self.skipped.values()),
+                changed_tiles={str(zoom): len(self.changed[zoom]) for zoom in self.changed})
 
     def collect_tiles(self, file_name):
-        self.tiles_to_post_process.append(file_name)
-        self.len_tiles_to_post_process += len(file_name) + 3
-        if self.len_tiles_to_post_process >= 7500:
-            self.post_process_tiles()
-
-    def post_process_tiles(self):
-        if self.tiles_to_post_process == []:
+        if self.sentinel_tile(file_name):
             return
+        self.tile_saved(file_name)
         # Add Copyright property
-        args = ['/C' , 'START', '', '/MIN', 'mogrify', '-set', 'Copyright','"Israel Hiking, CC-BY-NC-SA 3.0"']
-        args.extend(self.tiles_to_post_process)
-        App.start_program('cmd.exe', args)
-        del self.tiles_to_post_process[:]
-        self.len_tiles_to_post_process = 0
+        set_png_text(file_name, "Copyright", self.copyright)
+        if self.optimizer is not None:
+            self.optimizer.optimize(file_name)
 
 # vim: set shiftwidth=4 expandtab textwidth=0:
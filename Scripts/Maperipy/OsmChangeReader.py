@@ -0,0 +1,258 @@
+"""Streaming access to compressed or uncompressed Osm Change files
+
+The Osm Change file is read as a stream of elements, each reported once
+as an (action, type, id) record, where
+- action is "create", "modify", or "delete"
+- type is "node", "way", or "relation"
+- id is the element's id, as a long
+
+Memory usage is constant, regardless of the size of the Osm Change file.
+
+Elements can also be read with their details, as OsmElement objects,
+from either Osm Change files or OSM XML files.
+
+A sequence of Osm Change files can be read as a single change, with one net
+action per element, see osmChangesElements() and osmChangesDetails().
+Memory usage is then proportional to the number of distinct changed elements.
+
+Within Maperitive the file is parsed by a System.Xml.XmlReader.
+Elsewhere, such as for benchmarking on Linux, xml.etree's iterparse is used.
+"""
+
+import gzip  # https://bitbucket.org/jdhardy/ironpythonzlib/src/tip/tests/gzip.py
+try:
+    import clr
+    clr.AddReference('System.Xml')
+    from System.IO import TextReader
+    from System.Xml import XmlReader, XmlReaderSettings, XmlNodeType
+except ImportError:
+    # Not running under IronPython
+    clr = None
+    from xml.etree import cElementTree
+
+ACTIONS = ("create", "modify", "delete")
+ELEMENT_TYPES = ("node", "way", "relation")
+
+class OsmElement(object):
+    """An element of an OSM XML or an Osm Change file"""
+    __slots__ = ("action", "type", "id", "lat", "lon", "nodes", "members", "tags")
+
+    def __init__(self, action, element_type, element_id):
+        self.action = action  # "create", "modify", "delete", or None in OSM XML files
+        self.type = element_type  # "node", "way", or "relation"
+        self.id = element_id
+        self.lat = None  # Location of a node, if available
+        self.lon = None
+        self.nodes = []  # Node ids of a way
+        self.members = []  # (type, ref, role) of each relation member
+        self.tags = {}
+
+    def __repr__(self):
+        return "OsmElement({}, {}, {})".format(self.action, self.type, self.id)
+
+def osmChangeOpen(filename):
+    """Open a plain or a gzip compressed (*.gz) file for binary reading"""
+    if filename[-3:] == ".gz":
+        return gzip.open(filename)
+    else:
+        return open(filename, 'rb')
+
+def osmChangeElements(filename):
+    """Generate an (action, type, id) record for each element of an Osm Change file"""
+    if clr:
+        return _xmlReaderElements(filename)
+    else:
+        return _iterparseElements(filename)
+
+def osmChangeDetails(filename):
+    """Generate an OsmElement for each element of an Osm Change or an OSM XML file"""
+    if clr:
+        return _xmlReaderDetails(filename)
+    else:
+        return _iterparseDetails(filename)
+
+def osmChangesElements(filenames):
+    """Generate an (action, type, id) record for each element changed by a sequence of Osm Change files
+
+    Each element is reported once, with its net action, see net_action()
+    """
+    first_actions = {}
+    last_actions = {}
+    for filename in filenames:
+        for (action, element_type, element_id) in osmChangeElements(filename):
+            key = (ELEMENT_TYPES.index(element_type), element_id)
+            first_actions.setdefault(key, action)
+            last_actions[key] = action
+    for key in sorted(last_actions):
+        action = net_action(first_actions[key], last_actions[key])
+        if action is not None:
+            yield (action, ELEMENT_TYPES[key[0]], key[1])
+
+def osmChangesDetails(filenames):
+    """Generate an OsmElement for each element changed by a sequence of Osm Change files
+
+    Each element is reported once, with its net action, see net_action(),
+    and its details in the last file
+    """
+    first_actions = {}
+    last_elements = {}
+    for filename in filenames:
+        for element in osmChangeDetails(filename):
+            key = (ELEMENT_TYPES.index(element.type), element.id)
+            first_actions.setdefault(key, element.action)
+            last_elements[key] = element
+    for key in sorted(last_elements):
+        element = last_elements[key]
+        element.action = net_action(first_actions[key], element.action)
+        if element.action is not None:
+            yield element
+
+def net_action(first_action, last_action):
+    """The action of consecutive changes of an element, given its first and last actions
+
+    The element existed before the changes unless first created,
+    and exists after them unless last deleted:
+    create ... delete is no action (None), delete ... create is a modification.
+    """
+    existed = first_action != "create"
+    exists = last_action != "delete"
+    if existed and exists:
+        return "modify"
+    elif existed:
+        return "delete"
+    elif exists:
+        return "create"
+    return None
+
+def _xmlReaderElements(filename):
+    text_reader = osmChangeReader(filename)
+    settings = XmlReaderSettings()
+    settings.IgnoreComments = True
+    settings.IgnoreWhitespace = True
+    reader = XmlReader.Create(text_reader, settings)
+    try:
+        action = None
+        while reader.Read():
+            if reader.NodeType != XmlNodeType.Element:
+                continue
+            # <osmChange> is at depth 0, its actions at depth 1,
+            # and the changed elements at depth 2
+            if reader.Depth == 1:
+                action = reader.Name
+            elif reader.Depth == 2:
+                yield (action, reader.Name, long(reader.GetAttribute("id")))
+    finally:
+        reader.Close()
+        text_reader.f.close()
+
+def _iterparseElements(filename):
+    f = osmChangeOpen(filename)
+    try:
+        depth = 0
+        root = None
+        action = None
+        for event, element in cElementTree.iterparse(f, events=("start", "end")):
+            if event == "start":
+                if depth == 0:
+                    root = element
+                elif depth == 1:
+                    action = element
+                elif depth == 2:
+                    yield (action.tag, element.tag, long(element.get("id")))
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 2:
+                    # Release the parsed element and its tags, nodes, or members
+                    action.clear()
+                elif depth == 1:
+                    # Release the parsed action
+                    root.clear()
+    finally:
+        f.close()
+
+def _xmlReaderDetails(filename):
+    text_reader = osmChangeReader(filename)
+    settings = XmlReaderSettings()
+    settings.IgnoreComments = True
+    settings.IgnoreWhitespace = True
+    reader = XmlReader.Create(text_reader, settings)
+    try:
+        action = None
+        element = None
+        while reader.Read():
+            if reader.NodeType == XmlNodeType.Element:
+                name = reader.Name
+                if name in ELEMENT_TYPES:
+                    element = OsmElement(action, name, long(reader.GetAttribute("id")))
+                    if reader.GetAttribute("lat") is not None:
+                        element.lat = float(reader.GetAttribute("lat"))
+                        element.lon = float(reader.GetAttribute("lon"))
+                    if reader.IsEmptyElement:
+                        yield element
+                        element = None
+                elif element is None:
+                    if name in ACTIONS:
+                        action = name
+                elif name == "nd":
+                    element.nodes.append(long(reader.GetAttribute("ref")))
+                elif name == "member":
+                    element.members.append((reader.GetAttribute("type"),
+                        long(reader.GetAttribute("ref")), reader.GetAttribute("role")))
+                elif name == "tag":
+                    element.tags[reader.GetAttribute("k")] = reader.GetAttribute("v")
+            elif reader.NodeType == XmlNodeType.EndElement:
+                if element is not None and reader.Name == element.type:
+                    yield element
+                    element = None
+                elif reader.Name in ACTIONS:
+                    action = None
+    finally:
+        reader.Close()
+        text_reader.f.close()
+
+def _iterparseDetails(filename):
+    f = osmChangeOpen(filename)
+    try:
+        parents = []
+        action = None
+        for event, xml_element in cElementTree.iterparse(f, events=("start", "end")):
+            tag = xml_element.tag
+            if event == "start":
+                parents.append(xml_element)
+                if tag in ACTIONS:
+                    action = tag
+                continue
+            parents.pop()
+            if tag in ACTIONS:
+                action = None
+            if tag not in ELEMENT_TYPES:
+                continue
+            element = OsmElement(action, tag, long(xml_element.get("id")))
+            if xml_element.get("lat") is not None:
+                element.lat = float(xml_element.get("lat"))
+                element.lon = float(xml_element.get("lon"))
+            for child in xml_element:
+                if child.tag == "nd":
+                    element.nodes.append(long(child.get("ref")))
+                elif child.tag == "member":
+                    element.members.append((child.get("type"), long(child.get("ref")), child.get("role")))
+                elif child.tag == "tag":
+                    element.tags[child.get("k")] = child.get("v")
+            yield element
+            # Release the parsed element and its siblings
+            parents[-1].clear()
+    finally:
+        f.close()
+
+if clr:
+    class osmChangeReader(TextReader):
+        """A System.IO.TextReader of a plain or a gzip compressed file"""
+        def __init__(self, filename):
+            self.f = osmChangeOpen(filename)
+        def Read(self, buffer, index, count):
+            chars = self.f.read(count).ToCharArray()
+            chars.CopyTo(buffer, index)
+            return len(chars)
+
+# vim: set shiftwidth=4 expandtab textwidth=0:
@@ -30,6 +30,7 @@ class osmChangeSource(object):
         self.change_resolution = ""
         self.osmupdate_params = []
         self.osmconvert_params = []
+        self.geometry_index = None  # Optional OsmGeometryIndex of the base map
 
 
     def status(self):
@@ -167,10 +168,16 @@ class osmChangeSource(object):
         App.log("=== Advancing "+self.region+" map state ===")
         status = self.status()
         if status == "incremental":
+            index_current = self.geometry_index and self.geometry_index.represents(self.base)
             self.safe_rename(self.updated, self.base)
+            if index_current:
+                App.log("=== Updating "+self.region+" geometry index ===")
+                self.geometry_index.apply(self.changes, self.base)
             self.silent_remove(self.changes)
+            self.indexBase()
         elif status == "non-incremental":
             self.safe_rename(self.updated, self.base)
+            self.indexBase()
         elif status == "changes":
             self.safe_rename(self.changes, self.changes+".old")
             self.silent_remove(self.base)
@@ -181,6 +188,23 @@ class osmChangeSource(object):
                 self.region, status))
             raise RuntimeError
 
+    def indexBase(self):
+        """Build the geometry index of the base map, unless it is up to date"""
+        if (not self.geometry_index or not os.path.exists(self.base)
+                or self.geometry_index.represents(self.base)):
+            return
+        App.log("=== Indexing "+self.region+" base map ===")
+        osm_file = os.path.join(self.tempdir, "index.osm")
+        exit_code = App.run_program(
+                "osmconvert.exe", 7200, [self.base, "-o="+osm_file]
+                + self.osmconvert_params)
+        if exit_code:
+            App.log("  Program finished with exit code {}.".format(
+                exit_code))
+        else:
+            self.geometry_index.build(osm_file, self.base)
+        self.silent_remove(osm_file)
+
     def deactivate(self):
         self.silent_remove(self.updated)
         self.silent_remove(self.changes)
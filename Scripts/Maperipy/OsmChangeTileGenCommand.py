@@ -1,13 +1,33 @@
 """Tile generation restriction by an Osm Change file and a polygon.
 
-Read a compressed or uncompressed Osm Change file
+Read a compressed or uncompressed Osm Change file, or a sequence of them
 Analyze the tiles that were modified at a given range of zoom levels.
 Potentially perform the analysis on additional Osm Change files.
 Restrict the tile generation within a polygon to changed tiles and their adjecent tiles.
 
 Inputs for each analysis:
-- Osm Change file
+- Osm Change file, or a list of consecutive Osm Change files analyzed
+  once per changed element, see OsmChangeReader.osmChangesElements()
 - Base and new OSM maps, each as either a pbf file or an existing map layer
+- Alternatively, an OsmGeometryIndex of the base map
+
+With an OsmGeometryIndex and the tags read by the rulesets, see RulesetTags,
+modified elements whose geometry and rendered tags did not change are skipped.
+With an OsmGeometryIndex and the zoom levels of the rulesets, see RulesetZooms,
+the tiles of each element are marked only at the zoom levels where the element,
+its ways, or its parent relations are drawn.
+
+The same analysis can also mark separate changed tiles for several target maps,
+each with its own rulesets and an optional osmfilter selection, see add_target().
+
+The analysis can be split between several threads, see osmChangeWorker.
+
+The results of an analysis can be saved and loaded to resume an interrupted
+tile generation, see save_analysis() and analysis_key().
+
+Ways mark the tiles their segments cross, and closed ways the tiles covering
+their area, see TileRaster. Nodes and the accumulated members of multipolygons
+mark the tiles covering their bounding boxes.
 """
 
 # TODO:
@@ -19,25 +39,33 @@ Inputs for each analysis:
 # import string
 import math
 import os
+import json
+import hashlib
+import itertools
+import threading
+import Queue
+import types
 from datetime import *
-from System.IO import TextReader
 from maperipy import *
 from maperipy.osm import *
 from PolygonTileGenCommand import PolygonTileGenCommand
-import gzip  # https://bitbucket.org/jdhardy/ironpythonzlib/src/tip/tests/gzip.py
-import clr
-clr.AddReference('System.Xml')
-from System.Xml import *
+from TileSet import TileSet, SummedAreaTable
+from OsmChangeReader import osmChangeElements, osmChangeDetails, osmChangesElements, osmChangesDetails
+from OsmGeometryIndex import OsmGeometryIndex, SCALE
+from TileManifest import write_manifest
+from TileRaster import line_rows, area_rows, parent_rows, is_closed
+from FileUtils import replace_file
 
 class OsmChangeTileGenCommand(PolygonTileGenCommand):
     """Analyse an OsmChange file and find all tiles to be updated
 
-    Changed tiles are stored in a dictionary of dictionaries:
-    self.changed[zoom][(tile_x, tile_y)]
+    Changed tiles are stored in a dictionary of TileSets, one per zoom level:
+    (tile_x, tile_y) in self.changed[zoom]
     Changed tiles are added at max_zoom and propagated to lower zoom levels if needed.
 
     Tiles to be updated are either changed or adjecant to changed tiles.
-    self.guard[zoom][(tile_x, tile_y)] is a cache for the tiles to be updated
+    self.guard[zoom] is a cache of the TileSet of the tiles to be updated
+    self.guard_index[zoom] is its SummedAreaTable, answering whether a super-tile is to be updated
     """
 
     def generation_filter(self, zoom, x, y, width, height):
@@ -48,7 +76,7 @@ class OsmChangeTileGenCommand(PolygonTileGenCommand):
             # Change analysis is not used
             return PolygonTileGenCommand.generation_filter(self, zoom, x, y, width, height)
         self._progress_update(zoom, width*height)
-        generate = self.updated(zoom, x, y, width, height)
+        generate = self.updated(zoom, x, y, width, height) and self.tiles_in_zoom_regions(zoom, x, y, width, height)
         if self.verbose:
             print "     OsmChangeTileGenCommand - Generating {}x{} super-tile: {}/{}/{}: {}".format(
                     width, height, zoom, x, y, generate)
@@ -61,7 +89,8 @@ class OsmChangeTileGenCommand(PolygonTileGenCommand):
         if self.changed is None:
             # Change analysis is not used
             return PolygonTileGenCommand.save_filter(self, tile)
-        save = self.updated(tile.zoom, tile.tile_x, tile.tile_y, 1, 1)
+        save = (self.updated(tile.zoom, tile.tile_x, tile.tile_y, 1, 1)
+                and self.tiles_in_zoom_regions(tile.zoom, tile.tile_x, tile.tile_y, 1, 1))
         if self.verbose:
             reason = "Changed" if (tile.tile_x, tile.tile_y) in self.changed[tile.zoom] else ("Guard band" if save else "Skipped")
             # TODO # self.reason[reason] += 1
@@ -76,119 +105,404 @@ class OsmChangeTileGenCommand(PolygonTileGenCommand):
         The new pbf file is added to the map.
 
         Inputs: File names of the change file, base map, and new map
+        The change file can also be a list of consecutive change files, from the base map to the new map.
         The base map is used for locating tiles with deleted and changed objects.
+        The base map can also be an OsmGeometryIndex, which is used instead of loading the base map.
         The new map is used for locating tiles with new and changed objects.
         """
 
         App.run_command('clear-map')
         App.run_command("use-ruleset location="+os.path.join("Rules", "empty.mrules"))
         App.collect_garbage()
-        self.changed = {x:{} for x in range(self.min_zoom, self.max_zoom+1)}
+        self.changed = self.new_changes()
+        self.target_changed = {name: self.new_changes() for name in self.targets}
         # Initialize the guard zone tiles
         self.guard = None
+        self.zoom_limited = (self.ruleset_zooms is not None and isinstance(base_map, OsmGeometryIndex))
+        self.zoom_cache = {}
+        self.zoom_marks = {}
+        # Initialize the bounding box cache
+        self.bbox_cache = {}
+        self.bbox_in_progress = set()
+        self.bbox_cycle = False  # Was a relation cycle cut while finding the bboxes in progress?
+        self.bbox_stats = {"hits": 0, "misses": 0, "cycles": 0}
         if self.verbose:
             print "     Reading change file", change_file, "..."
-        osmChange = XmlDocument()
-        osmChange.Load(osmChangeReader(change_file))
-        for element in osmChange.SelectNodes("./osmChange"):
-            if not element.HasChildNodes:
-                return
-        if self.verbose:
-            print "     Reading base OSM map from", base_map, "..."
-        Map.add_osm_source(base_map)
-        base_index = len(Map.layers)
-        Map.layers[base_index-1].visible = False
-        baseOsm = Map.layers[base_index-1].osm
-        App.collect_garbage()
+        # The change file is streamed, one element at a time
+        self.skipped = {key : 0 for key in ("node", "way", "relation")}
+        self.analyzed = {key : 0 for key in ("node", "way", "relation")}
+        if isinstance(change_file, (list, tuple)):
+            # Consecutive change files, with one net action per element
+            (read_elements, read_details) = (osmChangesElements, osmChangesDetails)
+        else:
+            (read_elements, read_details) = (osmChangeElements, osmChangeDetails)
+        if ((self.ruleset_tags is not None or self.targets or self.ruleset_zooms is not None)
+                and isinstance(base_map, OsmGeometryIndex)):
+            elements = self.rendered_elements(read_details(change_file), base_map)
+        else:
+            elements = read_elements(change_file)
+        try:
+            first_element = next(elements)
+        except StopIteration:
+            # No changes
+            return
+        if isinstance(base_map, OsmGeometryIndex):
+            if self.verbose:
+                print "     Using base OSM geometry index", base_map.filename, "..."
+            base_index = None
+            baseOsm = osmIndexData(base_map)
+        else:
+            if self.verbose:
+                print "     Reading base OSM map from", base_map, "..."
+            Map.add_osm_source(base_map)
+            base_index = len(Map.layers)
+            Map.layers[base_index-1].visible = False
+            baseOsm = Map.layers[base_index-1].osm
+            App.collect_garbage()
         if self.verbose:
             App.log("     Reading new OSM map from {} ...".format(new_map))
         Map.add_osm_source(new_map)
         new_index = len(Map.layers)
         App.collect_garbage()
         newOsm = Map.layers[new_index-1].osm
-        if self.verbose:
-            print "     Analyzing change file ..."
-        sum = {key : 0 for key in ("node", "way", "relation")}
-        for element in osmChange.SelectNodes("./osmChange/*/*"):
-            action = element.ParentNode.Name  # "delete", "modify", or "create"`
-            element_type = element.Name  # "node", "way", or "relation"
-            element_id = long(element.Attributes.GetNamedItem("id").Value)
-            # DEBUG EXAMPLE
-            # self.verbose = ((element_type == "relation") and (element_id == 3791784))
-            sum[element_type] += 1
+        elements = itertools.chain([first_element], elements)
+        if self.workers > 1 and not self.visualize:
+            if self.verbose:
+                print "     Analyzing change file with {} threads ...".format(self.workers)
+            sum = self.analyze_parallel(elements, base_map, baseOsm, newOsm)
+        else:
             if self.verbose:
-                print "     {} {} id={}:".format(action, element_type, element_id)
-            try:
-                if action in ("delete", "modify"):
-                    for bbox in self.bboxes(baseOsm, element_type, element_id):
-                            self.mark_bbox(bbox)
-                if action in ("create", "modify"):
-                    for bbox in self.bboxes(newOsm, element_type, element_id):
-                        self.mark_bbox(bbox)
-            except KeyError:
-                # An element does not exist in the map,
-                # no need to redraw its position
-                pass
+                print "     Analyzing change file ..."
+            sum = {key : 0 for key in ("node", "way", "relation")}
+            for element in elements:
+                # DEBUG EXAMPLE
+                # self.verbose = ((element[1] == "relation") and (element[2] == 3791784))
+                sum[element[1]] += 1
+                self.analyze_element(baseOsm, newOsm, *element)
+        self.analyzed = sum
         App.collect_garbage()
         if self.verbose:
             print "     Analyzed {} nodes, {} ways, and {} relations.".format(
                     sum["node"], sum["way"], sum["relation"])
-        App.run_command('remove-source index="{}"'.format(base_index))
+            if self.ruleset_tags is not None or self.targets:
+                print "     Skipped {} nodes, {} ways, and {} relations without rendered changes.".format(
+                        self.skipped["node"], self.skipped["way"], self.skipped["relation"])
+            for name in sorted(self.target_changed):
+                print "     {} map has {} changed tiles.".format(
+                        name, changed_count(self.target_changed[name]))
+            (hits, misses, cycles) = self.bbox_cache_statistics()
+            print "     Bounding box cache: {} hits, {} misses ({:.0%} hit rate), {} relation cycles.".format(
+                    hits, misses, float(hits)/max(1, hits+misses), cycles)
+        # Release the cached geometry
+        self.bbox_cache = {}
+        self.zoom_marks = {}
+        if base_index is not None:
+            App.run_command('remove-source index="{}"'.format(base_index))
+
+    def rendered_elements(self, elements, index):
+        """Generate the (action, type, id, target names, minimal zoom) of changed elements,
+        skipping unrendered modifications
+
+        elements - OsmElements of the change file
+        index - OsmGeometryIndex of the base map, providing the old elements
+        """
+        for element in elements:
+            if (element.action == "modify" and self.ruleset_tags is not None
+                    and not self.rendering_changed(element, index, self.ruleset_tags)):
+                self.skipped[element.type] += 1
+                continue
+            targets = tuple(name for name in sorted(self.targets)
+                    if self.targets[name].affected(self, element, index))
+            if self.targets and not targets:
+                self.skipped[element.type] += 1
+                continue
+            min_zoom = None
+            if self.ruleset_zooms is not None:
+                min_zoom = self.visible_zoom(element, index)
+            yield (element.action, element.type, element.id, targets, min_zoom)
+
+    def rendering_changed(self, element, index, ruleset_tags):
+        """Did a modification change the geometry, or a tag read by the rulesets?"""
+        old_tags = index.tags(element.type, element.id)
+        if old_tags is None:
+            # Not in the base map
+            return True
+        if element.type == "node":
+            (lat, lon) = index.node(element.id)
+            if (int(round(lat*SCALE)), int(round(lon*SCALE))) != (
+                    int(round(element.lat*SCALE)), int(round(element.lon*SCALE))):
+                return True
+        elif element.type == "way":
+            if index.way_nodes(element.id) != element.nodes:
+                return True
+        elif element.type == "relation":
+            if index.relation_members(element.id) != element.members:
+                return True
+        return ruleset_tags.changed(old_tags, element.tags)
+
+    def visible_zoom(self, element, index):
+        """The lowest analyzed zoom at which a changed element, its ways,
+        or its parent relations are drawn
+        """
+        parents = [index.tags("relation", relation_id) or {}
+                for relation_id in index.member_relations(element.type, element.id)]
+        zooms = [self.ruleset_zooms.min_zoom(element.type, element.tags, parents),
+                self.stored_zoom(index, element.type, element.id)]
+        if element.type == "node":
+            zooms.extend(self.stored_zoom(index, "way", way_id) for way_id in index.node_ways(element.id))
+        zooms = [zoom for zoom in zooms if zoom is not None]
+        if not zooms:
+            # Not drawn at all
+            return max(self.changed)
+        return max(min(zooms), min(self.changed))
+
+    def stored_zoom(self, index, element_type, element_id):
+        """The minimal zoom at which an element of the base map, or its parent relations, are drawn
+
+        The zoom levels are cached per analysis. A relation that is its own parent,
+        directly or indirectly, is ignored the second time.
+        """
+        key = (element_type, element_id)
+        if key not in self.zoom_cache:
+            self.zoom_cache[key] = None
+            parent_ids = index.member_relations(element_type, element_id)
+            parents = [index.tags("relation", relation_id) or {} for relation_id in parent_ids]
+            zooms = [self.ruleset_zooms.min_zoom(
+                    element_type, index.tags(element_type, element_id) or {}, parents)]
+            zooms.extend(self.stored_zoom(index, "relation", relation_id) for relation_id in parent_ids)
+            zooms = [zoom for zoom in zooms if zoom is not None]
+            self.zoom_cache[key] = min(zooms) if zooms else None
+        return self.zoom_cache[key]
+
+    def analyze_element(self, baseOsm, newOsm, action, element_type, element_id, targets=None, min_zoom=None):
+        """Mark the tiles of an element's old and new positions
+
+        action is "delete", "modify", or "create"
+        element_type is "node", "way", or "relation"
+        targets - names of the target maps affected by the element, None for all targets
+        min_zoom - the lowest zoom to be marked, None for all analyzed zoom levels
+        """
+        if self.verbose:
+            print "     {} {} id={}:".format(action, element_type, element_id)
+        if targets is None:
+            targets = self.target_changed
+        changed_sets = [self.changed] + [self.target_changed[name] for name in targets]
+        try:
+            if action in ("delete", "modify"):
+                for bbox in self.bboxes(baseOsm, element_type, element_id):
+                        self.mark_bbox(bbox, changed_sets, min_zoom)
+            if action in ("create", "modify"):
+                for bbox in self.bboxes(newOsm, element_type, element_id):
+                    self.mark_bbox(bbox, changed_sets, min_zoom)
+        except KeyError:
+            # An element does not exist in the map,
+            # no need to redraw its position
+            pass
+
+    def analyze_parallel(self, elements, base_map, baseOsm, newOsm):
+        """Analyze chunks of elements in self.workers threads, and merge their changed tiles
+
+        Returns the number of elements of each type.
+        """
+        chunks = Queue.Queue(2*self.workers)
+        workers = [osmChangeWorker(self, base_map, baseOsm, newOsm, chunks)
+                for i in range(self.workers)]
+        threads = [threading.Thread(target=worker.run) for worker in workers]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        sum = {key : 0 for key in ("node", "way", "relation")}
+        try:
+            chunk = []
+            for element in elements:
+                sum[element[1]] += 1
+                chunk.append(element)
+                if len(chunk) == self.chunk_size:
+                    chunks.put(chunk)
+                    chunk = []
+            if chunk:
+                chunks.put(chunk)
+        finally:
+            for thread in threads:
+                # End of elements
+                chunks.put(None)
+            for thread in threads:
+                thread.join()
+        for worker in workers:
+            if worker.error is not None:
+                raise worker.error
+            for zoom in self.changed:
+                self.changed[zoom].update(worker.changed[zoom])
+                for name in self.target_changed:
+                    self.target_changed[name][zoom].update(worker.target_changed[name][zoom])
+            for key in self.bbox_stats:
+                self.bbox_stats[key] += worker.bbox_stats[key]
+        return sum
 
     def __init__(self, *args):
         PolygonTileGenCommand.__init__(self)
         self.changed = None
         self.guard = None
+        self.guard_index = None
+        self.bbox_cache = {}
+        self.bbox_in_progress = set()
+        self.bbox_cycle = False  # Was a relation cycle cut while finding the bboxes in progress?
+        self.bbox_stats = {"hits": 0, "misses": 0, "cycles": 0}
+        self.write_manifests = True  # List the tiles to be updated next to each tiles directory?
+        self.workers = 1  # Number of change analysis threads, see osmChangeWorker
+        self.ruleset_tags = None  # Optional RulesetTags, to skip modifications of unrendered tags
+        self.ruleset_zooms = None  # Optional RulesetZooms, to skip zoom levels where elements are not drawn
+        self.zoom_limited = False  # Did the last analysis skip zoom levels of elements?
+        self.zoom_cache = {}  # {(type, id): minimal zoom} of base map elements, see stored_zoom()
+        self.zoom_marks = {}  # Tiles marked down to each minimal zoom, see marked_to_zoom()
+        self.targets = {}  # Target maps with changed tiles of their own, see add_target()
+        self.target_changed = None  # {target name: changed tiles} of the last analysis
+        self.skipped = {key : 0 for key in ("node", "way", "relation")}
+        self.analyzed = {key : 0 for key in ("node", "way", "relation")}  # Elements of the last analysis
+        self.chunk_size = 1000  # Number of elements analyzed by a thread at a time
+        self.rasterize_ways = True  # Mark the tiles of way segments, rather than of way bboxes?
+
+    def GenToDirectory(self, min_zoom, max_zoom, tiles_dir):
+        """Generate a given range of zoom levels into a target tiles directory
+
+        After a change analysis, the tiles to be updated are first listed in a manifest,
+        see manifest_file()
+        """
+        if self.changed is not None and self.write_manifests:
+            self.write_manifest(min_zoom, max_zoom, tiles_dir)
+        PolygonTileGenCommand.GenToDirectory(self, min_zoom, max_zoom, tiles_dir)
+
+    def manifest_file(self, min_zoom, max_zoom, tiles_dir):
+        """The manifest of a tiles directory and zoom range, such as Site/Tiles-7-15.tiles
+
+        A binary manifest is written next to it, with an additional .bin suffix.
+        """
+        tiles_dir = os.path.normpath(tiles_dir)
+        return "{}-{}-{}.tiles".format(tiles_dir, min_zoom, max_zoom)
+
+    def write_manifest(self, min_zoom, max_zoom, tiles_dir):
+        """List the tiles to be updated in a zoom range, see TileManifest"""
+        self.update_guard()
+        manifest = self.manifest_file(min_zoom, max_zoom, tiles_dir)
+        write_manifest(manifest, {zoom: self.guard[zoom] for zoom in self.guard
+            if min_zoom <= zoom <= max_zoom})
+        print "     Tiles to be updated are listed in", manifest
+
+    def add_target(self, name, ruleset_tags=None, osm_filter=None):
+        """Mark the changed tiles of a target map separately in the following analyses
+
+        ruleset_tags - RulesetTags of the target's rulesets, or None for any tag
+        osm_filter - OsmFilter of the target's map data, or None for all elements
+        Modifications are checked for each target with an OsmGeometryIndex of the base map,
+        otherwise all changes are marked for all targets.
+        """
+        self.targets[name] = osmChangeTarget(ruleset_tags, osm_filter)
+
+    def use_target(self, name):
+        """Restrict the tile generation to a target map's changed tiles, if analyzed"""
+        if self.target_changed is not None:
+            self.use_changes(self.target_changed[name], self.zoom_limited)
+
+    def use_changes(self, changed, zoom_limited=False):
+        """Restrict the tile generation to given changed tiles, such as another command's target
+
+        zoom_limited - were the changed tiles marked only from the zoom levels elements are drawn at?
+        """
+        self.changed = changed
+        self.zoom_limited = zoom_limited
+        self.guard = None
+        self.guard_index = None
+
+    def new_changes(self):
+        """An empty TileSet for each zoom level"""
+        return {zoom: TileSet(zoom, self.tile_extent(zoom))
+                for zoom in range(self.min_zoom, self.max_zoom+1)}
+
+    def save_analysis(self, filename, key):
+        """Save the changed tiles of the last analysis, and their guard, replacing the file atomically, see replace_file()
+
+        key - identifies the analyzed change, see analysis_key()
+        """
+        self.update_guard()
+        temp_filename = filename + ".tmp"
+        with open(temp_filename, 'w') as f:
+            f.write("OsmChangeAnalysis {} {}\n".format(key, " ".join(str(zoom) for zoom in sorted(self.changed))))
+            f.write(json.dumps({
+                "skipped": self.skipped,
+                "bbox_stats": self.bbox_stats,
+                "zoom_limited": self.zoom_limited,
+                "targets": sorted(self.target_changed or {})}) + "\n")
+            for zoom in sorted(self.changed):
+                self.changed[zoom].write(f)
+                self.guard[zoom].write(f)
+            for name in sorted(self.target_changed or {}):
+                for zoom in sorted(self.changed):
+                    self.target_changed[name][zoom].write(f)
+            f.write("End\n")
+        replace_file(temp_filename, filename)
+
+    def load_analysis(self, filename, key):
+        """Load an analysis saved for the same key and zoom levels, return True if successful"""
+        zooms = sorted(self.new_changes())
+        try:
+            with open(filename) as f:
+                header = f.readline().split()
+                if header != ["OsmChangeAnalysis", key] + [str(zoom) for zoom in zooms]:
+                    return False
+                metadata = json.loads(f.readline())
+                (changed, guard) = ({}, {})
+                for zoom in zooms:
+                    changed[zoom] = TileSet.read(f)
+                    guard[zoom] = TileSet.read(f)
+                target_changed = {}
+                for name in metadata["targets"]:
+                    target_changed[name] = {zoom: TileSet.read(f) for zoom in zooms}
+                if f.readline().strip() != "End":
+                    return False
+        except (IOError, ValueError, KeyError):
+            return False
+        self.changed = changed
+        self.guard = guard
+        self.guard_index = {zoom: SummedAreaTable(self.guard[zoom]) for zoom in self.guard}
+        self.target_changed = target_changed
+        self.skipped = metadata["skipped"]
+        self.bbox_stats = metadata["bbox_stats"]
+        self.zoom_limited = metadata["zoom_limited"]
+        return True
 
     def execute(self):
         if self.changed is not None:
-            if self.changed[min(self.changed)]:
+            # With zoom limited analysis, the lowest zoom levels may have no changes
+            if any(self.changed.values()):
                 self.update_guard()
             else:
                 # Change analysis was done, but nothing was changed
+                self.metrics.start(tiles_dir=self.tiles_dir, min_zoom=self.min_zoom, max_zoom=self.max_zoom)
                 return
         PolygonTileGenCommand.execute(self)
 
     def updated(self, zoom, x, y, width, height):
+        """Is any tile of a range of tiles to be updated?
+
+        Zoom levels during tile generation may differ from analyzed zoom levels:
+        above the analyzed zoom levels, the covering tiles are checked,
+        below them, the covered tiles are checked.
+        """
+        self.update_guard()
+        (left, top, right, bottom) = (x, y, x+width-1, y+height-1)
+        analyzed_zoom = min(max(zoom, min(self.changed)), max(self.changed))
+        if zoom > analyzed_zoom:
+            shift = zoom - analyzed_zoom
+            (left, top, right, bottom) = (left >> shift, top >> shift, right >> shift, bottom >> shift)
+        elif zoom < analyzed_zoom:
+            shift = analyzed_zoom - zoom
+            (left, top, right, bottom) = (left << shift, top << shift,
+                    ((right+1) << shift) - 1, ((bottom+1) << shift) - 1)
+        result = self.guard_index[analyzed_zoom].any(left, top, right, bottom)
         if self.verbose:
-            App.log("updated({}, {}, {}, {}, {})".format(zoom, x, y, width, height))
-        try:
-            # Leverage the guard to check every 3rd row and column inside the super-tile
-            # Note: This is for safety. We did not see width or height values larger than 3.
-            for tile_x in range(x, x+width, 3) + [x+width-1]:
-                for tile_y in range(y, y+width, 3) + [y+width-1]:
-                    if self.verbose:
-                        App.log("({}, {}) {} in self.guard[{}]".format(
-                            tile_x, tile_y,
-                            "" if (tile_x, tile_y) in self.guard[zoom] else "not ",
-                            zoom))
-                    if (tile_x, tile_y) in self.guard[zoom]:
-                        return True
-            return False
-        # Handle rare scenarios through exceptions
-        except TypeError:
-            if self.guard is None:
-                # Guard is not updated
-                self.update_guard()
-                return self.updated(zoom, x, y, width, height)
-            else:
-                raise
-        except KeyError:
-            # Zoom levels during tile generation may differ from analyzed zoom levels
-            if zoom > max(self.changed):
-                # Look for a tile at zoom == max(self.changed) that covers this tile
-                return self.updated(zoom-1, x//2, y//2)
-            elif zoom < min(self.changed):
-                # Look for a tile at zoom == min(self.changed) that is covered by this tile
-                zoom += 1
-                x *= 2
-                y *= 2
-                return (self.updated(zoom, x, y)
-                        or self.updated(zoom, x+1, y+1)
-                        or self.updated(zoom, x, y+1)
-                        or self.updated(zoom, x+1, y))
-            else:
-                raise
+            App.log("updated({}, {}, {}, {}, {}): tiles {}/{}/{} - {}/{}: {}".format(
+                zoom, x, y, width, height, analyzed_zoom, left, top, right, bottom, result))
+        return result
 
     def new_tile_upwards(self, x, y, zoom):
         if self.verbose:
@@ -197,16 +511,14 @@ class OsmChangeTileGenCommand(PolygonTileGenCommand):
             self.new_tile_upwards(x//2, y//2, zoom-1)
 
     def new_tile(self, x, y, zoom):
-        tile = (x, y)
-        if zoom not in self.changed or tile in self.changed[zoom]:
+        if zoom not in self.changed or not self.changed[zoom].add(x, y):
             if self.verbose:
                 if zoom not in self.changed:
                     App.log("     No new tile {}/{}/{}, zoom not in self.changed".format(zoom, x, y))
-                if tile in self.changed[zoom]:
+                else:
                     App.log("     No new tile {}/{}/{}, already there".format(zoom, x, y))
             return False
         else:
-            self.changed[zoom][tile] = True
             if self.verbose:
                 App.log("     New tile {}/{}/{}".format(zoom, x, y))
             return True
@@ -214,25 +526,21 @@ class OsmChangeTileGenCommand(PolygonTileGenCommand):
     def update_guard(self):
         """If needed, update the cache of tiles to be rendered
         by adding a guard of one tile around each changed tile.
-        Avoid adding tiles outside the polygon.
+        Avoid adding tiles outside the polygon, and tiles excluded by zoom regions.
         """
         if self.guard is not None:
             return
         self.guard={}
-        tile_checked = {}
         for zoom in sorted(self.changed):
-            self.guard[zoom] = {}
-            tile_checked[zoom] = {}
-            for (x, y) in self.changed[zoom]:
-                for x_guard in range(x-1, x+2):
-                    for y_guard in range(y-1, y+2):
-                        if (x_guard, y_guard) not in tile_checked[zoom]:
-                            # Check each tile once
-                            tile_checked[zoom][(x_guard, y_guard)] = True
-                            if ((zoom == min(self.changed) or (x_guard//2, y_guard//2) in self.guard[zoom-1])
-                                    and self.tiles_overlapps_polygon(zoom, x_guard, y_guard, 1, 1)):
-                                # Included in guard of lower zoom, if exists, and in the polygon 
-                                self.guard[zoom][(x_guard, y_guard)] = True
+            # Changed tiles and their adjecent tiles, computed row by row
+            guard = self.changed[zoom].dilated()
+            if zoom != min(self.changed) and not self.zoom_limited:
+                # Included in guard of lower zoom.
+                # Not when elements were not marked at lower zoom levels, see visible_zoom()
+                guard.intersection_update(self.guard[zoom-1].children(guard.extent))
+            # and in the polygon
+            self.guard[zoom] = self.tiles_overlapping_polygon(guard)
+        self.guard_index = {zoom: SummedAreaTable(self.guard[zoom]) for zoom in self.guard}
 
     def statistics(self, verbose=True):
         self.update_guard()
@@ -251,9 +559,17 @@ class OsmChangeTileGenCommand(PolygonTileGenCommand):
                     sum_changed, sum_guard)
         return (sum_changed, sum_guard)
 
-    def mark_bbox(self, bbox):
-        # Update all tiles covering the bounding box
-        if not self.linear_ring_overlapps_polygon(bbox.polygon.exterior):
+    def mark_bbox(self, bbox, changed_sets=None, min_zoom=None):
+        """Update all tiles covering the bounding box
+
+        A way's geometry, as returned by bboxes(), is marked by mark_way().
+        changed_sets - the changed tiles to be updated, self.changed by default
+        min_zoom - the lowest zoom to be updated, None for all zoom levels
+        """
+        if not isinstance(bbox, BoundingBox):
+            self.mark_way(bbox, changed_sets, min_zoom)
+            return
+        if not self.bbox_overlapps_polygon(bbox):
             # Ignore changes outside the generation polygon
             return
         zoom = max(self.changed)
@@ -285,26 +601,126 @@ class OsmChangeTileGenCommand(PolygonTileGenCommand):
         if self.verbose:
             App.log("     mark_bbox for x in range ({}, {}):".format(left, right+1))
             App.log("     mark_bbox     for y in range ({}, {}):".format(top, bottom+1))
-        for x in range (left, right+1):
-            for y in range(top, bottom+1):
-                self.new_tile_upwards(x, y, zoom)
+        # Add the tiles and their covering tiles at lower zoom levels, row by row.
+        # Tiles covering tiles already marked down to the same zoom already exist.
+        rect = (zoom, left, top, right, bottom)
+        for changed in changed_sets or [self.changed]:
+            marked = self.marked_to_zoom(changed, min_zoom)
+            (zoom, left, top, right, bottom) = rect
+            while zoom in changed and zoom >= (min_zoom or 0):
+                if not marked[zoom].add_rect(left, top, right, bottom):
+                    break
+                if marked is not changed:
+                    changed[zoom].add_rect(left, top, right, bottom)
                 if self.verbose:
-                    App.log("     mark_bbox        new_tile_upwards(({}, {}), {})".format(x, y, zoom))
+                    App.log("     mark_bbox        new tiles {}/{}/{} - {}/{}".format(zoom, left, top, right, bottom))
+                (left, top, right, bottom) = (left//2, top//2, right//2, bottom//2)
+                zoom -= 1
+
+    def mark_way(self, geometry, changed_sets=None, min_zoom=None):
+        """Update the tiles crossed by the segments of a way, or covering a closed way"""
+        if not self.bbox_overlapps_polygon(geometry.bounding_box):
+            # Ignore changes outside the generation polygon
+            return
+        coords = [(point.x, point.y) for point in geometry.coords]
+        if not coords:
+            return
+        zoom = max(self.changed)
+        if is_closed(coords):
+            rows = area_rows(coords, zoom)
+        else:
+            rows = line_rows(coords, zoom)
+        if self.verbose:
+            App.log("     mark_way {} points, {} rows at zoom {}".format(len(coords), len(rows), zoom))
+        # Add the tiles and their covering tiles at lower zoom levels, row by row.
+        # Rows without new tiles marked down to the same zoom are already covered
+        # at lower zoom levels.
+        for changed in changed_sets or [self.changed]:
+            marked = self.marked_to_zoom(changed, min_zoom)
+            (zoom, zoom_rows) = (max(self.changed), rows)
+            while zoom in changed and zoom >= (min_zoom or 0) and zoom_rows:
+                new_rows = {y: ranges for (y, ranges) in zoom_rows.items()
+                        if sum([marked[zoom].add_rect(left, y, right, y) for (left, right) in ranges])}
+                if marked is not changed:
+                    for (y, ranges) in new_rows.items():
+                        for (left, right) in ranges:
+                            changed[zoom].add_rect(left, y, right, y)
+                zoom_rows = parent_rows(new_rows)
+                zoom -= 1
+
+    def marked_to_zoom(self, changed, min_zoom):
+        """The tiles of changed tiles that were marked down to a minimal zoom
+
+        Tiles marked down to the same minimal zoom have their covering tiles marked,
+        so marking an element can stop at its tiles that were already marked.
+        Without a minimal zoom, all tiles are marked down to the lowest zoom.
+        """
+        if min_zoom is None:
+            return changed
+        key = (id(changed), min_zoom)
+        if key not in self.zoom_marks:
+            self.zoom_marks[key] = {zoom: TileSet(zoom, tiles.extent)
+                    for (zoom, tiles) in changed.items() if zoom >= min_zoom}
+        return self.zoom_marks[key]
 
     def rel_members_bbox(self, relation):
         return not (relation.has_tag("type") and relation.get_tag("type") == "multipolygon")
 
     def bboxes(self, osm_data, element_type, element_id):
+        """The bounding boxes to be marked for an element, cached per analysis
+
+        Ways are represented by their geometry, unless rasterize_ways is False.
+
+        The bounding boxes of ways and relations are cached by (layer, type, id),
+        as relations can share members. A relation that is its own member,
+        directly or indirectly, is ignored the second time. The bounding boxes
+        found inside such a cycle are partial, and only those of the outermost
+        element are cached.
+        """
+        if element_type not in ("way", "relation"):
+            return list(self.element_bboxes(osm_data, element_type, element_id))
+        key = (id(osm_data), element_type, element_id)
+        if key in self.bbox_cache:
+            self.bbox_stats["hits"] += 1
+            return self.bbox_cache[key]
+        if key in self.bbox_in_progress:
+            self.bbox_stats["cycles"] += 1
+            if self.verbose:
+                App.log("     relation cycle at {} {}".format(element_type, element_id))
+            self.bbox_cycle = True
+            return []
+        self.bbox_stats["misses"] += 1
+        outer_cycle = self.bbox_cycle
+        self.bbox_cycle = False
+        self.bbox_in_progress.add(key)
+        try:
+            result = list(self.element_bboxes(osm_data, element_type, element_id))
+        finally:
+            self.bbox_in_progress.discard(key)
+        if not self.bbox_in_progress:
+            # The outermost element is complete, even if a cycle was cut inside it
+            self.bbox_cache[key] = result
+            self.bbox_cycle = False
+        elif not self.bbox_cycle:
+            self.bbox_cache[key] = result
+            self.bbox_cycle = outer_cycle
+        return result
+
+    def element_bboxes(self, osm_data, element_type, element_id):
         if self.verbose:
             App.log("     finding bboxes of {} {}".format(element_type, element_id))
         if element_type == "node":
             yield osm_data.node(element_id).location.bounding_box
         elif element_type == "way":
-            yield osm_data.get_way_geometry(element_id).bounding_box
+            geometry = osm_data.get_way_geometry(element_id)
+            if self.rasterize_ways and hasattr(geometry, "coords"):
+                yield geometry
+            else:
+                yield geometry.bounding_box
         elif element_type == "relation":
             relation = osm_data.relation(element_id) 
             members_bbox = self.rel_members_bbox(relation) # Yield each member's bbox?
-            rel_bbox = BoundingBox(Srid.Wgs84LonLat)  # Members bboxes accumulator, if needed
+            rel_bbox = None  # Members bboxes accumulator, if needed
             for member in relation.members:
                 member_type = None
                 if member.ref_type==OsmReferenceType.NODE and osm_data.has_node(member.ref_id):
@@ -313,25 +729,199 @@ class OsmChangeTileGenCommand(PolygonTileGenCommand):
                     member_type = "way"
                 elif member.ref_type==OsmReferenceType.RELATION and osm_data.has_relation(member.ref_id):
                     member_type = "relation"
+                if member_type is None:
+                    continue
                 for bbox in self.bboxes(osm_data, member_type, member.ref_id):
                     if members_bbox:
                         # Yield each member's bbox
                         yield bbox
                     else:
+                        if rel_bbox is None:
+                            rel_bbox = BoundingBox(Srid.Wgs84LonLat)
+                        if not isinstance(bbox, BoundingBox):
+                            bbox = bbox.bounding_box
                         rel_bbox.extend_with(bbox)
-                if not members_bbox:
-                    # Yield the accumulated bbox of all members
-                    yield rel_bbox
-
-class osmChangeReader(TextReader):
-    def __init__(self, filename):
-        if filename[-3:] == ".gz":
-            self.f = gzip.open(filename)
-        else:
-            self.f = open(filename)
-    def Read(self, buffer, index, count):
-        chars = self.f.read(count).ToCharArray()
-        chars.CopyTo(buffer, index)
-        return len(chars)
+            if rel_bbox is not None:
+                # Yield the accumulated bbox of all members
+                yield rel_bbox
+
+    def bbox_cache_statistics(self):
+        """(hits, misses, cycles) of the bounding box cache of the last analysis"""
+        return (self.bbox_stats["hits"], self.bbox_stats["misses"], self.bbox_stats["cycles"])
+
+class osmChangeWorker(object):
+    """A thread analyzing chunks of the elements of a change file
+
+    Each worker marks changed tiles in TileSets of its own, using its own cache of
+    bounding boxes, and its own connection to the base map's OsmGeometryIndex, if any.
+    The Maperitive maps are shared for reading.
+    Since changed tiles are added with all their covering tiles, the union of the
+    workers' changed tiles is the same as the changed tiles of a single thread.
+
+    The command's analysis methods are bound to the worker,
+    other attributes are the command's attributes.
+    """
+    def __init__(self, command, base_map, baseOsm, newOsm, chunks):
+        self.command = command
+        self.base_map = base_map
+        self.baseOsm = baseOsm
+        self.newOsm = newOsm
+        self.chunks = chunks
+        self.changed = {zoom: TileSet(zoom, tiles.extent) for (zoom, tiles) in command.changed.items()}
+        self.target_changed = {name: {zoom: TileSet(zoom, tiles.extent) for (zoom, tiles) in changed.items()}
+                for (name, changed) in command.target_changed.items()}
+        self.bbox_cache = {}
+        self.bbox_in_progress = set()
+        self.bbox_cycle = False  # Was a relation cycle cut while finding the bboxes in progress?
+        self.bbox_stats = {"hits": 0, "misses": 0, "cycles": 0}
+        self.zoom_marks = {}
+        self.error = None
+        for name in ("analyze_element", "bboxes", "element_bboxes", "mark_bbox", "mark_way", "marked_to_zoom"):
+            setattr(self, name, types.MethodType(getattr(type(command), name).im_func, self))
+
+    def __getattr__(self, name):
+        return getattr(self.command, name)
+
+    def run(self):
+        index = None
+        baseOsm = self.baseOsm
+        if isinstance(self.base_map, OsmGeometryIndex):
+            # SQLite connections are not shared between threads
+            index = OsmGeometryIndex(self.base_map.filename)
+            baseOsm = osmIndexData(index)
+        try:
+            while True:
+                chunk = self.chunks.get()
+                if chunk is None:
+                    break
+                if self.error is not None:
+                    # Drain the remaining chunks after a failure
+                    continue
+                try:
+                    for element in chunk:
+                        self.analyze_element(baseOsm, self.newOsm, *element)
+                except Exception as e:
+                    self.error = e
+        finally:
+            if index is not None:
+                index.close()
+
+class osmChangeTarget(object):
+    """A target map of the change analysis, see OsmChangeTileGenCommand.add_target()"""
+    def __init__(self, ruleset_tags=None, osm_filter=None):
+        self.ruleset_tags = ruleset_tags
+        self.osm_filter = osm_filter
+
+    def affected(self, command, element, index):
+        """May a changed element change the target map?"""
+        if self.osm_filter is not None and not self.selected(element, index):
+            return False
+        if element.action == "modify" and self.ruleset_tags is not None:
+            return command.rendering_changed(element, index, self.ruleset_tags)
+        return True
+
+    def selected(self, element, index):
+        """Is the old or the new element in the target map's data?"""
+        old_tags = index.tags(element.type, element.id) or {}
+        if (self.osm_filter.matches(element.type, element.tags)
+                or self.osm_filter.matches(element.type, old_tags)):
+            return True
+        members = [(element.type, element.id)]
+        if element.type == "node":
+            # Nodes of selected ways. New ways and their new nodes are in the change file.
+            for way_id in index.node_ways(element.id):
+                if self.osm_filter.matches("way", index.tags("way", way_id) or {}):
+                    return True
+                members.append(("way", way_id))
+        # Members of selected relations, such as the ways of hiking routes, are selected with them
+        for (member_type, member_id) in members:
+            for relation_id in index.member_relations(member_type, member_id):
+                if self.osm_filter.matches("relation", index.tags("relation", relation_id) or {}):
+                    return True
+        return False
+
+class osmIndexData(object):
+    """Access to an OsmGeometryIndex through the methods of Maperitive's OSM data used by bboxes()
+
+    Missing elements raise a KeyError.
+    """
+    def __init__(self, index):
+        self.index = index
+
+    def has_node(self, node_id):
+        return self.index.has("node", node_id)
+
+    def has_way(self, way_id):
+        return self.index.has("way", way_id)
+
+    def has_relation(self, relation_id):
+        return self.index.has("relation", relation_id)
+
+    def node(self, node_id):
+        location = self.index.node(node_id)
+        if location is None:
+            raise KeyError(node_id)
+        return osmIndexNode(Point(location[1], location[0]))
+
+    def get_way_geometry(self, way_id):
+        locations = self.index.way_locations(way_id)
+        if not locations:
+            raise KeyError(way_id)
+        points = [Point(lon, lat) for (lat, lon) in locations]
+        if len(points) == 1:
+            points.append(points[0])
+        return LineString(points)
+
+    def relation(self, relation_id):
+        members = self.index.relation_members(relation_id)
+        if members is None:
+            raise KeyError(relation_id)
+        return osmIndexRelation(self.index.tags("relation", relation_id), members)
+
+class osmIndexNode(object):
+    def __init__(self, location):
+        self.location = location
+
+class osmIndexRelation(object):
+    reference_types = {
+            "node": OsmReferenceType.NODE,
+            "way": OsmReferenceType.WAY,
+            "relation": OsmReferenceType.RELATION}
+
+    def __init__(self, tags, members):
+        self.tags = tags
+        self.members = [osmIndexMember(self.reference_types[member_type], ref)
+                for (member_type, ref, role) in members]
+
+    def has_tag(self, key):
+        return key in self.tags
+
+    def get_tag(self, key):
+        return self.tags[key]
+
+class osmIndexMember(object):
+    def __init__(self, ref_type, ref_id):
+        self.ref_type = ref_type
+        self.ref_id = ref_id
+
+def analysis_key(change_file, *timestamps):
+    """A key identifying the analysis of a change file, or a list of change files,
+    between the timestamps of its maps
+    """
+    digest = hashlib.md5()
+    for filename in change_file if isinstance(change_file, (list, tuple)) else [change_file]:
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), ""):
+                digest.update(block)
+    for timestamp in timestamps:
+        digest.update(str(timestamp))
+    return digest.hexdigest()[:16]
+
+def changed_count(changed):
+    """The number of tiles in a dictionary of TileSets"""
+    count = 0
+    for tiles in changed.values():
+        count += len(tiles)
+    return count
 
 # vim: set shiftwidth=4 expandtab textwidth=0:
@@ -0,0 +1,65 @@
+"""The element selection of an osmfilter parameter file
+
+Reads the --keep, --keep-nodes, --keep-ways, and --keep-relations options
+of an osmfilter parameter file, such as Filters/trails_filter.txt:
+    --keep-ways=
+        highway=
+        waterway=stream =river
+selects ways with any highway tag, and ways with waterway=stream or waterway=river.
+
+The selection is conservative: "and" is read as "or", and wildcard values match any value.
+The tag options, such as --keep-tags and --drop-tags, are not read.
+"""
+
+OPTIONS = {
+        "--keep": ("node", "way", "relation"),
+        "--keep-nodes": ("node",),
+        "--keep-ways": ("way",),
+        "--keep-relations": ("relation",)}
+
+class OsmFilter(object):
+    def __init__(self, filename=None):
+        # {element type: {key: set of values, or None for any value}}
+        self.conditions = {element_type: {} for element_type in ("node", "way", "relation")}
+        if filename:
+            self.read(filename)
+
+    def read(self, filename):
+        with open(filename) as f:
+            text = f.read()
+        element_types = ()
+        key = None
+        for token in text.split():
+            if token.startswith("--"):
+                (option, value) = (token.split("=", 1) + [""])[:2]
+                element_types = OPTIONS.get(option, ())
+                key = None
+                token = value
+                if not token:
+                    continue
+            if token.lower() in ("and", "or"):
+                continue
+            if token.startswith("="):
+                # An additional value of the previous key
+                if key is not None:
+                    self.add(element_types, key, token[1:])
+            elif "=" in token:
+                (key, value) = token.split("=", 1)
+                self.add(element_types, key, value)
+
+    def add(self, element_types, key, value):
+        for element_type in element_types:
+            conditions = self.conditions[element_type]
+            if not value or "*" in value or (key in conditions and conditions[key] is None):
+                conditions[key] = None
+            else:
+                conditions.setdefault(key, set()).add(value)
+
+    def matches(self, element_type, tags):
+        """Does an element with given tags pass the filter?"""
+        for (key, values) in self.conditions[element_type].items():
+            if key in tags and (values is None or tags[key] in values):
+                return True
+        return False
+
+# vim: set shiftwidth=4 expandtab textwidth=0:
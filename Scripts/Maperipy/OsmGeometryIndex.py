@@ -0,0 +1,219 @@
+"""Persistent geometry index of an OSM map
+
+The index is an SQLite database kept next to a base map, holding:
+- nodes: id to location, in 1e-7 degrees, and tags of tagged nodes
+- way_nodes: the node ids of each way, also indexed by node id
+- ways: the tags of each way
+- relation_members: the members of each relation, also indexed by member
+- relations: the tags of each relation
+
+The index answers "old geometry" queries of the change analysis without
+loading the base map into Maperitive.
+It is built once from an OSM XML file of the base map, and then updated
+incrementally by each Osm Change file applied to the base map.
+"""
+
+import os
+import json
+import sqlite3
+from OsmChangeReader import osmChangeDetails
+
+SCALE = 10000000  # Locations are stored in 1e-7 degrees, as in OSM's database
+
+class OsmGeometryIndex(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = None
+        self.batch_size = 10000
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.filename)
+            self.connection.execute("PRAGMA synchronous=OFF")
+            self.connection.execute("PRAGMA cache_size=100000")
+        return self.connection
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def create(self):
+        """Create an empty index"""
+        self.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        db = self.connect()
+        db.executescript("""
+            CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE nodes (id INTEGER PRIMARY KEY, lat INTEGER, lon INTEGER, tags TEXT);
+            CREATE TABLE way_nodes (way_id INTEGER, seq INTEGER, node_id INTEGER,
+                PRIMARY KEY (way_id, seq));
+            CREATE TABLE ways (id INTEGER PRIMARY KEY, tags TEXT);
+            CREATE TABLE relation_members (relation_id INTEGER, seq INTEGER,
+                type TEXT, ref INTEGER, role TEXT, PRIMARY KEY (relation_id, seq));
+            CREATE TABLE relations (id INTEGER PRIMARY KEY, tags TEXT);
+            """)
+        db.commit()
+
+    def build(self, osm_file, base_file=None):
+        """Build the index from an OSM XML file (plain or gzip compressed)
+
+        base_file - the map file represented by the index, see represents()
+        """
+        self.create()
+        self._load(osmChangeDetails(osm_file))
+        db = self.connect()
+        db.execute("CREATE INDEX way_nodes_node ON way_nodes (node_id)")
+        db.execute("CREATE INDEX relation_members_ref ON relation_members (type, ref)")
+        db.commit()
+        if base_file:
+            self.mark(base_file)
+
+    def apply(self, change_file, base_file=None):
+        """Update the index with an Osm Change file (plain or gzip compressed)
+
+        base_file - the map file represented by the updated index, see represents()
+        """
+        self._load(osmChangeDetails(change_file))
+        if base_file:
+            self.mark(base_file)
+
+    def _load(self, elements):
+        db = self.connect()
+        batch = 0
+        for element in elements:
+            if element.type == "node":
+                self._node(db, element)
+            elif element.type == "way":
+                self._way(db, element)
+            elif element.type == "relation":
+                self._relation(db, element)
+            batch += 1
+            if batch == self.batch_size:
+                db.commit()
+                batch = 0
+        db.commit()
+
+    def _node(self, db, element):
+        if element.action == "delete":
+            db.execute("DELETE FROM nodes WHERE id = ?", (element.id,))
+        else:
+            db.execute("INSERT OR REPLACE INTO nodes (id, lat, lon, tags) VALUES (?, ?, ?, ?)",
+                    (element.id, int(round(element.lat*SCALE)), int(round(element.lon*SCALE)),
+                        encode_tags(element.tags)))
+
+    def _way(self, db, element):
+        if element.action is not None:
+            db.execute("DELETE FROM way_nodes WHERE way_id = ?", (element.id,))
+        if element.action == "delete":
+            db.execute("DELETE FROM ways WHERE id = ?", (element.id,))
+            return
+        db.executemany("INSERT INTO way_nodes (way_id, seq, node_id) VALUES (?, ?, ?)",
+                [(element.id, seq, node_id) for (seq, node_id) in enumerate(element.nodes)])
+        db.execute("INSERT OR REPLACE INTO ways (id, tags) VALUES (?, ?)",
+                (element.id, encode_tags(element.tags)))
+
+    def _relation(self, db, element):
+        if element.action is not None:
+            db.execute("DELETE FROM relation_members WHERE relation_id = ?", (element.id,))
+        if element.action == "delete":
+            db.execute("DELETE FROM relations WHERE id = ?", (element.id,))
+            return
+        db.executemany("""INSERT INTO relation_members (relation_id, seq, type, ref, role)
+                VALUES (?, ?, ?, ?, ?)""",
+                [(element.id, seq, member_type, ref, role)
+                    for (seq, (member_type, ref, role)) in enumerate(element.members)])
+        db.execute("INSERT OR REPLACE INTO relations (id, tags) VALUES (?, ?)",
+                (element.id, encode_tags(element.tags)))
+
+    def mark(self, base_file):
+        """Record the size and modification time of the map file represented by the index"""
+        db = self.connect()
+        db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('base', ?)",
+                (file_signature(base_file),))
+        db.commit()
+
+    def represents(self, base_file):
+        """Does the index represent a given map file?"""
+        if not self.exists() or not os.path.exists(base_file):
+            return False
+        try:
+            row = self.connect().execute("SELECT value FROM meta WHERE key = 'base'").fetchone()
+        except sqlite3.Error:
+            return False
+        return row is not None and row[0] == file_signature(base_file)
+
+    def node(self, node_id):
+        """(lat, lon) of a node, or None"""
+        row = self.connect().execute(
+                "SELECT lat, lon FROM nodes WHERE id = ?", (node_id,)).fetchone()
+        if row is None:
+            return None
+        return (float(row[0])/SCALE, float(row[1])/SCALE)
+
+    def way_nodes(self, way_id):
+        """[node id, ...] of a way, or None"""
+        if not self.has("way", way_id):
+            return None
+        return [node_id for (node_id,) in self.connect().execute(
+                "SELECT node_id FROM way_nodes WHERE way_id = ? ORDER BY seq", (way_id,))]
+
+    def way_locations(self, way_id):
+        """[(lat, lon), ...] of the located nodes of a way, or None"""
+        if not self.has("way", way_id):
+            return None
+        return [(float(lat)/SCALE, float(lon)/SCALE) for (lat, lon) in self.connect().execute(
+                """SELECT nodes.lat, nodes.lon FROM way_nodes, nodes
+                WHERE way_nodes.way_id = ? AND nodes.id = way_nodes.node_id
+                ORDER BY way_nodes.seq""", (way_id,))]
+
+    def node_ways(self, node_id):
+        """[way id, ...] of the ways of a node"""
+        return [way_id for (way_id,) in self.connect().execute(
+                "SELECT DISTINCT way_id FROM way_nodes WHERE node_id = ?", (node_id,))]
+
+    def member_relations(self, member_type, ref):
+        """[relation id, ...] of the relations with a given member"""
+        return [relation_id for (relation_id,) in self.connect().execute(
+                "SELECT DISTINCT relation_id FROM relation_members WHERE type = ? AND ref = ?",
+                (member_type, ref))]
+
+    def relation_members(self, relation_id):
+        """[(type, ref, role), ...] of a relation, or None"""
+        if not self.has("relation", relation_id):
+            return None
+        return [(member_type, ref, role) for (member_type, ref, role) in self.connect().execute(
+                "SELECT type, ref, role FROM relation_members WHERE relation_id = ? ORDER BY seq",
+                (relation_id,))]
+
+    def tags(self, element_type, element_id):
+        """The tags dictionary of an element, or None"""
+        row = self.connect().execute(
+                "SELECT tags FROM {}s WHERE id = ?".format(element_type), (element_id,)).fetchone()
+        if row is None:
+            return None
+        return decode_tags(row[0])
+
+    def has(self, element_type, element_id):
+        return self.connect().execute(
+                "SELECT 1 FROM {}s WHERE id = ?".format(element_type), (element_id,)).fetchone() is not None
+
+def encode_tags(tags):
+    if not tags:
+        return None
+    return json.dumps(tags, separators=(',', ':'), sort_keys=True)
+
+def decode_tags(text):
+    if not text:
+        return {}
+    return json.loads(text)
+
+def file_signature(filename):
+    stat = os.stat(filename)
+    return "{}:{}".format(stat.st_size, int(stat.st_mtime))
+
+# vim: set shiftwidth=4 expandtab textwidth=0:
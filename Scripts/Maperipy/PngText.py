@@ -0,0 +1,67 @@
+"""Textual metadata of PNG files, without decoding the image
+
+A PNG file is a signature followed by chunks of: length (unsigned 32 bit, big
+endian), type, data, and the CRC of the type and data.
+A tEXt chunk's data is a Latin-1 keyword, a zero byte, and the Latin-1 text.
+
+set_png_text() inserts a tEXt chunk after the IHDR chunk, replacing tEXt chunks
+with the same keyword. The file is rewritten to a temporary file, which then
+replaces it.
+
+Usage from the command line:
+    python PngText.py <keyword> <text> <png file> ...
+"""
+
+import sys
+import struct
+import zlib
+
+from FileUtils import replace_file
+
+SIGNATURE = "\x89PNG\r\n\x1a\n"
+
+def png_chunks(data):
+    """Generate the (type, data, bytes) of the chunks of a PNG file's content"""
+    if data[:len(SIGNATURE)] != SIGNATURE:
+        raise ValueError("Not a PNG file")
+    position = len(SIGNATURE)
+    while position < len(data):
+        (length, chunk_type) = struct.unpack(">I4s", data[position:position+8])
+        yield (chunk_type, data[position+8:position+8+length], data[position:position+12+length])
+        position += 12 + length
+
+def png_chunk(chunk_type, chunk_data):
+    return (struct.pack(">I", len(chunk_data)) + chunk_type + chunk_data
+            + struct.pack(">I", zlib.crc32(chunk_type + chunk_data) & 0xffffffff))
+
+def text_chunk(keyword, text):
+    return png_chunk("tEXt", keyword + "\0" + text)
+
+def png_text(filename):
+    """{keyword: text} of the tEXt chunks of a PNG file"""
+    with open(filename, 'rb') as f:
+        data = f.read()
+    return dict(chunk_data.split("\0", 1)
+            for (chunk_type, chunk_data, chunk) in png_chunks(data) if chunk_type == "tEXt")
+
+def set_png_text(filename, keyword, text):
+    """Set a tEXt chunk of a PNG file"""
+    with open(filename, 'rb') as f:
+        data = f.read()
+    parts = [SIGNATURE]
+    for (chunk_type, chunk_data, chunk) in png_chunks(data):
+        if chunk_type == "tEXt" and chunk_data.split("\0", 1)[0] == keyword:
+            continue
+        parts.append(chunk)
+        if chunk_type == "IHDR":
+            parts.append(text_chunk(keyword, text))
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, 'wb') as f:
+        f.write("".join(parts))
+    replace_file(temp_filename, filename)
+
+if __name__ == "__main__":
+    for filename in sys.argv[3:]:
+        set_png_text(filename, sys.argv[1], sys.argv[2])
+
+# vim: set shiftwidth=4 expandtab textwidth=0:
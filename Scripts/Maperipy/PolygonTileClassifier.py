@@ -0,0 +1,270 @@
+"""Classification of tiles as inside, outside, or on the boundary of a polygon
+
+The classification is a quadtree: starting from the single tile of zoom 0,
+each tile is classified against the polygon, and only boundary tiles are
+divided into their four children, down to a maximal zoom level.
+A tile inside or outside the polygon settles all its descendants.
+
+The quadtree is kept as two TileSets per zoom level:
+- inside[zoom] - tiles fully inside the polygon, including descendants of such tiles
+- boundary[zoom] - tiles crossed by an edge of the polygon
+All other tiles are outside the polygon.
+
+The geometry is computed in longitude/latitude degrees, where tiles are rectangles,
+without using Maperitive, and can be cached on disk.
+
+A PreparedPolygon answers exact rectangle and point queries against the polygon,
+using a grid index of its edges.
+"""
+
+import os
+import math
+import hashlib
+from TileSet import TileSet
+from FileUtils import replace_file
+
+INSIDE = "inside"
+OUTSIDE = "outside"
+BOUNDARY = "boundary"
+
+def deg2num(lat_deg, lon_deg, zoom):
+    # Same as PolygonTileGenCommand.deg2num
+    lat_rad = math.radians(lat_deg)
+    n = 2.0 ** zoom
+    tile_x = int((lon_deg + 180.0) / 360.0 * n)
+    tile_y = int((1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2.0 * n)
+    return (tile_x, tile_y)
+
+def tile_bounds(zoom, x, y, width=1, height=1):
+    """The (west, south, east, north) bounds in degrees of a range of tiles"""
+    n = 2.0**zoom
+    west = 360.0*x/n - 180.0
+    east = 360.0*(x+width)/n - 180.0
+    north = math.degrees(math.atan(math.sinh(math.pi*(1 - 2*y/n))))
+    south = math.degrees(math.atan(math.sinh(math.pi*(1 - 2*(y+height)/n))))
+    return (west, south, east, north)
+
+def polygon_tile_extent(coords, zoom):
+    """The range of tiles covering (lon, lat) coordinates with a margin of one tile
+
+    Returns an inclusive (left, top, right, bottom) tile range.
+    """
+    (left, top) = deg2num(max(lat for (lon, lat) in coords), min(lon for (lon, lat) in coords), zoom)
+    (right, bottom) = deg2num(min(lat for (lon, lat) in coords), max(lon for (lon, lat) in coords), zoom)
+    return (left-1, top-1, right+1, bottom+1)
+
+def point_in_polygon(lon, lat, coords):
+    """Ray casting test of a point against a closed ring of (lon, lat) coordinates"""
+    inside = False
+    (lon1, lat1) = coords[-1]
+    for (lon2, lat2) in coords:
+        if (lat1 > lat) != (lat2 > lat):
+            if lon < lon1 + (lat - lat1)*(lon2 - lon1)/(lat2 - lat1):
+                inside = not inside
+        (lon1, lat1) = (lon2, lat2)
+    return inside
+
+def segment_intersects_rect(lon1, lat1, lon2, lat2, west, south, east, north):
+    """Liang-Barsky clipping of a segment by a rectangle, including its edges"""
+    t0 = 0.0
+    t1 = 1.0
+    d_lon = lon2 - lon1
+    d_lat = lat2 - lat1
+    for (p, q) in ((-d_lon, lon1 - west), (d_lon, east - lon1),
+                   (-d_lat, lat1 - south), (d_lat, north - lat1)):
+        if p == 0:
+            if q < 0:
+                return False
+        else:
+            t = float(q)/p
+            if p < 0:
+                if t > t1:
+                    return False
+                t0 = max(t0, t)
+            else:
+                if t < t0:
+                    return False
+                t1 = min(t1, t)
+    return True
+
+def classify_rect(coords, west, south, east, north):
+    for i in xrange(len(coords)-1):
+        (lon1, lat1) = coords[i]
+        (lon2, lat2) = coords[i+1]
+        if segment_intersects_rect(lon1, lat1, lon2, lat2, west, south, east, north):
+            return BOUNDARY
+    # No edge crosses the rectangle, which is either inside or outside the polygon
+    if point_in_polygon((west + east)/2, (south + north)/2, coords):
+        return INSIDE
+    return OUTSIDE
+
+class PreparedPolygon(object):
+    def __init__(self, coords):
+        """Index the edges of a polygon in a uniform grid over its bounding box
+
+        coords - ring of (lon, lat) coordinates
+
+        The grid has about one edge per cell. A rectangle query checks only the edges
+        of the cells it overlaps, and a point query only the edges of its grid row.
+        """
+        self.coords = [(float(lon), float(lat)) for (lon, lat) in coords]
+        if self.coords[0] != self.coords[-1]:
+            self.coords.append(self.coords[0])
+        self.edges = [self.coords[i] + self.coords[i+1] for i in xrange(len(self.coords)-1)]
+        self.west = min(lon for (lon, lat) in self.coords)
+        self.south = min(lat for (lon, lat) in self.coords)
+        self.east = max(lon for (lon, lat) in self.coords)
+        self.north = max(lat for (lon, lat) in self.coords)
+        self.size = max(1, int(math.sqrt(len(self.edges))))
+        self.cell_width = (self.east - self.west)/self.size or 1.0
+        self.cell_height = (self.north - self.south)/self.size or 1.0
+        self.cells = {}  # {(column, row): [edge index, ...]}
+        self.row_edges = [[] for row in xrange(self.size)]
+        for (index, (lon1, lat1, lon2, lat2)) in enumerate(self.edges):
+            (left, right) = (self.column(min(lon1, lon2)), self.column(max(lon1, lon2)))
+            (bottom, top) = (self.row(min(lat1, lat2)), self.row(max(lat1, lat2)))
+            for row in xrange(bottom, top+1):
+                self.row_edges[row].append(index)
+                for column in xrange(left, right+1):
+                    self.cells.setdefault((column, row), []).append(index)
+
+    def column(self, lon):
+        return min(max(int((lon - self.west)/self.cell_width), 0), self.size-1)
+
+    def row(self, lat):
+        return min(max(int((lat - self.south)/self.cell_height), 0), self.size-1)
+
+    def contains_point(self, lon, lat):
+        """Ray casting test of a point, see point_in_polygon()"""
+        if not (self.west <= lon <= self.east and self.south <= lat <= self.north):
+            return False
+        inside = False
+        for index in self.row_edges[self.row(lat)]:
+            (lon1, lat1, lon2, lat2) = self.edges[index]
+            if (lat1 > lat) != (lat2 > lat):
+                if lon < lon1 + (lat - lat1)*(lon2 - lon1)/(lat2 - lat1):
+                    inside = not inside
+        return inside
+
+    def classify_rect(self, west, south, east, north):
+        """INSIDE, OUTSIDE, or BOUNDARY for a rectangle, see classify_rect()"""
+        if west > self.east or east < self.west or south > self.north or north < self.south:
+            return OUTSIDE
+        checked = set()
+        for row in xrange(self.row(south), self.row(north)+1):
+            for column in xrange(self.column(west), self.column(east)+1):
+                for index in self.cells.get((column, row), ()):
+                    if index in checked:
+                        continue
+                    checked.add(index)
+                    if segment_intersects_rect(*(self.edges[index] + (west, south, east, north))):
+                        return BOUNDARY
+        # No edge crosses the rectangle, which is either inside or outside the polygon
+        if self.contains_point((west + east)/2, (south + north)/2):
+            return INSIDE
+        return OUTSIDE
+
+    def intersects_rect(self, west, south, east, north):
+        """Does a rectangle overlap the polygon, including its boundary?"""
+        return self.classify_rect(west, south, east, north) != OUTSIDE
+
+class PolygonTileClassifier(object):
+    def __init__(self, coords, max_zoom, polygon=None):
+        """Classify tiles against a polygon's exterior
+
+        coords - closed ring of (lon, lat) coordinates
+        max_zoom - the highest zoom level of the quadtree
+        polygon - optional PreparedPolygon of the coordinates
+        """
+        self.coords = [(float(lon), float(lat)) for (lon, lat) in coords]
+        if self.coords[0] != self.coords[-1]:
+            self.coords.append(self.coords[0])
+        self.max_zoom = max_zoom
+        self.polygon = polygon or PreparedPolygon(self.coords)
+        self.inside = {}
+        self.boundary = {}
+
+    def extent(self, zoom):
+        return polygon_tile_extent(self.coords, zoom)
+
+    def key(self):
+        """A key identifying the polygon and the depth of the quadtree"""
+        digest = hashlib.md5(repr((self.coords, self.max_zoom))).hexdigest()
+        return "{}-z{}".format(digest[:16], self.max_zoom)
+
+    def build(self):
+        for zoom in range(self.max_zoom+1):
+            self.inside[zoom] = TileSet(zoom, self.extent(zoom))
+            self.boundary[zoom] = TileSet(zoom, self.extent(zoom))
+        self.boundary[0].add(0, 0)
+        for zoom in range(1, self.max_zoom+1):
+            # Descendants of inside tiles are inside
+            self.inside[zoom].update(self.inside[zoom-1].children(self.inside[zoom].extent))
+            # Children of boundary tiles require geometry
+            for (parent_x, parent_y) in self.boundary[zoom-1]:
+                for x in (2*parent_x, 2*parent_x+1):
+                    for y in (2*parent_y, 2*parent_y+1):
+                        classification = self.polygon.classify_rect(*tile_bounds(zoom, x, y))
+                        if classification == INSIDE:
+                            self.inside[zoom].add(x, y)
+                        elif classification == BOUNDARY:
+                            self.boundary[zoom].add(x, y)
+
+    def classify(self, zoom, x, y):
+        """INSIDE, OUTSIDE, or BOUNDARY for a tile up to max_zoom"""
+        if zoom > self.max_zoom:
+            shift = zoom - self.max_zoom
+            classification = self.classify(self.max_zoom, x >> shift, y >> shift)
+            if classification == BOUNDARY:
+                # Finer tiles are not classified
+                return self.polygon.classify_rect(*tile_bounds(zoom, x, y))
+            return classification
+        if (x, y) in self.inside[zoom]:
+            return INSIDE
+        if (x, y) in self.boundary[zoom]:
+            return BOUNDARY
+        return OUTSIDE
+
+    def classify_range(self, zoom, x, y, width, height):
+        """INSIDE, OUTSIDE, or BOUNDARY for a range of tiles"""
+        classifications = set(self.classify(zoom, tile_x, tile_y)
+                for tile_x in xrange(x, x+width)
+                for tile_y in xrange(y, y+height))
+        if len(classifications) == 1:
+            return classifications.pop()
+        return BOUNDARY
+
+    def save(self, filename):
+        temp_filename = filename + ".tmp"
+        with open(temp_filename, 'w') as f:
+            f.write("PolygonTileClassifier {} {}\n".format(self.key(), self.max_zoom))
+            for zoom in range(self.max_zoom+1):
+                self.inside[zoom].write(f)
+                self.boundary[zoom].write(f)
+        replace_file(temp_filename, filename)
+
+    def load(self, filename):
+        """Load a classification saved for the same polygon and zoom, return True if successful"""
+        try:
+            with open(filename) as f:
+                header = f.readline().split()
+                if header != ["PolygonTileClassifier", self.key(), str(self.max_zoom)]:
+                    return False
+                for zoom in range(self.max_zoom+1):
+                    self.inside[zoom] = TileSet.read(f)
+                    self.boundary[zoom] = TileSet.read(f)
+            return True
+        except (IOError, ValueError):
+            return False
+
+    def cached(self, cache_dir):
+        """Load the classification from a cache directory, or build and save it there"""
+        filename = os.path.join(cache_dir, "polygon-{}.quadtree".format(self.key()))
+        if not self.load(filename):
+            self.build()
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            self.save(filename)
+        return self
+
+# vim: set shiftwidth=4 expandtab textwidth=0:
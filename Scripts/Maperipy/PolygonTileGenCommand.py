@@ -3,9 +3,12 @@
 The GenToDirectory method generates tiles in a given zoom interval into a directory
 
 Tile generation options:
-  - Remove tiles outside of the polygon from disk
+  - Remove tiles outside of the polygon from disk, after generation, see TileStoreCleaner
   - Create a Unix script to remove such tiles independently
   - Visualize the ploygon, the generated super-tiles, and the saved tiles
+  - Record the throughput of each zoom level as JSON lines, see RenderMetrics
+  - Limit the zoom levels generated inside regions of the polygon, see add_zoom_region()
+  - Keep uniform tiles, such as transparent tiles, in a sparse index instead of tile files, see SentinelIndex
 
 Author: Zeev Stadler
 License: public domain
@@ -15,6 +18,12 @@ import os
 import math
 from maperipy import *
 from maperipy.tilegen import TileGenCommand
+from TileSet import TileSet
+from PolygonTileClassifier import PolygonTileClassifier, PreparedPolygon, polygon_tile_extent, tile_bounds
+from PolygonTileClassifier import INSIDE, BOUNDARY
+from TileStoreCleaner import TileStoreCleaner
+from RenderMetrics import RenderMetrics
+from SentinelIndex import SentinelIndex, sentinel_dir, uniform_color, tile_numbers
 
 class PolygonTileGenCommand(TileGenCommand):
     def GenToDirectory(self, min_zoom, max_zoom, tiles_dir):
@@ -24,9 +33,6 @@ class PolygonTileGenCommand(TileGenCommand):
         self.min_zoom = min_zoom
         self.max_zoom = max_zoom
         self.rendering_bounds = Map.geo_bounds
-        if self.clean_tiles and self.tile_removal_script:
-            self.list_file.close()
-            self.list_file = open(self.tile_removal_script, 'w')
         if self.visualize and self.generation_polygon:
             # Show the Polygon on the map
             if not self.layer:
@@ -42,8 +48,19 @@ class PolygonTileGenCommand(TileGenCommand):
             # Add the plygon to the layer
             self.layer.add_symbol(self.polygon.add(self.generation_polygon))
             Map.zoom_area(self.rendering_bounds)
+        if self.sentinel_colors != ():
+            self.sentinels = SentinelIndex(sentinel_dir(tiles_dir))
         self.execute()
-        self.list_file.close()
+        self.metrics.finish()
+        if self.sentinels is not None:
+            self.sentinels.close()
+            self.sentinels = None
+        if self.clean_tiles and self.generation_polygon:
+            # Stale tiles are removed in bulk, outside of the generation loop
+            cleaner = TileStoreCleaner(self.tile_classifier())
+            cleaner.zoom_regions = self.zoom_region_classifiers()
+            cleaner.removal_script = self.tile_removal_script
+            cleaner.clean([tiles_dir], min_zoom, max_zoom)
         App.collect_garbage()
 
     def num2deg(self, xtile, ytile, zoom):
@@ -71,32 +88,102 @@ class PolygonTileGenCommand(TileGenCommand):
         tile_y = int((1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2.0 * n)
         return (tile_x, tile_y)
 
-    def linear_ring_overlapps_polygon(self, geometry):
-        result = False
-        # Start with the geometry nodes, as it is usually a rectangle
-        for point in geometry.coords:
-            if GeometryUtils.is_inside_linear_ring(point, self.generation_polygon.exterior, True):
-                # A geometry node is inside the polygon
-                result = True
-                break
-        else:
-            for point in self.generation_polygon.exterior.coords:
-                if GeometryUtils.is_inside_linear_ring(point, geometry, True):
-                    # A polygon node is inside the geometry
-                    result = True
-                    break
-        return result
+    def tile_extent(self, zoom):
+        """The range of tiles covering the generation polygon with a margin of one tile
 
-    def tiles_overlapps_polygon(self, zoom, x, y, width, height):
+        Returns an inclusive (left, top, right, bottom) tile range, or None without a polygon.
+        """
+        if self.generation_polygon is None:
+            return None
+        return polygon_tile_extent(self.polygon_coords(), zoom)
+
+    def polygon_coords(self):
+        """The (lon, lat) coordinates of the generation polygon's exterior"""
+        return [(point.x, point.y) for point in self.generation_polygon.exterior.coords]
+
+    def tile_classifier(self):
+        """The inside/outside/boundary classification of tiles against the polygon
+
+        The classification is computed once and cached on disk.
+        """
+        if self.classifier is None:
+            self.classifier = PolygonTileClassifier(self.polygon_coords(), self.classification_zoom,
+                    self.prepared_polygon()).cached(self.polygon_cache_dir)
+        return self.classifier
+
+    def prepared_polygon(self):
+        """The generation polygon, indexed for exact rectangle queries"""
+        if self.prepared is None:
+            self.prepared = PreparedPolygon(self.polygon_coords())
+        return self.prepared
+
+    def rect_overlapps_polygon(self, west, south, east, north):
+        """Does a rectangle in degrees overlap the polygon?"""
         if self.generation_polygon is None:
             return True
-        tile_geometry = LinearRing([
+        return self.prepared_polygon().intersects_rect(west, south, east, north)
+
+    def bbox_overlapps_polygon(self, bbox):
+        return self.rect_overlapps_polygon(bbox.min_x, bbox.min_y, bbox.max_x, bbox.max_y)
+
+    def add_zoom_region(self, coords, min_zoom, max_zoom):
+        """Generate the tiles inside a region only at a range of zoom levels
+
+        coords - closed ring of (lon, lat) coordinates of the region
+        Tiles fully inside the region are skipped below min_zoom and above max_zoom,
+        such as sea or empty desert regions with max_zoom 13.
+        Tiles crossing the region's boundary are generated.
+        """
+        self.zoom_regions.append((coords, min_zoom, max_zoom))
+        self.region_classifiers = None
+
+    def zoom_region_classifiers(self):
+        """[(classifier, min_zoom, max_zoom), ...] of the zoom regions
+
+        The classification of each region is cached on disk, down to the first zoom level above max_zoom.
+        """
+        if self.region_classifiers is None:
+            self.region_classifiers = [
+                    (PolygonTileClassifier(coords, max_zoom+1).cached(self.polygon_cache_dir), min_zoom, max_zoom)
+                    for (coords, min_zoom, max_zoom) in self.zoom_regions]
+        return self.region_classifiers
+
+    def tiles_in_zoom_regions(self, zoom, x, y, width, height):
+        """Is a range of tiles not excluded at its zoom level by a zoom region?"""
+        for (classifier, min_zoom, max_zoom) in self.zoom_region_classifiers():
+            if not min_zoom <= zoom <= max_zoom and classifier.classify_range(zoom, x, y, width, height) == INSIDE:
+                return False
+        return True
+
+    def remove_region_excluded_tiles(self, tiles):
+        """Remove from a TileSet the tiles excluded at its zoom level by a zoom region, and return it"""
+        for (classifier, min_zoom, max_zoom) in self.zoom_region_classifiers():
+            if not min_zoom <= tiles.zoom <= max_zoom:
+                for (x, y) in list(tiles):
+                    if classifier.classify(tiles.zoom, x, y) == INSIDE:
+                        tiles.discard(x, y)
+        return tiles
+
+    def tiles_linear_ring(self, zoom, x, y, width, height):
+        return LinearRing([
             self.num2deg(x, y, zoom),  # NW
             self.num2deg(x+width, y, zoom),  # NE
             self.num2deg(x+width, y+height, zoom),  # SE
             self.num2deg(x, y+height, zoom)])  # SW
-        result = self.linear_ring_overlapps_polygon(tile_geometry)
+
+    def tiles_overlapps_polygon(self, zoom, x, y, width, height):
+        if not self.tiles_in_zoom_regions(zoom, x, y, width, height):
+            return False
+        if self.generation_polygon is None:
+            return True
+        classification = self.tile_classifier().classify_range(zoom, x, y, width, height)
+        if classification == BOUNDARY:
+            # Only tiles on the polygon's boundary require geometry
+            result = self.rect_overlapps_polygon(*tile_bounds(zoom, x, y, width, height))
+        else:
+            result = classification == INSIDE
         if False and self.verbose:
+            tile_geometry = self.tiles_linear_ring(zoom, x, y, width, height)
             print "     overlap query bbox: ({:10.7f}, {:11.7f}, {:10.7f}, {:11.7f}), tiles {}/{} - {}/{}: {}".format(
                     tile_geometry.bounding_box.min_y, tile_geometry.bounding_box.min_x,
                     tile_geometry.bounding_box.max_y, tile_geometry.bounding_box.max_x,
@@ -108,7 +195,7 @@ class PolygonTileGenCommand(TileGenCommand):
                     self.layer = Map.add_custom_layer()
                     self.layer.visible = True
                 # Create a polygon for the tile
-                tile_polygon = Polygon(tile_geometry)
+                tile_polygon = Polygon(self.tiles_linear_ring(zoom, x, y, width, height))
                 # Create a symbol for the tile
                 tile_symbol = PolygonSymbol("{}/{}/{} ({}x{} tiles)".format(
                     zoom, x, y, width, height), Srid.Wgs84LonLat)
@@ -122,23 +209,65 @@ class PolygonTileGenCommand(TileGenCommand):
                 tile_symbol.style.fill_opacity = 0
                 # Add the polygon to the layer
                 self.layer.add_symbol(tile_symbol.add(tile_polygon))
-        elif self.clean_tiles:
-            for xshift in xrange(width):
-                for yshift in xrange(height):
-                    self.clean_tile(zoom, x+xshift, y+yshift)
         return result
 
-    def clean_tile(self, zoom, x, y):
-        filename = "{}/{}/{}.png".format(zoom, x, y)
-        self.delete_tile(filename)
-        self.delete_tile(filename+".finger")
-        if self.tile_removal_script:
-            self.list_file.write("rm -f {}*\n".format(filename))
+    def tiles_overlapping_polygon(self, tiles):
+        """The subset of a TileSet of the tiles overlapping the polygon,
+        without the tiles excluded by zoom regions"""
+        if self.generation_polygon is None:
+            return self.remove_region_excluded_tiles(tiles.copy())
+        classifier = self.tile_classifier()
+        if tiles.zoom <= classifier.max_zoom and not self.visualize:
+            # Tiles inside the polygon are selected row by row,
+            # and only the boundary tiles are checked one by one
+            result = tiles & classifier.inside[tiles.zoom]
+            for (x, y) in tiles & classifier.boundary[tiles.zoom]:
+                if self.tiles_overlapps_polygon(tiles.zoom, x, y, 1, 1):
+                    result.add(x, y)
+            return self.remove_region_excluded_tiles(result)
+        result = TileSet(tiles.zoom, tiles.extent)
+        for (x, y) in tiles:
+            if self.tiles_overlapps_polygon(tiles.zoom, x, y, 1, 1):
+                result.add(x, y)
+        return result
+
+    def filter_super_tile(self, zoom, x, y, width, height):
+        """The generation filter, counting the rendered and skipped super-tiles"""
+        generate = self.generation_filter(zoom, x, y, width, height)
+        self.metrics.super_tile(zoom, width*height, generate)
+        return generate
+
+    def tile_saved(self, file_name):
+        """Count the tiles saved and their bytes"""
+        try:
+            size = os.path.getsize(file_name)
+        except OSError:
+            size = 0
+        self.metrics.tile_saved(size)
+
+    def after_save(self, file_name):
+        if self.sentinel_tile(file_name):
+            return
+        self.tile_saved(file_name)
+
+    def sentinel_tile(self, file_name):
+        """Replace a saved uniform tile of the sentinel colors by an entry of the sentinel index
 
-    def delete_tile(self, tilename):
-        filename = os.path.join(self.tiles_dir, tilename)
-        if os.path.exists(filename):
-            os.remove(filename)
+        Returns True if the tile file was removed.
+        """
+        if self.sentinels is None:
+            return False
+        with open(file_name, 'rb') as f:
+            data = f.read()
+        color = uniform_color(data)
+        (zoom, x, y) = tile_numbers(file_name)
+        if color is None or (self.sentinel_colors is not None and color not in self.sentinel_colors):
+            self.sentinels.discard(zoom, x, y)
+            return False
+        self.sentinels.add(zoom, x, y, color, data)
+        os.remove(file_name)
+        self.metrics.sentinel_tile()
+        return True
 
     def generation_filter (self, zoom, x, y, width, height):
         """Avoid generating tile batches outside the polygon"""
@@ -161,6 +290,7 @@ class PolygonTileGenCommand(TileGenCommand):
             bbox = LineSymbol("Generation filter Polygon", Srid.Wgs84LonLat, [args[0]]).bounding_box
             cmd = TileGenCommand.__new__(cls, bbox, args[1], args[2])
             cmd.generation_polygon = args[0]
+            cmd.classification_zoom = args[2]
         else:
             # Also allow construction with TileGenCommand's original parameters.
             cmd = TileGenCommand.__new__(cls, *args)
@@ -169,12 +299,14 @@ class PolygonTileGenCommand(TileGenCommand):
 
     def execute(self):
         self._progress_zoom = None
+        self.metrics.start(tiles_dir=self.tiles_dir, min_zoom=self.min_zoom, max_zoom=self.max_zoom)
         try:
             TileGenCommand.execute(self)
         except BaseException as e:
             print "Exception during TileGenCommand.execute():", e
             if str(e) <> "ValueError: An item with the same key has already been added.":
                 raise
+        self.metrics.end_zoom()
 
     def _progress_update(self, zoom, size):
         if self._progress_zoom <> zoom:
@@ -185,22 +317,33 @@ class PolygonTileGenCommand(TileGenCommand):
             self._progress_count = 0
             self._progress_last_report = 0
             self._progress_report_step = max(1000, self._progress_target/10.0)
+            self.metrics.start_zoom(zoom)
         if self._progress_count - self._progress_last_report > self._progress_report_step:
             print "     Scanned {}% of zoom {}".format(
                 self._progress_count*100//self._progress_target, zoom)
+            self.metrics.progress(zoom, self._progress_count, self._progress_target)
             self._progress_last_report = self._progress_count
         self._progress_count += size
 
     def __init__(self):
         # Derived classes can overide the save_filter and generation_filter methods
         self.tile_save_filter = self.save_filter
-        self.tile_generation_filter = self.generation_filter
+        self.tile_generation_filter = self.filter_super_tile
+        self.after_tile_save = self.after_save
         self.visualize = False  # Show polygon, generated and saved areas on the map?
         self.layer = None
         self.verbose = False  # Show tile generation progress?
-        self.clean_tiles = False  # Remove all skipped tiles?
+        self.clean_tiles = False  # Remove the tiles outside the polygon after generation?
         self.tile_removal_script = 'Output\\rm_tiles.sh'  # Optional: tile removal script name
-        self.list_file = open(os.devnull, 'w')
+        self.classifier = None  # Tile classification against the polygon, see tile_classifier()
+        self.prepared = None  # Indexed polygon, see prepared_polygon()
+        self.polygon_cache_dir = 'Cache'  # Location of the cached tile classification
+        self.zoom_regions = []  # [(coords, min_zoom, max_zoom), ...], see add_zoom_region()
+        self.region_classifiers = None  # Tile classification against the zoom regions
+        self.metrics = RenderMetrics()  # Throughput metrics, written to the metrics file if given one
+        self.tiles_dir = None
+        self.sentinel_colors = ()  # Colors of uniform tiles kept in a SentinelIndex, None for all colors
+        self.sentinels = None  # The SentinelIndex of the tiles directory during generation
 
 def pretty_timer(prefix, timer):
     days = timer // 3600*24
@@ -0,0 +1,126 @@
+"""Throughput metrics of tile generation and change analysis, as JSON lines
+
+Each line of the metrics file is a JSON object with the "time" (UTC) and "event"
+of a record, the context given to start(), such as the tiles directory, and:
+- "progress": the tiles of a zoom level scanned so far, and the zoom's target,
+  tiles scanned per second and ETA in seconds
+- "zoom": the super-tiles considered by the generation filter of a zoom level,
+  rendered and skipped, the tiles saved, bytes written, and tiles per second,
+  and the uniform tiles kept in the sentinel index instead
+- "generation": the totals of a tile generation
+- "analysis": the elements of a change analysis and the tiles it marked
+
+The file is appended to, so consecutive runs can be compared.
+
+Usage:
+    metrics = RenderMetrics("render-metrics.jsonl")
+    metrics.start(tiles_dir="Site/Tiles")
+    metrics.super_tile(zoom, width*height, rendered)
+    metrics.tile_saved(bytes)
+    metrics.finish()
+"""
+
+import json
+import time
+import threading
+from datetime import datetime
+
+class RenderMetrics(object):
+    def __init__(self, filename=None):
+        """filename - the JSON lines file, or None to collect metrics without writing them"""
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.context = {}
+        self.zoom = None
+        self.start_time = time.time()
+        self.zoom_start_time = self.start_time
+        self.totals = new_counters()
+        self.counters = new_counters()
+
+    def record(self, event, **fields):
+        """Append a record to the metrics file"""
+        if not self.filename:
+            return
+        record = {"time": datetime.utcnow().isoformat()+"Z", "event": event}
+        record.update(self.context)
+        record.update(fields)
+        with open(self.filename, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True)+"\n")
+
+    def analysis(self, **fields):
+        """Record a change analysis, which precedes tile generation"""
+        self.context = {}
+        self.record("analysis", **fields)
+
+    def start(self, **context):
+        """Start collecting the metrics of a tile generation, with context fields of its records"""
+        self.context = context
+        self.zoom = None
+        self.start_time = time.time()
+        self.totals = new_counters()
+
+    def start_zoom(self, zoom):
+        """Start the super-tiles of a zoom level, ending the previous zoom level"""
+        self.end_zoom()
+        self.zoom = zoom
+        self.zoom_start_time = time.time()
+        self.counters = new_counters()
+
+    def end_zoom(self):
+        if self.zoom is None:
+            return
+        seconds = time.time() - self.zoom_start_time
+        self.record("zoom", zoom=self.zoom, seconds=round(seconds, 3),
+                tiles_per_second=rate(self.counters["tiles_saved"], seconds),
+                **self.counters)
+        for key in self.totals:
+            self.totals[key] += self.counters[key]
+        self.zoom = None
+
+    def super_tile(self, zoom, size, rendered):
+        """Count a super-tile of size tiles, rendered or skipped by the generation filter"""
+        if zoom != self.zoom:
+            self.start_zoom(zoom)
+        self.counters["super_tiles"] += 1
+        self.counters["rendered" if rendered else "skipped"] += 1
+        self.counters["rendered_tiles" if rendered else "skipped_tiles"] += size
+
+    def tile_saved(self, size):
+        """Count a tile of size bytes written to disk"""
+        with self.lock:
+            self.counters["tiles_saved"] += 1
+            self.counters["bytes"] += size
+
+    def sentinel_tile(self):
+        """Count a uniform tile kept in the sentinel index instead of a tile file"""
+        with self.lock:
+            self.counters["sentinel_tiles"] += 1
+
+    def progress(self, zoom, scanned, target):
+        """Record the progress of scanning the tiles of a zoom level"""
+        seconds = time.time() - self.zoom_start_time
+        scanned_per_second = rate(scanned, seconds)
+        self.record("progress", zoom=zoom, scanned=scanned, target=target,
+                seconds=round(seconds, 3), scanned_per_second=scanned_per_second,
+                eta_seconds=round((target-scanned)/scanned_per_second) if scanned_per_second else None)
+
+    def finish(self, **fields):
+        """Record the totals of a tile generation, returns them"""
+        self.end_zoom()
+        seconds = time.time() - self.start_time
+        totals = dict(self.totals)
+        totals.update(fields)
+        self.record("generation", seconds=round(seconds, 3),
+                tiles_per_second=rate(self.totals["tiles_saved"], seconds), **totals)
+        return totals
+
+def new_counters():
+    return {key: 0 for key in ("super_tiles", "rendered", "skipped",
+        "rendered_tiles", "skipped_tiles", "tiles_saved", "bytes", "sentinel_tiles")}
+
+def rate(count, seconds):
+    if seconds <= 0:
+        return None
+    return round(count/seconds, 2)
+
+# vim: set shiftwidth=4 expandtab textwidth=0:
@@ -0,0 +1,201 @@
+"""The OSM tags read by Maperitive rulesets
+
+A ruleset's tags are collected from:
+- The conditions of features, such as "peak : natural=peak"
+- The for and elsefor conditions of rules
+- The text property of rules, such as "text : ref"
+- The tags read by import-script functions, such as hasTag('name:he') in names.py
+- The tags read by other scripts adding computed tags, such as AddOsmTags.py, see read_script()
+
+A tag key is either:
+- Compared only with given values, such as "natural=peak" or "@isOneOf(natural, peak, spring)".
+  A change of its value matters only if the old or the new value is one of these values.
+- Otherwise read, such as "place", "name", "@isMatch(name:en, ...)" or "ele != 0".
+  Any change of its value matters.
+
+Usage from the command line, printing the tags of rulesets:
+    python RulesetTags.py <ruleset> ...
+"""
+
+import os
+import re
+import sys
+
+# Keys affecting the geometry or the layering of all rulesets
+GEOMETRY_KEYS = ("area", "type", "layer")
+
+TOKEN = re.compile(r'"[^"]*"|!=|<=|>=|[=<>()\[\],]|[^\s=!<>()\[\],"]+')
+OPERATORS = ("=", "!=", "<", ">", "<=", ">=")
+KEYWORDS = ("AND", "OR", "NOT")
+SCRIPT_CALLS = re.compile(r"""\b(?:has_?[tT]ag|get_?[tT]ag)\(([^()]*)\)""")
+SCRIPT_ITEMS = re.compile(r"""\[\s*['"]([^'"]+)['"]\s*\]""")
+SCRIPT_LOOPS = re.compile(r"""\bfor\s+(\w+)\s+in\s+[(\[]([^()\[\]]*)[)\]]""")
+STRING = re.compile(r"""^\s*(?:'([^']*)'|"([^"]*)")\s*$""")
+
+def unquote(token):
+    if token.startswith('"'):
+        return token[1:-1]
+    return token
+
+def string_literal(argument):
+    """The value of a quoted string argument of a script, or None"""
+    match = STRING.match(argument)
+    if not match:
+        return None
+    return match.group(1) if match.group(1) is not None else match.group(2)
+
+def is_number(token):
+    try:
+        float(token)
+        return True
+    except ValueError:
+        return False
+
+class RulesetTags(object):
+    def __init__(self, *rulesets):
+        """Collect the tags of Maperitive ruleset files"""
+        self.keys = set(GEOMETRY_KEYS)  # Keys whose every change matters
+        self.values = {}  # {key: set of values} of keys compared only with values
+        self.all_keys = False  # Does every change matter, as a script reads tags not known in advance?
+        for ruleset in rulesets:
+            self.read(ruleset)
+
+    def read(self, filename):
+        section = None
+        with open(filename) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("//"):
+                    continue
+                if line.startswith("import-script"):
+                    script = line.split(":", 1)[1].strip().replace("\\", os.sep)
+                    self.read_script(os.path.join(os.path.dirname(filename), script))
+                elif line in ("features", "properties", "rules"):
+                    section = line
+                elif ":" in line:
+                    (name, value) = (part.strip() for part in line.split(":", 1))
+                    if section == "features":
+                        self.read_condition(value)
+                    elif section == "rules" and name in ("for", "elsefor"):
+                        self.read_condition(value)
+                    elif section == "rules" and name == "text":
+                        self.read_condition(value)
+
+    def read_script(self, filename):
+        """Tags read by a Python script, such as hasTag('name'), get_tag("name"),
+        set['name'], or has_tag("natural", "ridge")
+
+        A tag key can also be a loop variable over literal keys, such as
+        has_tag(osmTag) inside 'for osmTag in ("boundary", "leisure"):'.
+        Any other key that is not a literal string makes every change matter.
+        """
+        if not os.path.exists(filename):
+            return
+        with open(filename) as f:
+            script = f.read()
+        self.keys.update(SCRIPT_ITEMS.findall(script))
+        loop_keys = {}
+        for (name, items) in SCRIPT_LOOPS.findall(script):
+            keys = [string_literal(item) for item in items.split(",") if item.strip()]
+            if keys and None not in keys:
+                loop_keys.setdefault(name, set()).update(keys)
+        for arguments in SCRIPT_CALLS.findall(script):
+            arguments = [argument.strip() for argument in arguments.split(",")]
+            key = string_literal(arguments[0])
+            if key is not None:
+                keys = [key]
+            elif arguments[0] in loop_keys:
+                keys = loop_keys[arguments[0]]
+            else:
+                self.all_keys = True
+                continue
+            value = string_literal(arguments[1]) if len(arguments) > 1 else None
+            for key in keys:
+                if value is None:
+                    self.keys.add(key)
+                else:
+                    self.add_value(key, value)
+
+    def read_condition(self, condition):
+        tokens = TOKEN.findall(condition)
+        i = 0
+        while i < len(tokens):
+            token = tokens[i]
+            following = tokens[i+1] if i+1 < len(tokens) else None
+            if token in ("(", ")", "[", "]", ",") or token.upper() in KEYWORDS:
+                i += 1
+            elif token.startswith("@"):
+                i = self.read_function(token, tokens, i+1)
+            elif following == "[":
+                # A selector such as node[...] or relation[...].way[...]
+                i += 1
+            elif following in OPERATORS:
+                key = unquote(token)
+                if following == "=" and i+2 < len(tokens):
+                    self.add_value(key, unquote(tokens[i+2]))
+                else:
+                    self.keys.add(key)
+                i += 3
+            else:
+                # Tag existence, or the value of a tag
+                self.keys.add(unquote(token))
+                i += 1
+
+    def read_function(self, function, tokens, i):
+        """Read the arguments of a function, return the index of the following token"""
+        if i >= len(tokens) or tokens[i] != "(":
+            return i
+        depth = 0
+        arguments = []
+        while i < len(tokens):
+            if tokens[i] in ("(", "["):
+                depth += 1
+            elif tokens[i] in (")", "]"):
+                depth -= 1
+                if depth == 0:
+                    i += 1
+                    break
+            elif tokens[i] != ",":
+                arguments.append(tokens[i])
+            i += 1
+        if function.lower() == "@isoneof" and arguments:
+            for value in arguments[1:]:
+                self.add_value(unquote(arguments[0]), unquote(value))
+        else:
+            # Unquoted arguments other than numbers are keys
+            self.keys.update(argument for argument in arguments
+                    if not argument.startswith('"') and not is_number(argument))
+        return i
+
+    def add_value(self, key, value):
+        self.values.setdefault(key, set()).add(value)
+
+    def changed(self, old_tags, new_tags):
+        """Did a change of tags change any tag read by the rulesets?"""
+        if self.all_keys:
+            return old_tags != new_tags
+        for key in set(old_tags) | set(new_tags):
+            (old_value, new_value) = (old_tags.get(key), new_tags.get(key))
+            if old_value == new_value:
+                continue
+            if key in self.keys:
+                return True
+            values = self.values.get(key)
+            if values and (old_value in values or new_value in values):
+                return True
+        return False
+
+    def __repr__(self):
+        if self.all_keys:
+            return "RulesetTags(all keys)"
+        return "RulesetTags({} keys, {} compared keys)".format(
+                len(self.keys), len(set(self.values) - self.keys))
+
+if __name__ == "__main__":
+    ruleset_tags = RulesetTags(*sys.argv[1:])
+    for key in sorted(ruleset_tags.keys):
+        print key
+    for key in sorted(set(ruleset_tags.values) - ruleset_tags.keys):
+        print "{}={}".format(key, "|".join(sorted(ruleset_tags.values[key])))
+
+# vim: set shiftwidth=4 expandtab textwidth=0:
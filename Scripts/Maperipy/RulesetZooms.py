@@ -0,0 +1,357 @@
+"""The minimal zoom levels at which Maperitive rulesets draw OSM elements
+
+An element is drawn by the rules of each feature whose condition it matches,
+such as "peak : natural=peak" drawn by "target : peak". The minimal zoom of a
+feature is the lowest min-zoom in effect at any draw command of its targets.
+The rules are followed per feature:
+- "if" conditions test the feature name, and are followed exactly
+- "for" conditions test tags, and are followed exactly when they can be
+  evaluated, otherwise every possible branch is followed
+- A draw without any min-zoom definition draws from zoom 0
+
+The evaluation is conservative, and a condition that cannot be evaluated may match:
+- Tags computed by scripts, such as length and width of AddOsmTags.py, see read_script()
+- Selectors of parent relations, such as relation[network=nwn].way, when the
+  parent relations are unknown
+- Unknown functions
+Point features are also matched by ways and relations, as their labels can be points.
+
+Usage from the command line, printing the minimal zoom of an element without parent relations:
+    python RulesetZooms.py <ruleset> ... -- <element type> <key>=<value> ...
+"""
+
+import os
+import re
+import sys
+import math
+import fnmatch
+from RulesetTags import TOKEN, OPERATORS, unquote, is_number
+
+GROUP_TYPES = {
+        "points": ("node", "way", "relation"),
+        "lines": ("way", "relation"),
+        "areas": ("way", "relation")}
+SCRIPT_SET_TAGS = re.compile(r"""set_?[tT]ag\(\s*['"]([^'"]+)['"]""")
+
+def all_of(values):
+    """Three-valued AND of True, False, and None (unknown)"""
+    if False in values:
+        return False
+    if None in values:
+        return None
+    return True
+
+def any_of(values):
+    """Three-valued OR of True, False, and None (unknown)"""
+    if True in values:
+        return True
+    if None in values:
+        return None
+    return False
+
+def number(value):
+    if value is not None and is_number(value):
+        return float(value)
+    return None
+
+class RulesetZooms(object):
+    def __init__(self, *rulesets):
+        """Read the features and rules of Maperitive ruleset files"""
+        # [(features, targets), ...] of each ruleset, where
+        # features are [(name, element types, condition), ...] and
+        # targets are [(name pattern, statements), ...]
+        self.rulesets = []
+        self.computed_keys = set()  # Keys of tags computed by scripts
+        self.conditions = {}  # Parsed conditions of rules
+        self.cache = {}
+        for ruleset in rulesets:
+            self.read(ruleset)
+
+    def read(self, filename):
+        (features, targets) = ([], [])
+        self.rulesets.append((features, targets))
+        section = None
+        groups = ()
+        statements = None
+        stack = []
+        with open(filename) as f:
+            for line in f:
+                indent = len(line.expandtabs(4)) - len(line.expandtabs(4).lstrip())
+                line = line.strip()
+                if not line or line.startswith("//"):
+                    continue
+                if line.startswith("import-script"):
+                    script = line.split(":", 1)[1].strip().replace("\\", os.sep)
+                    self.read_script(os.path.join(os.path.dirname(filename), script))
+                elif line in ("features", "properties", "rules"):
+                    section = line
+                elif section == "features":
+                    if ":" in line:
+                        (name, condition) = (part.strip() for part in line.split(":", 1))
+                        features.append((name.lower(), groups, self.parse_condition(condition)))
+                    else:
+                        groups = tuple(set(element_type for group in line.split(",")
+                                for element_type in GROUP_TYPES.get(group.strip(), ())))
+                elif section == "rules":
+                    (name, value) = (part.strip() for part in (line.split(":", 1) + [""])[:2])
+                    if name == "target":
+                        statements = []
+                        targets.append((value.lower(), statements))
+                        stack = [(indent, statements)]
+                        continue
+                    if statements is None:
+                        continue
+                    while len(stack) > 1 and stack[-1][0] >= indent:
+                        stack.pop()
+                    statement = (name, value, [])
+                    stack[-1][1].append(statement)
+                    stack.append((indent, statement[2]))
+
+    def read_script(self, filename):
+        """Tags set by a Python script, such as set_tag("length", ...)"""
+        if not os.path.exists(filename):
+            return
+        with open(filename) as f:
+            self.computed_keys.update(SCRIPT_SET_TAGS.findall(f.read()))
+
+    def parse_condition(self, condition):
+        """The syntax tree of a condition, or None if it cannot be parsed"""
+        tokens = TOKEN.findall(condition)
+        try:
+            (tree, i) = self.parse_or(tokens, 0)
+        except IndexError:
+            return None
+        return tree if i == len(tokens) else None
+
+    def parse_or(self, tokens, i):
+        (tree, i) = self.parse_and(tokens, i)
+        items = [tree]
+        while i < len(tokens) and tokens[i].upper() == "OR":
+            (tree, i) = self.parse_and(tokens, i+1)
+            items.append(tree)
+        return (("or", items) if len(items) > 1 else items[0], i)
+
+    def parse_and(self, tokens, i):
+        (tree, i) = self.parse_not(tokens, i)
+        items = [tree]
+        # Conditions are also joined by juxtaposition, such as "network = rwn @isMatch(...)"
+        while i < len(tokens) and tokens[i] not in (")", "]", ",") and tokens[i].upper() != "OR":
+            if tokens[i].upper() == "AND":
+                i += 1
+            (tree, i) = self.parse_not(tokens, i)
+            items.append(tree)
+        return (("and", items) if len(items) > 1 else items[0], i)
+
+    def parse_not(self, tokens, i):
+        if tokens[i].upper() == "NOT":
+            (tree, i) = self.parse_not(tokens, i+1)
+            return (("not", tree), i)
+        return self.parse_primary(tokens, i)
+
+    def parse_primary(self, tokens, i):
+        token = tokens[i]
+        following = tokens[i+1] if i+1 < len(tokens) else None
+        if token == "(":
+            (tree, i) = self.parse_or(tokens, i+1)
+            if tokens[i] != ")":
+                raise IndexError(i)
+            return (tree, i+1)
+        if token.startswith("@"):
+            arguments = []
+            i += 1
+            if following == "(":
+                depth = 0
+                while True:
+                    if tokens[i] == "(":
+                        depth += 1
+                    elif tokens[i] == ")":
+                        depth -= 1
+                        if depth == 0:
+                            break
+                    elif tokens[i] != ",":
+                        arguments.append(unquote(tokens[i]))
+                    i += 1
+                i += 1
+            return (("function", token[1:].lower(), arguments), i)
+        if following == "[":
+            # A selector such as node[...] or relation[...].way[...]
+            (condition, i) = self.parse_or(tokens, i+2)
+            if tokens[i] != "]":
+                raise IndexError(i)
+            i += 1
+            member = None
+            if i+1 < len(tokens) and tokens[i].startswith(".") and tokens[i+1] == "[":
+                (member, i) = self.parse_primary(tokens, i)
+                member = (member[1][1:], member[2])
+            return (("select", token.lower(), condition, member), i)
+        if following in OPERATORS and i+2 < len(tokens):
+            return (("compare", unquote(token), following, unquote(tokens[i+2])), i+3)
+        return (("exists", unquote(token)), i+1)
+
+    def evaluate(self, tree, element_type, tags, parents):
+        """True, False, or None if unknown
+
+        parents - the tags of the element's parent relations, or None if unknown
+        """
+        if tree is None:
+            return None
+        kind = tree[0]
+        if kind == "and":
+            return all_of([self.evaluate(item, element_type, tags, parents) for item in tree[1]])
+        if kind == "or":
+            return any_of([self.evaluate(item, element_type, tags, parents) for item in tree[1]])
+        if kind == "not":
+            result = self.evaluate(tree[1], element_type, tags, parents)
+            return None if result is None else not result
+        if kind == "select":
+            return self.evaluate_selector(tree, element_type, tags, parents)
+        key = tree[2][0] if kind == "function" and tree[2] else tree[1]
+        if key in self.computed_keys:
+            return None
+        if kind == "exists":
+            return key in tags
+        if kind == "compare":
+            (operator, value) = tree[2:]
+            if operator == "=":
+                return tags.get(key) == value
+            if key not in tags:
+                return None
+            if operator == "!=":
+                return tags[key] != value
+            (left, right) = (number(tags[key]), number(value))
+            if left is None or right is None:
+                return None
+            return {"<": left < right, ">": left > right,
+                    "<=": left <= right, ">=": left >= right}[operator]
+        # A function
+        (function, arguments) = tree[1:]
+        if not arguments:
+            return None
+        value = tags.get(key)
+        if function == "isoneof":
+            return value in arguments[1:]
+        if function == "ismatch" and len(arguments) > 1:
+            if value is None:
+                return False
+            try:
+                return re.search(arguments[1], value) is not None
+            except re.error:
+                return None
+        if function == "ismulti" and len(arguments) > 1:
+            (value, divisor) = (number(value), number(arguments[1]))
+            if value is None or not divisor:
+                return None if key in tags else False
+            return value % divisor == 0
+        return None
+
+    def evaluate_selector(self, tree, element_type, tags, parents):
+        (selected_type, condition, member) = tree[1:]
+        if selected_type in ("node", "way", "area"):
+            if selected_type != element_type and (selected_type != "area" or element_type == "node"):
+                return False
+            return self.evaluate(condition, element_type, tags, parents)
+        if selected_type != "relation":
+            # Such as contour lines, which are not OSM elements
+            return False
+        if element_type == "relation":
+            return self.evaluate(condition, element_type, tags, parents)
+        if member is None or element_type != member[0]:
+            return False
+        member_result = self.evaluate(member[1], element_type, tags, parents)
+        if parents is None:
+            return all_of([None, member_result])
+        return all_of([member_result, any_of([self.evaluate(condition, "relation", parent_tags, None)
+                for parent_tags in parents])])
+
+    def min_zoom(self, element_type, tags, parents=None):
+        """The minimal zoom at which an element is drawn, or None if it is not drawn
+
+        parents - the tags of the element's parent relations, or None if unknown
+        """
+        key = (element_type, tuple(sorted(tags.items())),
+                None if parents is None else tuple(tuple(sorted(parent.items())) for parent in parents))
+        if key not in self.cache:
+            zooms = [self.tags_min_zoom(element_type, tags, parents)]
+            # Tags copied from parent relations by scripts, such as multipolygon names
+            for parent_tags in parents or []:
+                inherited = dict(parent_tags)
+                inherited.update(tags)
+                zooms.append(self.tags_min_zoom(element_type, inherited, parents))
+            zooms = [zoom for zoom in zooms if zoom is not None]
+            self.cache[key] = min(zooms) if zooms else None
+        return self.cache[key]
+
+    def tags_min_zoom(self, element_type, tags, parents):
+        zooms = []
+        for (features, targets) in self.rulesets:
+            for (name, element_types, condition) in features:
+                if element_type not in element_types:
+                    continue
+                if self.evaluate(condition, element_type, tags, parents) is False:
+                    continue
+                for (pattern, statements) in targets:
+                    if fnmatch.fnmatchcase(name, pattern):
+                        (states, draws) = self.follow(
+                                statements, set([None]), name, element_type, tags, parents)
+                        zooms.extend(0 if zoom is None else int(math.ceil(zoom)) for zoom in draws)
+        return min(zooms) if zooms else None
+
+    def follow(self, statements, states, name, element_type, tags, parents):
+        """Follow the statements of a target for a feature
+
+        states - the possible min-zoom values in effect, None for undefined
+        Return the states after the statements and the min-zoom values of the draw commands.
+        """
+        draws = set()
+        i = 0
+        while i < len(statements) and states:
+            (statement, value, children) = statements[i]
+            i += 1
+            if statement == "define":
+                for (property_name, property_value, grandchildren) in children:
+                    if property_name == "min-zoom" and is_number(property_value):
+                        states = set([float(property_value)])
+            elif statement == "draw":
+                draws.update(states)
+            elif statement == "stop":
+                states = set()
+            elif statement in ("if", "for"):
+                branches = [(statement, value, children)]
+                continuations = ("elseif", "else") if statement == "if" else ("elsefor", "else")
+                while i < len(statements) and statements[i][0] in continuations:
+                    branches.append(statements[i])
+                    i += 1
+                    if branches[-1][0] == "else":
+                        break
+                remaining = states
+                states = set()
+                for (branch, condition, branch_statements) in branches:
+                    if branch == "else":
+                        matched = True
+                    elif statement == "if":
+                        matched = any(fnmatch.fnmatchcase(name, pattern.strip().lower())
+                                for pattern in re.split(r"\s+OR\s+", condition))
+                    else:
+                        if condition not in self.conditions:
+                            self.conditions[condition] = self.parse_condition(condition)
+                        matched = self.evaluate(self.conditions[condition], element_type, tags, parents)
+                    if matched is False:
+                        continue
+                    (branch_states, branch_draws) = self.follow(
+                            branch_statements, remaining, name, element_type, tags, parents)
+                    states.update(branch_states)
+                    draws.update(branch_draws)
+                    if matched:
+                        remaining = set()
+                        break
+                states.update(remaining)
+        return (states, draws)
+
+if __name__ == "__main__":
+    separator = sys.argv.index("--")
+    ruleset_zooms = RulesetZooms(*sys.argv[1:separator])
+    element_type = sys.argv[separator+1]
+    tags = dict(argument.split("=", 1) for argument in sys.argv[separator+2:])
+    print ruleset_zooms.min_zoom(element_type, tags, [])
+
+# vim: set shiftwidth=4 expandtab textwidth=0:
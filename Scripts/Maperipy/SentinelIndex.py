@@ -0,0 +1,271 @@
+"""Sentinel tiles: uniform tiles kept in a sparse index instead of tile files
+
+A uniform tile has a single color, such as a fully transparent overlay tile.
+uniform_color() detects such tiles exactly, by decoding the tile's PNG image
+data, rather than by a heuristic of the tile file's size.
+
+The uniform tiles of a tiles directory are listed in a directory next to it,
+such as Site/OverlayTiles.sentinels, with for each color:
+- <color>.png: a shared sentinel tile of the color
+- <color>.tiles: a manifest of the tiles of the color, and its compact binary
+  variant <color>.tiles.bin, see TileManifest
+
+Colors are "rrggbbaa" hex strings, and all fully transparent tiles share the
+color TRANSPARENT.
+
+Consumers of the tiles answer the listed tiles with the sentinel tile, or by a
+background color for transparent tiles, as do the Leaflet overlays and the
+Mobile Atlas Creator map sources (backgroundColor #00000000). The upload and zip
+scripts package only tile files, so the tiles of other colors are not packaged,
+unless written back as tile files from the command line.
+
+Usage:
+    sentinels = SentinelIndex(sentinel_dir(tiles_dir))
+    color = uniform_color(data)
+    if color == TRANSPARENT:
+        sentinels.add(zoom, x, y, color, data)
+    sentinels.close()
+
+Usage from the command line, writing the sentinel tiles of a tiles directory as
+tile files, such as into a target tiles directory to be packaged by hand:
+    python SentinelIndex.py <tiles directory> [<target tiles directory>]
+"""
+
+import os
+import sys
+import struct
+import shutil
+import threading
+import zlib
+from PngText import png_chunks
+from FileUtils import replace_file
+from TileManifest import write_manifest, read_manifest
+
+TRANSPARENT = "00000000"
+
+# Number of samples of each PNG color type
+CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+class SentinelIndex(object):
+    def __init__(self, directory):
+        """directory - the index directory, see sentinel_dir()"""
+        self.directory = directory
+        self.lock = threading.Lock()  # Tiles may be saved by several threads
+        self.tiles = None  # {color: {zoom: set of (x, y)}}
+        self.changed = set()  # Colors whose manifests should be written
+
+    def load(self):
+        self.tiles = {}
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.endswith(".tiles.bin"):
+                color = name[:-len(".tiles.bin")]
+                tiles = self.tiles[color] = {}
+                for (zoom, x, y) in read_manifest(os.path.join(self.directory, name)):
+                    tiles.setdefault(zoom, set()).add((x, y))
+
+    def sentinel_tile(self, color):
+        """The file name of the shared sentinel tile of a color"""
+        return os.path.join(self.directory, color+".png")
+
+    def manifest(self, color):
+        return os.path.join(self.directory, color+".tiles")
+
+    def color(self, zoom, x, y):
+        """The color of a sentinel tile, or None"""
+        with self.lock:
+            if self.tiles is None:
+                self.load()
+            for color in self.tiles:
+                if (x, y) in self.tiles[color].get(zoom, ()):
+                    return color
+        return None
+
+    def add(self, zoom, x, y, color, data):
+        """Record a uniform tile of a color, with the content of its PNG file"""
+        with self.lock:
+            if self.tiles is None:
+                self.load()
+            if not os.path.exists(self.sentinel_tile(color)):
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                with open(self.sentinel_tile(color)+".tmp", 'wb') as f:
+                    f.write(data)
+                replace_file(self.sentinel_tile(color)+".tmp", self.sentinel_tile(color))
+            for other in self.tiles:
+                if other != color:
+                    self._discard(other, zoom, x, y)
+            tiles = self.tiles.setdefault(color, {}).setdefault(zoom, set())
+            if (x, y) not in tiles:
+                tiles.add((x, y))
+                self.changed.add(color)
+
+    def discard(self, zoom, x, y):
+        """Remove a tile that is no longer uniform"""
+        with self.lock:
+            if self.tiles is None:
+                self.load()
+            for color in self.tiles:
+                self._discard(color, zoom, x, y)
+
+    def _discard(self, color, zoom, x, y):
+        tiles = self.tiles[color].get(zoom)
+        if tiles and (x, y) in tiles:
+            tiles.remove((x, y))
+            self.changed.add(color)
+
+    def __iter__(self):
+        """Generate the (zoom, x, y, color) of the sentinel tiles"""
+        if self.tiles is None:
+            self.load()
+        for color in sorted(self.tiles):
+            for zoom in sorted(self.tiles[color]):
+                for (x, y) in sorted(self.tiles[color][zoom]):
+                    yield (zoom, x, y, color)
+
+    def close(self):
+        """Write the manifests of the changed colors"""
+        with self.lock:
+            for color in self.changed:
+                write_manifest(self.manifest(color), self.tiles[color])
+            self.changed = set()
+
+def sentinel_dir(tiles_dir):
+    """The sentinel index of a tiles directory"""
+    return os.path.normpath(tiles_dir) + ".sentinels"
+
+def tile_numbers(file_name):
+    """(zoom, x, y) of a zoom/x/y.png tile file name"""
+    (x_dir, name) = os.path.split(file_name)
+    (zoom_dir, x) = os.path.split(x_dir)
+    return (int(os.path.basename(zoom_dir)), int(x), int(name.split(".", 1)[0]))
+
+def uniform_color(data):
+    """The color of a PNG image of a single color, or None
+
+    Colors are "rrggbbaa" hex strings, with 4 hex digits per sample in 16 bit
+    images, and TRANSPARENT for all fully transparent images.
+    Only non-interlaced images of 8 or 16 bit samples are detected.
+    """
+    header = None
+    palette = ""
+    transparency = None
+    image_data = []
+    for (chunk_type, chunk_data, chunk) in png_chunks(data):
+        if chunk_type == "IHDR":
+            header = struct.unpack(">IIBBBBB", chunk_data)
+        elif chunk_type == "PLTE":
+            palette = chunk_data
+        elif chunk_type == "tRNS":
+            transparency = chunk_data
+        elif chunk_type == "IDAT":
+            image_data.append(chunk_data)
+    (width, height, depth, color_type, compression, filter_method, interlace) = header
+    if depth not in (8, 16) or interlace or color_type not in CHANNELS:
+        return None
+    pixel_size = CHANNELS[color_type]*depth//8
+    row_size = 1 + width*pixel_size
+    image = zlib.decompress("".join(image_data))
+    if len(image) < height*row_size or ord(image[0]) > 4:
+        return None
+    # With every filter type, the first pixel of the first row is stored as is
+    pixel = image[1:1+pixel_size]
+    row = pixel*width
+    # Each row of the image is that row, if it is stored as that row filtered
+    # by its filter type, against a zero previous row for the first row
+    filtered_rows = {}
+    previous = "\0"*len(row)
+    for row_start in xrange(0, height*row_size, row_size):
+        filter_type = ord(image[row_start])
+        key = (filter_type, row_start == 0)
+        if key not in filtered_rows:
+            if filter_type > 4:
+                return None
+            filtered_rows[key] = filter_row(filter_type, row, previous, pixel_size)
+        if image[row_start+1:row_start+row_size] != filtered_rows[key]:
+            return None
+        previous = row
+    return pixel_color(pixel, depth, color_type, palette, transparency)
+
+def filter_row(filter_type, row, previous, pixel_size):
+    """A row of samples filtered by a PNG filter type, given the previous row"""
+    result = bytearray(len(row))
+    row = bytearray(row)
+    previous = bytearray(previous)
+    for i in xrange(len(row)):
+        a = row[i-pixel_size] if i >= pixel_size else 0
+        b = previous[i]
+        c = previous[i-pixel_size] if i >= pixel_size else 0
+        if filter_type == 0:
+            predictor = 0
+        elif filter_type == 1:
+            predictor = a
+        elif filter_type == 2:
+            predictor = b
+        elif filter_type == 3:
+            predictor = (a + b)//2
+        else:
+            predictor = paeth(a, b, c)
+        result[i] = (row[i] - predictor) & 0xFF
+    return str(result)
+
+def paeth(a, b, c):
+    p = a + b - c
+    (pa, pb, pc) = (abs(p - a), abs(p - b), abs(p - c))
+    if pa <= pb and pa <= pc:
+        return a
+    if pb <= pc:
+        return b
+    return c
+
+def pixel_color(pixel, depth, color_type, palette, transparency):
+    """The "rrggbbaa" color of a pixel's samples"""
+    sample_size = depth//8
+    samples = [int(pixel[i:i+sample_size].encode("hex"), 16) for i in xrange(0, len(pixel), sample_size)]
+    opaque = (1 << depth) - 1
+    if color_type == 3:
+        index = samples[0]
+        if 3*index+3 > len(palette):
+            return None
+        samples = [ord(sample) for sample in palette[3*index:3*index+3]]
+        alpha = ord(transparency[index]) if transparency and index < len(transparency) else 0xFF
+        samples.append(alpha)
+        sample_size = 1
+    elif color_type in (0, 2):
+        # tRNS holds a single transparent gray or RGB value, of 16 bits per sample
+        transparent = transparency is not None and transparency == "".join(
+                struct.pack(">H", sample) for sample in samples)
+        if color_type == 0:
+            samples = samples*3
+        samples.append(0 if transparent else opaque)
+    elif color_type == 4:
+        samples = samples[0:1]*3 + samples[1:2]
+    if samples[3] == 0:
+        return TRANSPARENT
+    return "".join("{:0{}x}".format(sample, 2*sample_size) for sample in samples)
+
+def write_sentinel_tiles(tiles_dir, target_dir=None):
+    """Write the sentinel tiles of a tiles directory as tile files, linked to the sentinel tiles"""
+    sentinels = SentinelIndex(sentinel_dir(tiles_dir))
+    count = 0
+    for (zoom, x, y, color) in sentinels:
+        x_dir = os.path.join(target_dir or tiles_dir, str(zoom), str(x))
+        filename = os.path.join(x_dir, "{}.png".format(y))
+        if os.path.exists(filename):
+            continue
+        if not os.path.isdir(x_dir):
+            os.makedirs(x_dir)
+        try:
+            os.link(sentinels.sentinel_tile(color), filename)
+        except (AttributeError, OSError):
+            # Hard links are not supported
+            shutil.copyfile(sentinels.sentinel_tile(color), filename)
+        count += 1
+    return count
+
+if __name__ == "__main__":
+    count = write_sentinel_tiles(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
+    print "     Wrote {} sentinel tiles".format(count)
+
+# vim: set shiftwidth=4 expandtab textwidth=0:
@@ -0,0 +1,122 @@
+"""Content-addressed deduplication report of tile sets
+
+Tile sets, such as the Tiles, mtbTiles, and overlay directories of each language,
+hold many identical tiles: sea, empty desert, and tiles where the maps agree.
+Each tile is identified by the MD5 digest of its content.
+
+For each tile set, a map of its tiles to their digests is written next to it,
+such as Site/Tiles.hashes, with a "zoom/x/y size mtime digest" line per tile.
+Tiles whose size and modification time are unchanged are not hashed again.
+
+The tiles themselves are left as they are: linking identical tiles to a single
+file would give them a shared modification time, hiding updated tiles from
+FindUpdatedTiles.bat, and rewriting one of them would change them all.
+The packaging and upload scripts do not use the digests either.
+
+The deduplication ratio, tiles per distinct content, is reported for each tile
+set and zoom level, and for all tile sets together.
+Adding a tile set reads the size and modification time of each of its tiles,
+so the report is run on demand, from the command line, rather than by each
+map creation.
+
+Usage:
+    dedup = TileDedup()
+    dedup.add("Hebrew/Tiles", os.path.join("Hebrew", "Tiles"))
+    dedup.add("English/Tiles", os.path.join("English", "Tiles"))
+    dedup.report()
+
+Usage from the command line:
+    python TileDedup.py <tiles directory> ...
+"""
+
+import os
+import sys
+import hashlib
+from FileUtils import replace_file
+
+class TileDedup(object):
+    def __init__(self):
+        self.statistics = {}  # {(tile set, zoom): {"tiles":, "bytes":, "distinct":, "new":}}
+        self.digests = {}  # {digest: size} of the distinct contents of all tile sets
+
+    def map_file(self, tiles_dir):
+        return os.path.normpath(tiles_dir) + ".hashes"
+
+    def read_map(self, tiles_dir):
+        """{"zoom/x/y": (size, mtime, digest)} of the previous map of a tile set"""
+        tiles = {}
+        if os.path.exists(self.map_file(tiles_dir)):
+            with open(self.map_file(tiles_dir)) as f:
+                for line in f:
+                    fields = line.split()
+                    tiles[fields[0]] = (int(fields[1]), int(fields[2]), fields[3])
+        return tiles
+
+    def add(self, name, tiles_dir):
+        """Count the contents of a tile set, and write its map of tiles to digests"""
+        previous = self.read_map(tiles_dir)
+        tiles = {}
+        for (tile, filename) in tile_files(tiles_dir):
+            stat = os.stat(filename)
+            (size, mtime) = (stat.st_size, int(stat.st_mtime))
+            unchanged = tile in previous and previous[tile][:2] == (size, mtime)
+            if unchanged:
+                digest = previous[tile][2]
+            else:
+                with open(filename, 'rb') as f:
+                    digest = hashlib.md5(f.read()).hexdigest()
+            tiles[tile] = (size, mtime, digest)
+            self.count(name, int(tile.split("/")[0]), size, digest)
+        with open(self.map_file(tiles_dir)+".tmp", 'w') as f:
+            for tile in sorted(tiles):
+                (size, mtime, digest) = tiles[tile]
+                f.write("{} {} {} {}\n".format(tile, size, mtime, digest))
+        replace_file(self.map_file(tiles_dir)+".tmp", self.map_file(tiles_dir))
+        return tiles
+
+    def count(self, name, zoom, size, digest):
+        key = (name, zoom)
+        if key not in self.statistics:
+            self.statistics[key] = {"tiles": 0, "bytes": 0, "distinct": set(), "new": 0}
+        statistics = self.statistics[key]
+        statistics["tiles"] += 1
+        statistics["bytes"] += size
+        statistics["distinct"].add(digest)
+        if digest not in self.digests:
+            self.digests[digest] = size
+            statistics["new"] += 1
+
+    def report(self):
+        """Print the deduplication ratio of each tile set and zoom level, and of all tile sets"""
+        for (name, zoom) in sorted(self.statistics):
+            statistics = self.statistics[(name, zoom)]
+            print "     {} zoom {:2}: {:8} tiles, {:8} distinct ({:5.2f} tiles per content), {:8} not in previous tile sets".format(
+                    name, zoom, statistics["tiles"], len(statistics["distinct"]),
+                    float(statistics["tiles"])/len(statistics["distinct"]), statistics["new"])
+        tiles = sum(statistics["tiles"] for statistics in self.statistics.values())
+        size = sum(statistics["bytes"] for statistics in self.statistics.values())
+        print "     Total of {} tiles, {} distinct ({:.2f} tiles per content), {} bytes, {} bytes distinct".format(
+                tiles, len(self.digests), float(tiles)/max(1, len(self.digests)), size, sum(self.digests.values()))
+
+def tile_files(tiles_dir):
+    """Generate the ("zoom/x/y", file name) of the PNG tiles of a tiles directory"""
+    if not os.path.isdir(tiles_dir):
+        return
+    for zoom in sorted(name for name in os.listdir(tiles_dir) if name.isdigit()):
+        zoom_dir = os.path.join(tiles_dir, zoom)
+        for x in sorted(name for name in os.listdir(zoom_dir) if name.isdigit()):
+            x_dir = os.path.join(zoom_dir, x)
+            if not os.path.isdir(x_dir):
+                continue
+            for name in sorted(os.listdir(x_dir)):
+                (y, extension) = os.path.splitext(name)
+                if extension == ".png" and y.isdigit():
+                    yield ("{}/{}/{}".format(zoom, x, y), os.path.join(x_dir, name))
+
+if __name__ == "__main__":
+    dedup = TileDedup()
+    for tiles_dir in sys.argv[1:]:
+        dedup.add(tiles_dir, tiles_dir)
+    dedup.report()
+
+# vim: set shiftwidth=4 expandtab textwidth=0:
@@ -0,0 +1,122 @@
+"""Expire-tile manifests: lists of tiles to be updated
+
+A manifest lists tiles sorted by zoom and then in Morton (Z-order) order,
+which keeps nearby tiles together. It is written in two variants:
+- Text: one "zoom/x/y" line per tile, as used by expire-tile lists
+- Binary (*.bin): the magic "TILEMAN1", and for each zoom level a header of
+  zoom (unsigned byte) and tile count (unsigned 32 bit, little endian),
+  followed by the deltas of consecutive Morton codes as unsigned LEB128 varints
+
+Usage from the command line, printing the tile file names of a manifest:
+    python TileManifest.py <manifest> [<tiles directory>]
+"""
+
+import os
+import sys
+import struct
+from FileUtils import replace_file
+
+MAGIC = "TILEMAN1"
+
+def morton(x, y):
+    """Interleave the bits of x (even bits) and y (odd bits)"""
+    code = 0
+    bit = 0
+    while x or y:
+        code |= (x & 1) << (2*bit) | (y & 1) << (2*bit + 1)
+        x >>= 1
+        y >>= 1
+        bit += 1
+    return code
+
+def demorton(code):
+    x = 0
+    y = 0
+    bit = 0
+    while code:
+        x |= (code & 1) << bit
+        y |= (code >> 1 & 1) << bit
+        code >>= 2
+        bit += 1
+    return (x, y)
+
+def sorted_tiles(tiles_by_zoom):
+    """(zoom, [morton codes]) pairs of {zoom: iterable of (x, y)}, sorted
+
+    Tiles beyond the edges of the world, such as guard tiles of edge tiles, are skipped.
+    """
+    return [(zoom, sorted(morton(x, y) for (x, y) in tiles_by_zoom[zoom]
+                if 0 <= x < 2**zoom and 0 <= y < 2**zoom))
+            for zoom in sorted(tiles_by_zoom)]
+
+def write_manifest(filename, tiles_by_zoom):
+    """Write text and binary manifests of {zoom: iterable of (x, y)}
+
+    The binary manifest is written to filename+".bin".
+    Each file is replaced atomically, see replace_file().
+    """
+    zoom_codes = sorted_tiles(tiles_by_zoom)
+    with open(filename + ".tmp", 'w') as f:
+        for (zoom, codes) in zoom_codes:
+            for code in codes:
+                (x, y) = demorton(code)
+                f.write("{}/{}/{}\n".format(zoom, x, y))
+    with open(filename + ".bin.tmp", 'wb') as f:
+        f.write(MAGIC)
+        for (zoom, codes) in zoom_codes:
+            f.write(struct.pack("<BI", zoom, len(codes)))
+            previous = 0
+            varints = []
+            for code in codes:
+                varints.append(varint(code - previous))
+                previous = code
+            f.write("".join(varints))
+    for name in (filename, filename + ".bin"):
+        replace_file(name + ".tmp", name)
+
+def varint(value):
+    result = []
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            result.append(chr(byte | 0x80))
+        else:
+            result.append(chr(byte))
+            return "".join(result)
+
+def read_manifest(filename):
+    """Generate (zoom, x, y) of each tile in a text or binary manifest"""
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            f.seek(0)
+            for line in f:
+                if line.strip():
+                    yield tuple(int(value) for value in line.strip().split("/"))
+            return
+        data = f.read()
+    position = 0
+    while position < len(data):
+        (zoom, count) = struct.unpack_from("<BI", data, position)
+        position += struct.calcsize("<BI")
+        code = 0
+        for i in xrange(count):
+            delta = 0
+            shift = 0
+            while True:
+                byte = ord(data[position])
+                position += 1
+                delta |= (byte & 0x7F) << shift
+                shift += 7
+                if not byte & 0x80:
+                    break
+            code += delta
+            (x, y) = demorton(code)
+            yield (zoom, x, y)
+
+if __name__ == "__main__":
+    tiles_dir = sys.argv[2] if len(sys.argv) > 2 else ""
+    for (zoom, x, y) in read_manifest(sys.argv[1]):
+        print os.path.join(tiles_dir, str(zoom), str(x), "{}.png".format(y))
+
+# vim: set shiftwidth=4 expandtab textwidth=0:
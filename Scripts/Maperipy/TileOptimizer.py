@@ -0,0 +1,204 @@
+"""Lossless optimization of saved tiles
+
+Tiles are optimized in place by optipng, which recompresses the image data and
+reduces the bit depth, color type and palette when no information is lost, for
+example to a palette of the tile's colors when it has 256 colors or fewer.
+Textual chunks, such as the tiles' Copyright, are kept.
+
+Tiles are queued as they are saved, and optimized by a bounded number of
+threads, each running one optipng process at a time. The queue is bounded as
+well, so tile generation waits for the optimization rather than piling up tiles.
+
+A cache file maps the MD5 digest of each optimized content to the digest of its
+optimization, one "digest optimized-digest" line each:
+- A tile whose content is already optimized is left as is
+- Optimized tiles of up to max_stored_size bytes, such as the many sea or empty
+  tiles, are also kept in a store directory, and a tile with the same content is
+  replaced by a copy. Larger tiles are not stored, and a larger tile saved again
+  with the same content is optimized again. Unchanged tiles are usually not saved
+  again, as Maperitive skips them by their fingerprints.
+
+The digests are appended again, once per run, when a tile has their content, so the
+cache file's last lines are the most recently used digests. When loaded with more
+than max_digests digests, or twice as many lines, the cache file is compacted to
+the max_digests most recently used digests, and the store to their tiles.
+
+Usage:
+    optimizer = TileOptimizer("Cache/optimized-tiles.digests", "Cache/optimized-tiles")
+    optimizer.optimize(tile_file_name)  # After each tile is saved
+    optimizer.finish()  # Wait for the queued tiles
+"""
+
+import os
+import hashlib
+import threading
+import Queue
+from maperipy import App
+from FileUtils import replace_file
+
+class TileOptimizer(object):
+    def __init__(self, cache_file, store_dir=None):
+        """cache_file - the digests of optimized tiles
+        store_dir - optional directory of small optimized tiles, by digest
+        """
+        self.cache_file = cache_file
+        self.store_dir = store_dir
+        self.program = "optipng.exe"
+        self.params = ["-quiet", "-o2"]  # Lossless, with a moderate search of compression settings
+        self.timeout = 60  # Seconds per tile
+        self.workers = 4  # Number of concurrent optipng processes
+        self.max_stored_size = 4096  # Bytes of the largest optimized tile in the store
+        self.max_digests = 1000000  # Number of most recently used digests kept in the cache file
+        self.lock = threading.Lock()
+        self.digests = None
+        self.used = set()  # Digests appended to the cache file by this run
+        self.queue = None
+        self.threads = []
+        self.statistics = new_statistics()
+
+    def load(self):
+        """Load the digests of optimized tiles, and open the cache file for new digests"""
+        entries = []
+        if os.path.exists(self.cache_file):
+            with open(self.cache_file) as f:
+                for line in f:
+                    digests = line.split()
+                    if len(digests) == 2:
+                        entries.append(digests)
+        if self.store_dir and not os.path.isdir(self.store_dir):
+            os.makedirs(self.store_dir)
+        self.digests = dict(entries)
+        if len(self.digests) > self.max_digests or len(entries) > 2*self.max_digests:
+            # The last line of each digest is its latest use
+            recent = []
+            digests = set()
+            for (digest, optimized_digest) in reversed(entries):
+                if len(digests) == self.max_digests:
+                    break
+                if digest not in digests:
+                    digests.add(digest)
+                    recent.append((digest, optimized_digest))
+            recent.reverse()
+            self.digests = dict(recent)
+            self.compact(recent)
+        self.used = set()
+        self.digest_file = open(self.cache_file, 'a')
+
+    def compact(self, entries):
+        """Rewrite the cache file with the given digests, and remove the stored tiles of other digests"""
+        with open(self.cache_file+".tmp", 'w') as f:
+            for (digest, optimized_digest) in entries:
+                f.write("{} {}\n".format(digest, optimized_digest))
+        replace_file(self.cache_file+".tmp", self.cache_file)
+        if self.store_dir:
+            optimized_digests = set(optimized_digest for (digest, optimized_digest) in entries)
+            for name in os.listdir(self.store_dir):
+                if name.endswith(".png") and name[:-len(".png")] not in optimized_digests:
+                    os.remove(os.path.join(self.store_dir, name))
+
+    def stored_tile(self, digest):
+        """The file name of an optimized tile in the store, or None without a store"""
+        if not self.store_dir:
+            return None
+        return os.path.join(self.store_dir, digest+".png")
+
+    def start(self):
+        if self.digests is None:
+            self.load()
+        self.statistics = new_statistics()
+        self.queue = Queue.Queue(4*self.workers)
+        self.threads = [threading.Thread(target=self.run) for i in range(self.workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def optimize(self, filename):
+        """Queue a tile for optimization, unless its content was already optimized"""
+        if self.queue is None:
+            self.start()
+        with open(filename, 'rb') as f:
+            data = f.read()
+        digest = hashlib.md5(data).hexdigest()
+        with self.lock:
+            optimized_digest = self.digests.get(digest)
+        if optimized_digest:
+            self.use(digest, optimized_digest)
+        if optimized_digest == digest:
+            self.count("skipped", len(data), len(data))
+            return
+        stored_tile = self.stored_tile(optimized_digest) if optimized_digest else None
+        if stored_tile and os.path.exists(stored_tile):
+            with open(stored_tile, 'rb') as f:
+                optimized = f.read()
+            with open(filename+".tmp", 'wb') as f:
+                f.write(optimized)
+            replace_file(filename+".tmp", filename)
+            self.count("copied", len(data), len(optimized))
+            return
+        self.queue.put((filename, digest, len(data)))
+
+    def count(self, key, size, optimized_size):
+        with self.lock:
+            self.statistics[key] += 1
+            self.statistics["bytes_before"] += size
+            self.statistics["bytes_after"] += optimized_size
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            (filename, digest, size) = item
+            try:
+                exit_code = self.run_optimizer(filename)
+                with open(filename, 'rb') as f:
+                    optimized = f.read()
+            except Exception:
+                # The tile is left as saved
+                exit_code = -1
+            if exit_code:
+                self.count("failed", size, size)
+                continue
+            optimized_digest = hashlib.md5(optimized).hexdigest()
+            stored_tile = self.stored_tile(optimized_digest)
+            if stored_tile and len(optimized) <= self.max_stored_size and not os.path.exists(stored_tile):
+                with open(stored_tile+"."+str(threading.current_thread().ident), 'wb') as f:
+                    f.write(optimized)
+                replace_file(f.name, stored_tile)
+            self.use(digest, optimized_digest)
+            self.count("optimized", size, len(optimized))
+
+    def use(self, digest, optimized_digest):
+        """Record a content and its optimization, appending them to the cache file once per run"""
+        with self.lock:
+            for (key, value) in ((digest, optimized_digest), (optimized_digest, optimized_digest)):
+                self.digests[key] = value
+                if key not in self.used:
+                    self.used.add(key)
+                    self.digest_file.write("{} {}\n".format(key, value))
+
+    def run_optimizer(self, filename):
+        """Optimize a tile in place, returns the exit code"""
+        return App.run_program(self.program, self.timeout, self.params + [filename])
+
+    def finish(self):
+        """Wait for the queued tiles to be optimized, returns the statistics"""
+        if self.queue is None:
+            return self.statistics
+        for thread in self.threads:
+            # End of tiles
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.queue = None
+        self.digest_file.flush()
+        statistics = self.statistics
+        print "     Optimized {} tiles, copied {} and skipped {} optimized tiles, {} failed: {} to {} bytes".format(
+                statistics["optimized"], statistics["copied"], statistics["skipped"], statistics["failed"],
+                statistics["bytes_before"], statistics["bytes_after"])
+        return statistics
+
+def new_statistics():
+    return {key: 0 for key in ("optimized", "copied", "skipped", "failed", "bytes_before", "bytes_after")}
+
+# vim: set shiftwidth=4 expandtab textwidth=0:
@@ -0,0 +1,103 @@
+"""Rasterization of lines and areas into tiles
+
+Lines are rasterized with a supercover traversal: every tile crossed by a
+segment is included, and both side tiles are included where a segment passes
+exactly through a tile corner.
+Areas are rasterized as their outline, with each row filled between the
+outline's leftmost and rightmost tiles. This covers the area's footprint,
+and more for concave areas.
+
+The result is a dictionary of rows: {tile_y: [(left, right), ...]} of inclusive,
+sorted, and disjoint ranges of tile columns.
+"""
+
+import math
+
+def deg2tile(lat_deg, lon_deg, zoom):
+    """The fractional tile coordinates of a location, see PolygonTileGenCommand.deg2num"""
+    lat_rad = math.radians(lat_deg)
+    n = 2.0 ** zoom
+    return ((lon_deg + 180.0) / 360.0 * n,
+            (1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2.0 * n)
+
+def segment_tiles(x0, y0, x1, y1):
+    """The tiles crossed by a segment between fractional tile coordinates"""
+    (x, y) = (int(math.floor(x0)), int(math.floor(y0)))
+    (end_x, end_y) = (int(math.floor(x1)), int(math.floor(y1)))
+    tiles = [(x, y)]
+    (dx, dy) = (x1 - x0, y1 - y0)
+    step_x = 1 if dx > 0 else -1
+    step_y = 1 if dy > 0 else -1
+    # The segment's parameter at the next column and row boundaries, and between boundaries
+    if dx:
+        next_x = ((x + (step_x > 0)) - x0)/dx
+        delta_x = abs(1.0/dx)
+    else:
+        (next_x, delta_x) = (float("inf"), 0.0)
+    if dy:
+        next_y = ((y + (step_y > 0)) - y0)/dy
+        delta_y = abs(1.0/dy)
+    else:
+        (next_y, delta_y) = (float("inf"), 0.0)
+    for i in xrange(abs(end_x - x) + abs(end_y - y)):
+        if (x, y) == (end_x, end_y):
+            break
+        if next_x == next_y:
+            # Through a corner: include both side tiles
+            tiles.append((x + step_x, y))
+            tiles.append((x, y + step_y))
+            (x, y) = (x + step_x, y + step_y)
+            next_x += delta_x
+            next_y += delta_y
+        elif next_x < next_y:
+            x += step_x
+            next_x += delta_x
+        else:
+            y += step_y
+            next_y += delta_y
+        tiles.append((x, y))
+    return tiles
+
+def line_rows(coords, zoom):
+    """The rows of tiles crossed by a line of (lon, lat) coordinates"""
+    points = [deg2tile(lat, lon, zoom) for (lon, lat) in coords]
+    columns = {}
+    if len(points) == 1:
+        points.append(points[0])
+    for i in xrange(len(points)-1):
+        for (x, y) in segment_tiles(points[i][0], points[i][1], points[i+1][0], points[i+1][1]):
+            columns.setdefault(y, set()).add(x)
+    rows = {}
+    for (y, row_columns) in columns.items():
+        rows[y] = []
+        for x in sorted(row_columns):
+            if rows[y] and rows[y][-1][1] == x - 1:
+                rows[y][-1] = (rows[y][-1][0], x)
+            else:
+                rows[y].append((x, x))
+    return rows
+
+def area_rows(coords, zoom):
+    """The rows of tiles covering an area, given the (lon, lat) coordinates of its outline"""
+    rows = line_rows(coords, zoom)
+    return {y: [(ranges[0][0], ranges[-1][1])] for (y, ranges) in rows.items()}
+
+def parent_rows(rows):
+    """The rows of the covering tiles at the lower zoom level"""
+    columns = {}
+    for (y, ranges) in rows.items():
+        columns.setdefault(y//2, []).extend((left//2, right//2) for (left, right) in ranges)
+    result = {}
+    for (y, ranges) in columns.items():
+        result[y] = []
+        for (left, right) in sorted(ranges):
+            if result[y] and result[y][-1][1] >= left - 1:
+                result[y][-1] = (result[y][-1][0], max(result[y][-1][1], right))
+            else:
+                result[y].append((left, right))
+    return result
+
+def is_closed(coords):
+    return len(coords) > 3 and coords[0] == coords[-1]
+
+# vim: set shiftwidth=4 expandtab textwidth=0:
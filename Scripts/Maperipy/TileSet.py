@@ -0,0 +1,344 @@
+"""Compact storage of a set of tiles at a single zoom level
+
+Tiles inside a given extent are stored in a packed bitmap, one long integer
+per row of tiles. Tiles outside the extent, if any, are stored in a sparse set.
+
+A TileSet can replace a dictionary keyed by (tile_x, tile_y) tuples:
+    tiles = TileSet(16, (left, top, right, bottom))
+    tiles[(x, y)] = True
+    if (x, y) in tiles: ...
+    for (x, y) in tiles: ...
+    len(tiles)
+
+A SummedAreaTable of a TileSet counts its tiles in any rectangle in constant time.
+"""
+
+import itertools
+from array import array
+
+def popcount(bits):
+    return bin(bits).count('1')
+
+def _spread_byte(byte):
+    bits = 0
+    for bit in range(8):
+        if byte >> bit & 1:
+            bits |= 3 << 2*bit
+    return bits
+
+# Each bit of a byte duplicated into two adjacent bits
+_SPREAD = [_spread_byte(byte) for byte in range(256)]
+
+def spread(bits):
+    """Duplicate each bit of a row into two adjacent bits: the row of the child tiles"""
+    result = 0L
+    shift = 0
+    while bits:
+        result |= _SPREAD[bits & 0xFF] << shift
+        bits >>= 8
+        shift += 16
+    return result
+
+class TileSet(object):
+    def __init__(self, zoom, extent=None):
+        """Create an empty set of tiles
+
+        zoom - the zoom level of the tiles
+        extent - optional (left, top, right, bottom) inclusive tile range of the bitmap
+        """
+        self.zoom = zoom
+        self.extent = extent
+        if extent:
+            (self.left, self.top, right, bottom) = extent
+            self.width = right - self.left + 1
+            self.height = bottom - self.top + 1
+        else:
+            (self.left, self.top, self.width, self.height) = (0, 0, 0, 0)
+        self.rows = [0L]*self.height
+        self.outside = set()
+        self.count = 0
+
+    def _in_extent(self, x, y):
+        return 0 <= x - self.left < self.width and 0 <= y - self.top < self.height
+
+    def add(self, x, y):
+        """Add a tile, return True if the tile is new"""
+        if self._in_extent(x, y):
+            row = self.rows[y - self.top]
+            bit = 1L << (x - self.left)
+            if row & bit:
+                return False
+            self.rows[y - self.top] = row | bit
+        else:
+            if (x, y) in self.outside:
+                return False
+            self.outside.add((x, y))
+        self.count += 1
+        return True
+
+    def discard(self, x, y):
+        if self._in_extent(x, y):
+            row = self.rows[y - self.top]
+            bit = 1L << (x - self.left)
+            if not row & bit:
+                return
+            self.rows[y - self.top] = row & ~bit
+        else:
+            if (x, y) not in self.outside:
+                return
+            self.outside.remove((x, y))
+        self.count -= 1
+
+    def add_rect(self, left, top, right, bottom):
+        """Add all tiles in an inclusive range of tiles, return the number of new tiles"""
+        count = self.count
+        if self.extent:
+            # The part of the range inside the extent is set row by row
+            bitmap_left = max(left, self.left) - self.left
+            bitmap_right = min(right, self.left + self.width - 1) - self.left
+            bitmap_top = max(top, self.top) - self.top
+            bitmap_bottom = min(bottom, self.top + self.height - 1) - self.top
+            if bitmap_left <= bitmap_right:
+                mask = ((1L << (bitmap_right - bitmap_left + 1)) - 1) << bitmap_left
+                for row_index in xrange(bitmap_top, bitmap_bottom + 1):
+                    row = self.rows[row_index]
+                    self.count += popcount(mask & ~row)
+                    self.rows[row_index] = row | mask
+        # The part of the range outside the extent is set tile by tile
+        for y in xrange(top, bottom + 1):
+            if 0 <= y - self.top < self.height:
+                outside_columns = itertools.chain(
+                        xrange(left, min(right + 1, self.left)),
+                        xrange(max(left, self.left + self.width), right + 1))
+            else:
+                outside_columns = xrange(left, right + 1)
+            for x in outside_columns:
+                if (x, y) not in self.outside:
+                    self.outside.add((x, y))
+                    self.count += 1
+        return self.count - count
+
+    def update(self, other):
+        """Add all tiles of another TileSet of the same zoom level"""
+        if other.extent == self.extent:
+            for row_index in xrange(self.height):
+                row = self.rows[row_index]
+                self.count += popcount(other.rows[row_index] & ~row)
+                self.rows[row_index] = row | other.rows[row_index]
+            for (x, y) in other.outside:
+                self.add(x, y)
+        else:
+            for (x, y) in other:
+                self.add(x, y)
+
+    def __or__(self, other):
+        result = self.copy()
+        result.update(other)
+        return result
+
+    def copy(self):
+        result = TileSet(self.zoom, self.extent)
+        result.rows = list(self.rows)
+        result.outside = set(self.outside)
+        result.count = self.count
+        return result
+
+    def intersection_update(self, other):
+        """Keep only the tiles that are also in another TileSet of the same zoom level"""
+        if other.extent == self.extent:
+            for row_index in xrange(self.height):
+                self.rows[row_index] &= other.rows[row_index]
+            self.outside &= other.outside
+            self.count = sum(popcount(row) for row in self.rows) + len(self.outside)
+        else:
+            for (x, y) in list(self):
+                if (x, y) not in other:
+                    self.discard(x, y)
+
+    def __and__(self, other):
+        result = self.copy()
+        result.intersection_update(other)
+        return result
+
+    def dilated(self):
+        """A TileSet of the same extent with all tiles of this set and their 8 neighbors"""
+        result = TileSet(self.zoom, self.extent)
+        full_row = (1L << self.width) - 1
+        # Dilate each row horizontally, then combine each row with its adjacent rows
+        horizontal = [(row | row << 1 | row >> 1) & full_row for row in self.rows]
+        for row_index in xrange(self.height):
+            row = horizontal[row_index]
+            if row_index > 0:
+                row |= horizontal[row_index-1]
+            if row_index < self.height-1:
+                row |= horizontal[row_index+1]
+            result.rows[row_index] = row
+        result.count = sum(popcount(row) for row in result.rows)
+        # Neighbors outside the extent of tiles on the bitmap's edges
+        edge_bits = 1L | 1L << (self.width-1) if self.width else 0L
+        for row_index in xrange(self.height):
+            row = self.rows[row_index]
+            if row_index in (0, self.height-1):
+                edge_row = row
+            else:
+                edge_row = row & edge_bits
+            while edge_row:
+                low_bit = edge_row & -edge_row
+                x = self.left + low_bit.bit_length() - 1
+                result.add_rect(x-1, self.top+row_index-1, x+1, self.top+row_index+1)
+                edge_row ^= low_bit
+        for (x, y) in self.outside:
+            result.add_rect(x-1, y-1, x+1, y+1)
+        return result
+
+    def parents(self, extent=None):
+        """The TileSet at zoom-1 of all tiles covering the tiles of this set"""
+        result = TileSet(self.zoom-1, extent)
+        for (x, y) in self:
+            result.add(x//2, y//2)
+        return result
+
+    def children(self, extent=None):
+        """The TileSet at zoom+1 of all tiles covered by the tiles of this set"""
+        result = TileSet(self.zoom+1, extent)
+        # Columns of this bitmap whose children are all inside the extent of the result
+        inner_left = max(0, (result.left + 1)//2 - self.left)
+        inner_right = min(self.width, (result.left + result.width)//2 - self.left)
+        if inner_left < inner_right:
+            inner_bits = ((1L << (inner_right - inner_left)) - 1) << inner_left
+        else:
+            inner_bits = 0L
+        shift = 2*self.left - result.left
+        for row_index in xrange(self.height):
+            row = self.rows[row_index]
+            if not row:
+                continue
+            y = self.top + row_index
+            if 0 <= 2*y - result.top and 2*y + 1 - result.top < result.height:
+                child_row = spread(row & inner_bits)
+                child_row = child_row << shift if shift >= 0 else child_row >> -shift
+                for child_y in (2*y, 2*y + 1):
+                    result.rows[child_y - result.top] |= child_row
+                result.count += 2*popcount(child_row)
+                row &= ~inner_bits
+            # Tiles with children on or beyond the edge of the result's bitmap
+            while row:
+                low_bit = row & -row
+                x = self.left + low_bit.bit_length() - 1
+                result.add_rect(2*x, 2*y, 2*x+1, 2*y+1)
+                row ^= low_bit
+        for (x, y) in self.outside:
+            result.add_rect(2*x, 2*y, 2*x+1, 2*y+1)
+        return result
+
+    def __contains__(self, tile):
+        (x, y) = tile
+        if self._in_extent(x, y):
+            return bool(self.rows[y - self.top] >> (x - self.left) & 1)
+        return tile in self.outside
+
+    def __setitem__(self, tile, value):
+        if value:
+            self.add(*tile)
+        else:
+            self.discard(*tile)
+
+    def __len__(self):
+        return self.count
+
+    def __nonzero__(self):
+        return self.count > 0
+
+    def __iter__(self):
+        for row_index in xrange(self.height):
+            row = self.rows[row_index]
+            y = self.top + row_index
+            while row:
+                low_bit = row & -row
+                yield (self.left + low_bit.bit_length() - 1, y)
+                row ^= low_bit
+        for tile in list(self.outside):
+            yield tile
+
+    def write(self, f):
+        """Write the TileSet as three text lines: header, bitmap rows, and other tiles"""
+        f.write("TileSet {} {}\n".format(self.zoom,
+            " ".join(str(value) for value in self.extent) if self.extent else "None"))
+        f.write(" ".join("{:x}".format(row) for row in self.rows) + "\n")
+        f.write(" ".join("{},{}".format(x, y) for (x, y) in sorted(self.outside)) + "\n")
+
+    @staticmethod
+    def read(f):
+        """Read a TileSet written by TileSet.write"""
+        header = f.readline().split()
+        if not header or header[0] != "TileSet":
+            raise ValueError("Not a TileSet")
+        if header[2] == "None":
+            result = TileSet(int(header[1]))
+        else:
+            result = TileSet(int(header[1]), tuple(int(value) for value in header[2:6]))
+        rows = f.readline().split()
+        if len(rows) != result.height:
+            raise ValueError("TileSet has {} rows instead of {}".format(len(rows), result.height))
+        result.rows = [long(row, 16) for row in rows]
+        result.outside = set(tuple(int(value) for value in tile.split(","))
+                for tile in f.readline().split())
+        result.count = sum(popcount(row) for row in result.rows) + len(result.outside)
+        return result
+
+    def memory_size(self):
+        """Approximate size of the tile storage in bytes"""
+        return (sum((row.bit_length()+7)//8 for row in self.rows)
+                + 8*len(self.rows) + 100*len(self.outside))
+
+    def __repr__(self):
+        return "TileSet(zoom={}, extent={}, {} tiles)".format(self.zoom, self.extent, self.count)
+
+class SummedAreaTable(object):
+    def __init__(self, tiles):
+        """Index a TileSet for rectangle queries. Later changes of the TileSet are not indexed.
+
+        sums[(y+1)*(width+1) + x+1] is the number of tiles in bitmap columns 0..x of rows 0..y.
+        Tiles outside the bitmap's extent are checked one by one.
+        """
+        self.zoom = tiles.zoom
+        (self.left, self.top, self.width, self.height) = (tiles.left, tiles.top, tiles.width, tiles.height)
+        stride = self.width + 1
+        self.sums = array('l', [0])*(stride*(self.height + 1))
+        for row_index in xrange(self.height):
+            row = tiles.rows[row_index]
+            above = row_index*stride
+            here = above + stride
+            if not row:
+                self.sums[here:here+stride] = self.sums[above:above+stride]
+                continue
+            running = 0
+            # The row's bits from column 0 on
+            for (column, bit) in enumerate(reversed(bin(row)[2:].zfill(self.width))):
+                if bit == '1':
+                    running += 1
+                self.sums[here+column+1] = self.sums[above+column+1] + running
+        self.outside = list(tiles.outside)
+
+    def count(self, left, top, right, bottom):
+        """The number of tiles in an inclusive range of tiles"""
+        result = 0
+        bitmap_left = max(left, self.left) - self.left
+        bitmap_right = min(right, self.left + self.width - 1) - self.left
+        bitmap_top = max(top, self.top) - self.top
+        bitmap_bottom = min(bottom, self.top + self.height - 1) - self.top
+        if bitmap_left <= bitmap_right and bitmap_top <= bitmap_bottom:
+            stride = self.width + 1
+            (upper, lower) = (bitmap_top*stride, (bitmap_bottom + 1)*stride)
+            result = (self.sums[lower + bitmap_right + 1] - self.sums[upper + bitmap_right + 1]
+                    - self.sums[lower + bitmap_left] + self.sums[upper + bitmap_left])
+        for (x, y) in self.outside:
+            if left <= x <= right and top <= y <= bottom:
+                result += 1
+        return result
+
+    def any(self, left, top, right, bottom):
+        """Is there a tile in an inclusive range of tiles?"""
+        return self.count(left, top, right, bottom) > 0
+
+# vim: set shiftwidth=4 expandtab textwidth=0:
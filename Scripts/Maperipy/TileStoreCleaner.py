@@ -0,0 +1,205 @@
+"""Removal of stored tiles outside a tile generation polygon, or excluded by its zoom regions
+
+A tiles directory holds zoom/x/y.png tiles, and their y.png.finger fingerprints.
+The cleaner walks a tiles directory once, classifies each stored tile against the
+polygon (see PolygonTileClassifier), and removes the files of the tiles outside
+the polygon in batches, by several threads.
+Columns left empty are removed as well, and so are the tiles outside the
+polygon in the tiles directory's SentinelIndex.
+Optionally, the tiles excluded at their zoom level by zoom regions are removed as
+well, see PolygonTileGenCommand.add_zoom_region().
+
+This keeps the removal of stale tiles out of the tile generation loop.
+
+Usage inside Maperitive:
+    cleaner = TileStoreCleaner(tile_gen_command.tile_classifier())
+    cleaner.zoom_regions = tile_gen_command.zoom_region_classifiers()
+    cleaner.clean([tiles_dir, ...])
+
+Usage from the command line, with an Osmosis polygon file:
+    python TileStoreCleaner.py [--dry-run] <polygon.poly> <tiles directory> ...
+"""
+
+import os
+import sys
+import errno
+import threading
+import Queue
+from PolygonTileClassifier import PolygonTileClassifier, INSIDE, OUTSIDE
+from SentinelIndex import SentinelIndex, sentinel_dir
+
+class TileStoreCleaner(object):
+    def __init__(self, classifier):
+        """classifier - a built PolygonTileClassifier of the generation polygon"""
+        self.classifier = classifier
+        self.workers = 4  # Number of file removal threads
+        self.batch_size = 1000  # Number of files removed by a thread at a time
+        self.dry_run = False  # List the stale files without removing them?
+        self.removal_script = None  # Optional: a Unix script to remove the stale files independently
+        self.zoom_regions = []  # [(classifier, min_zoom, max_zoom), ...] of zoom regions, see stale_tile()
+        self.verbose = True
+
+    def clean(self, tiles_dirs, min_zoom=None, max_zoom=None):
+        """Remove the stale tiles from tile directories, see stale_tile()
+
+        Only zoom levels in an optional range are cleaned.
+        Returns the list of stale files.
+        """
+        stale = []
+        empty_dirs = []
+        for tiles_dir in tiles_dirs:
+            if not os.path.isdir(tiles_dir):
+                continue
+            for zoom in sorted(numbered(os.listdir(tiles_dir))):
+                if (min_zoom is not None and zoom < min_zoom) or (max_zoom is not None and zoom > max_zoom):
+                    continue
+                (zoom_stale, zoom_empty, scanned) = self.scan_zoom(tiles_dir, zoom)
+                if self.verbose and zoom_stale:
+                    print "     {}: {} of {} files of zoom {} are stale".format(
+                            tiles_dir, len(zoom_stale), scanned, zoom)
+                stale.extend(zoom_stale)
+                empty_dirs.extend(zoom_empty)
+            if not self.dry_run and os.path.isdir(sentinel_dir(tiles_dir)):
+                self.clean_sentinels(SentinelIndex(sentinel_dir(tiles_dir)), min_zoom, max_zoom)
+        if self.removal_script:
+            with open(self.removal_script, 'w') as script:
+                for filename in stale:
+                    script.write("rm -f '{}'\n".format(filename))
+        if not self.dry_run:
+            self.remove(stale)
+            for dirname in empty_dirs:
+                try:
+                    os.rmdir(dirname)
+                except OSError:
+                    # A file was added to the column meanwhile
+                    pass
+        if self.verbose:
+            print "     {} {} stale tile store files".format(
+                    "Found" if self.dry_run else "Removed", len(stale))
+        return stale
+
+    def stale_tile(self, zoom, x, y):
+        """Is a tile outside the polygon, or inside a zoom region excluding its zoom level?"""
+        if self.classifier.classify(zoom, x, y) == OUTSIDE:
+            return True
+        for (classifier, min_zoom, max_zoom) in self.zoom_regions:
+            if not min_zoom <= zoom <= max_zoom and classifier.classify(zoom, x, y) == INSIDE:
+                return True
+        return False
+
+    def clean_sentinels(self, sentinels, min_zoom=None, max_zoom=None):
+        """Remove the stale sentinel tiles from a SentinelIndex"""
+        for (zoom, x, y, color) in list(sentinels):
+            if (min_zoom is not None and zoom < min_zoom) or (max_zoom is not None and zoom > max_zoom):
+                continue
+            if self.stale_tile(zoom, x, y):
+                sentinels.discard(zoom, x, y)
+        sentinels.close()
+
+    def scan_zoom(self, tiles_dir, zoom):
+        """The stale files of a zoom level, the columns left empty, and the number of files"""
+        stale = []
+        empty_dirs = []
+        scanned = 0
+        zoom_dir = os.path.join(tiles_dir, str(zoom))
+        for (x, x_name) in numbered(os.listdir(zoom_dir)).items():
+            x_dir = os.path.join(zoom_dir, x_name)
+            if not os.path.isdir(x_dir):
+                continue
+            names = os.listdir(x_dir)
+            scanned += len(names)
+            # A tile and its fingerprint are both stale or not
+            stale_ys = {}
+            column_stale = []
+            for name in names:
+                y = name.split(".", 1)[0]
+                if not y.isdigit():
+                    continue
+                if y not in stale_ys:
+                    stale_ys[y] = self.stale_tile(zoom, x, int(y))
+                if stale_ys[y]:
+                    column_stale.append(os.path.join(x_dir, name))
+            stale.extend(column_stale)
+            if column_stale and len(column_stale) == len(names):
+                empty_dirs.append(x_dir)
+        return (stale, empty_dirs, scanned)
+
+    def remove(self, filenames):
+        """Remove files in batches by self.workers threads"""
+        batches = Queue.Queue(2*self.workers)
+        workers = [tileRemovalWorker(batches) for i in range(self.workers)]
+        threads = [threading.Thread(target=worker.run) for worker in workers]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for start in xrange(0, len(filenames), self.batch_size):
+                batches.put(filenames[start:start+self.batch_size])
+        finally:
+            for thread in threads:
+                # End of batches
+                batches.put(None)
+            for thread in threads:
+                thread.join()
+        for worker in workers:
+            if worker.error is not None:
+                raise worker.error
+
+class tileRemovalWorker(object):
+    """A thread removing batches of files, ignoring files already removed"""
+    def __init__(self, batches):
+        self.batches = batches
+        self.error = None
+
+    def run(self):
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                return
+            if self.error is not None:
+                # Drain the queue after a failure
+                continue
+            try:
+                for filename in batch:
+                    silent_remove(filename)
+            except BaseException as e:
+                self.error = e
+
+def numbered(names):
+    """{number: name} of the names that are decimal numbers"""
+    return {int(name): name for name in names if name.isdigit()}
+
+def silent_remove(filename):
+    try:
+        os.remove(filename)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+def read_poly(filename):
+    """The (lon, lat) coordinates of the first ring of an Osmosis polygon file"""
+    coords = []
+    with open(filename) as f:
+        lines = [line.strip() for line in f]
+    # A name line, then sections of a name line, coordinate lines, and an END line
+    for line in lines[2:]:
+        if line == "END":
+            break
+        (lon, lat) = line.split()[:2]
+        coords.append((float(lon), float(lat)))
+    return coords
+
+if __name__ == "__main__":
+    arguments = sys.argv[1:]
+    dry_run = "--dry-run" in arguments
+    if dry_run:
+        arguments.remove("--dry-run")
+    classifier = PolygonTileClassifier(read_poly(arguments[0]), 16).cached("Cache")
+    cleaner = TileStoreCleaner(classifier)
+    cleaner.dry_run = dry_run
+    cleaner.verbose = not dry_run
+    for filename in cleaner.clean(arguments[1:]):
+        if dry_run:
+            print filename
+
+# vim: set shiftwidth=4 expandtab textwidth=0:
@@ -0,0 +1,65 @@
+"""Tests of RulesetTags against the scripts and rulesets of the repository
+
+Usage:
+    python RulesetTagsTest.py
+Runs under CPython 2.7, without Maperitive.
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Maperipy")
+sys.path.append(SCRIPTS_DIR)
+
+from RulesetTags import RulesetTags
+
+class AddOsmTagsTest(unittest.TestCase):
+    def setUp(self):
+        self.tags = RulesetTags()
+        self.tags.read_script(os.path.join(SCRIPTS_DIR, "AddOsmTags.py"))
+
+    def test_loop_keys_are_read(self):
+        # for osmTag in ("boundary", "leisure"): ... has_tag(osmTag)
+        self.assertTrue(self.tags.changed({"boundary": "administrative"}, {"boundary": "political"}))
+        self.assertTrue(self.tags.changed({}, {"leisure": "park"}))
+        self.assertTrue(self.tags.changed({"is_in": "Israel"}, {}))
+
+    def test_literal_keys_and_values(self):
+        self.assertTrue(self.tags.changed({"highway": "path"}, {"highway": "track"}))
+        self.assertTrue(self.tags.changed({"natural": "peak"}, {"natural": "ridge"}))
+
+    def test_unread_keys_are_skipped(self):
+        self.assertFalse(self.tags.all_keys)
+        self.assertFalse(self.tags.changed({"source": "survey"}, {"source": "bing"}))
+
+class ScriptTest(unittest.TestCase):
+    def setUp(self):
+        (handle, self.filename) = tempfile.mkstemp(suffix=".py")
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def read(self, script):
+        with open(self.filename, 'w') as f:
+            f.write(script)
+        tags = RulesetTags()
+        tags.read_script(self.filename)
+        return tags
+
+    def test_unknown_key_reads_all_keys(self):
+        tags = self.read("def tag_of(element, key):\n    return element.get_tag(key)\n")
+        self.assertTrue(tags.all_keys)
+        self.assertTrue(tags.changed({"source": "survey"}, {"source": "bing"}))
+        self.assertFalse(tags.changed({"source": "survey"}, {"source": "survey"}))
+
+    def test_variable_value_reads_key(self):
+        tags = self.read("x.has_tag('name:en', place)\n")
+        self.assertTrue(tags.changed({"name:en": "Haifa"}, {"name:en": "Hefa"}))
+
+if __name__ == "__main__":
+    unittest.main()
+
+# vim: set shiftwidth=4 expandtab textwidth=0: